@@ -0,0 +1,178 @@
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Sequence
+
+from app.middleware.deadline import DEFAULT_ROUTE_TIMEOUTS, MAX_REQUEST_TIMEOUT
+from app.profile_import import IMPORT_TIMEOUT_SECONDS
+
+# Time-bucketed audit event counts for dashboards.
+#
+# Counts are computed in SQL with date_trunc over audit_events_all, one row per (bucket, group).
+# Audit events are append-only and always stamped with the current time, so once a bucket has
+# ended its counts can only change through transactions still in flight: an event stamped in the
+# bucket becomes visible when its transaction commits, which can be as late as the longest request
+# deadline, or the longest import (a CSV file is imported in one transaction, see app/profile_import.py).
+# Buckets are cached only once they ended more than that settle delay ago.
+#
+# The counts are read from a replica, which may lag the primary by any amount: a replica only
+# has what it replayed, so buckets are cached once settled relative to its last replayed
+# transaction (pg_last_xact_replay_timestamp) rather than to the current time.
+
+BUCKET_SIZES = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+DEFAULT_BUCKETS = {"hour": 24, "day": 30}  # Range returned when no start is given
+GROUP_COLUMNS = ("action", "resource")  # Columns counts can be grouped by
+ANALYTICS_MAX_BUCKETS = int(os.getenv("ANALYTICS_MAX_BUCKETS", "2000"))  # Largest range accepted, in buckets
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "20000"))  # Closed buckets kept in memory
+LONGEST_TRANSACTION_SECONDS = max(MAX_REQUEST_TIMEOUT, IMPORT_TIMEOUT_SECONDS, *(seconds for _, _, seconds in DEFAULT_ROUTE_TIMEOUTS))
+ANALYTICS_SETTLE_SECONDS = float(os.getenv(  # Delay before an ended bucket is cached: the longest transaction plus a margin
+    "ANALYTICS_SETTLE_SECONDS", str(LONGEST_TRANSACTION_SECONDS + 60)
+))
+
+
+def truncate(timestamp: datetime, bucket_size: str) -> datetime:
+    """
+    Returns the start of the bucket containing a timestamp, like date_trunc in Postgres.
+
+    Args:
+        timestamp (datetime): The timestamp to truncate.
+        bucket_size (str): "hour" or "day".
+
+    Returns:
+        datetime: The start of the bucket.
+    """
+    timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0) if bucket_size == "day" else timestamp
+
+
+def check_group_by(group_by: Sequence[str]) -> tuple:
+    """
+    Validates the grouping columns, dropping duplicates and keeping a canonical order.
+
+    Raises:
+        ValueError: If a column can't be grouped by.
+    """
+    unknown = set(group_by) - set(GROUP_COLUMNS)
+    if unknown:
+        raise ValueError(f"Cannot group by {', '.join(sorted(unknown))}; use {' or '.join(GROUP_COLUMNS)}")
+    return tuple(column for column in GROUP_COLUMNS if column in group_by)
+
+
+class BucketCache:
+    def __init__(self, max_size: int = ANALYTICS_CACHE_SIZE):
+        """
+        Initializes an LRU cache of the counts of closed buckets.
+
+        Args:
+            max_size (int): Maximum number of buckets kept.
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (bucket_size, group_by, bucket) -> count rows
+
+    def get(self, key: tuple) -> Optional[list]:
+        """Returns the cached rows of a bucket, or None."""
+        rows = self._entries.get(key)
+        if rows is not None:
+            self._entries.move_to_end(key)
+        return rows
+
+    def put(self, key: tuple, rows: list):
+        """Caches the rows of a closed bucket, evicting the least recently used bucket when full."""
+        self._entries[key] = rows
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes every cached bucket."""
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = BucketCache()  # Process-wide cache shared by all requests
+
+
+def get_bucket_cache() -> BucketCache:
+    """Returns the process-wide bucket cache."""
+    return _cache
+
+
+async def bucketed_counts(repository, bucket_size: str = "hour", start: Optional[datetime] = None,
+                          end: Optional[datetime] = None, group_by: Sequence[str] = GROUP_COLUMNS,
+                          cache: Optional[BucketCache] = None, now: Optional[datetime] = None) -> dict:
+    """
+    Counts audit events per time bucket, serving closed buckets from the cache.
+
+    The range is widened to whole buckets, so a bucket's counts never depend on the requested range.
+
+    Args:
+        repository (AuditEventRepository): Repository providing count_by_bucket and replayed_until.
+        bucket_size (str): "hour" or "day".
+        start (datetime): Start of the range; defaults to DEFAULT_BUCKETS buckets before the end.
+        end (datetime): End of the range (exclusive); defaults to now.
+        group_by (Sequence[str]): Columns to group the counts by ("action", "resource"; may be empty).
+        cache (BucketCache): Cache of closed buckets; defaults to the process-wide cache.
+        now (datetime): Current time (for tests).
+
+    Returns:
+        dict: The aligned range, the counts ordered by bucket, and the number of buckets served from the cache.
+
+    Raises:
+        ValueError: If the bucket size, grouping or range is invalid.
+    """
+    if bucket_size not in BUCKET_SIZES:
+        raise ValueError(f"Unknown bucket size {bucket_size!r}; use {' or '.join(BUCKET_SIZES)}")
+    group_by = check_group_by(group_by)
+    cache = cache if cache is not None else _cache
+    now = now or datetime.now()
+    step = BUCKET_SIZES[bucket_size]
+
+    end = naive_local(end) if end else now
+    last = truncate(end - timedelta(microseconds=1), bucket_size)  # The end is exclusive
+    first = truncate(naive_local(start), bucket_size) if start else last - step * (DEFAULT_BUCKETS[bucket_size] - 1)
+    if first > last:
+        raise ValueError("The start of the range must be before its end")
+    count = (last - first) // step + 1
+    if count > ANALYTICS_MAX_BUCKETS:
+        raise ValueError(f"The range spans {count} buckets; at most {ANALYTICS_MAX_BUCKETS} are allowed")
+    buckets = [first + step * i for i in range(count)]
+
+    settle = timedelta(seconds=ANALYTICS_SETTLE_SECONDS)
+    rows_by_bucket = {}
+    for bucket in buckets:
+        if bucket + step <= now - settle:
+            rows = cache.get((bucket_size, group_by, bucket))
+            if rows is not None:
+                rows_by_bucket[bucket] = rows
+    cached = len(rows_by_bucket)
+
+    missing = [bucket for bucket in buckets if bucket not in rows_by_bucket]
+    if missing:
+        # Read before counting: the counts then include at least everything replayed up to this point
+        replayed = await repository.replayed_until()
+        settled = min(now, naive_local(replayed)) - settle if replayed else now - settle
+        # One query over the span of uncached buckets: usually just the open ones at the end of the range
+        fresh = {bucket: [] for bucket in missing}
+        for row in await repository.count_by_bucket(bucket_size, group_by, missing[0], missing[-1] + step):
+            if row["bucket"] in fresh:
+                fresh[row["bucket"]].append(row)
+        for bucket, rows in fresh.items():
+            rows_by_bucket[bucket] = rows
+            if bucket + step <= settled:
+                cache.put((bucket_size, group_by, bucket), rows)
+
+    return {
+        "bucket_size": bucket_size,
+        "start": first,
+        "end": last + step,
+        "group_by": list(group_by),
+        "buckets": [row for bucket in buckets for row in rows_by_bucket[bucket]],
+        "cached_buckets": cached,
+    }
+
+
+def naive_local(timestamp: datetime) -> datetime:
+    """Converts an aware timestamp to local time, like the naive timestamps stored in audit_events."""
+    return timestamp.astimezone().replace(tzinfo=None) if timestamp.tzinfo else timestamp
@@ -0,0 +1,159 @@
+from contextlib import asynccontextmanager
+from fastapi import Request
+from app import database, deadlines, sharding
+from app.middleware.read_your_writes import LSN_COOKIE
+from app.repositories.audit_event_repository import AuditEventRepository
+from app.repositories.memory import InMemoryAuditEventRepository, InMemoryUserProfileRepository, get_memory_store
+from app.repositories.sharded import sharded_repositories
+from app.repositories.user_profile_repository import UserProfileRepository
+from app.unit_of_work import InMemoryUnitOfWork, ShardedUnitOfWork, UnitOfWork
+
+# Repository dependencies. Handlers receive their repositories through Depends(), so the storage
+# backend is chosen by configuration (database.STORAGE_BACKEND) or by app.dependency_overrides.
+#
+# Writes use the primary. When read replicas are configured, the WAL position reached by a write is
+# returned to the client (X-Last-Write-LSN header and last_write_lsn cookie, see
+# app/middleware/read_your_writes.py); reads that send it back are only served by replicas that have
+# replayed that far, and by the primary otherwise.
+#
+# When the storage is sharded (DATABASE_SHARD_URLS, see app/sharding.py), repositories span the shards
+# and hold a connection to each shard the request touches; replicas are not used.
+#
+# Every connection handed to a request gets the request's deadline as its statement_timeout
+# (app/deadlines.py).
+
+LSN_HEADER = "X-Last-Write-LSN"
+
+
+def _min_lsn(request: Request):
+    """Returns the WAL position of the client's last write, if the client sent one."""
+    return request.headers.get(LSN_HEADER) or request.cookies.get(LSN_COOKIE)
+
+
+@asynccontextmanager
+async def _connection(request: Request, readonly: bool):
+    """
+    Holds a database connection for the duration of a request.
+
+    Args:
+        request (Request): The current request.
+        readonly (bool): Whether the request only reads and may be served by a replica.
+    """
+    connection = await database.connect_to_db(readonly=readonly, min_lsn=_min_lsn(request) if readonly else None)
+    try:
+        await deadlines.apply_statement_timeout(connection)  # Statements stop at the request's deadline
+        yield connection
+        if not readonly and database.DATABASE_REPLICA_URLS:
+            request.state.last_write_lsn = await database.current_lsn(connection)  # Covers this request's writes
+    finally:
+        await database.close_db_connection(connection)  # Always give the connection back, even on errors
+
+
+async def _connect_to_shard(index: int):
+    """Opens a request's connection to a shard."""
+    connection = await database.connect_to_shard(index)
+    try:
+        await deadlines.apply_statement_timeout(connection)
+    except BaseException:
+        await database.close_db_connection(connection)
+        raise
+    return connection
+
+
+async def get_user_profile_repository(request: Request):
+    """
+    Provides a UserProfileRepository on the primary for the duration of a request.
+
+    Yields:
+        UserProfileRepository: A repository bound to a database connection, or to the in-memory store.
+    """
+    if database.STORAGE_BACKEND == "memory":
+        yield InMemoryUserProfileRepository(get_memory_store())
+        return
+
+    if sharding.is_sharded():
+        async with sharded_repositories(connect=_connect_to_shard) as repositories:
+            yield repositories[0]
+        return
+
+    async with _connection(request, readonly=False) as connection:
+        yield UserProfileRepository(connection)
+
+async def get_audit_event_repository(request: Request):
+    """
+    Provides an AuditEventRepository on the primary for the duration of a request.
+
+    Yields:
+        AuditEventRepository: A repository bound to a database connection, or to the in-memory store.
+    """
+    if database.STORAGE_BACKEND == "memory":
+        yield InMemoryAuditEventRepository(get_memory_store())
+        return
+
+    if sharding.is_sharded():
+        async with sharded_repositories(connect=_connect_to_shard) as repositories:
+            yield repositories[1]
+        return
+
+    async with _connection(request, readonly=False) as connection:
+        yield AuditEventRepository(connection)
+
+async def get_read_user_profile_repository(request: Request):
+    """
+    Provides a read-only UserProfileRepository, served by a replica when one has caught up with the client.
+
+    Yields:
+        UserProfileRepository: A repository bound to a replica or primary connection, or to the in-memory store.
+    """
+    if database.STORAGE_BACKEND == "memory":
+        yield InMemoryUserProfileRepository(get_memory_store())
+        return
+
+    if sharding.is_sharded():
+        async with sharded_repositories(connect=_connect_to_shard) as repositories:
+            yield repositories[0]
+        return
+
+    async with _connection(request, readonly=True) as connection:
+        yield UserProfileRepository(connection)
+
+async def get_read_audit_event_repository(request: Request):
+    """
+    Provides a read-only AuditEventRepository, served by a replica when one has caught up with the client.
+
+    Yields:
+        AuditEventRepository: A repository bound to a replica or primary connection, or to the in-memory store.
+    """
+    if database.STORAGE_BACKEND == "memory":
+        yield InMemoryAuditEventRepository(get_memory_store())
+        return
+
+    if sharding.is_sharded():
+        async with sharded_repositories(connect=_connect_to_shard) as repositories:
+            yield repositories[1]
+        return
+
+    async with _connection(request, readonly=True) as connection:
+        yield AuditEventRepository(connection)
+
+async def get_unit_of_work(request: Request):
+    """
+    Provides a UnitOfWork on the primary: one connection and one transaction for the whole request,
+    committed when the handler returns and rolled back when it raises.
+
+    Yields:
+        UnitOfWork: The unit of work exposing user_profiles and audit_events.
+    """
+    if database.STORAGE_BACKEND == "memory":
+        async with InMemoryUnitOfWork(get_memory_store()) as unit_of_work:
+            yield unit_of_work
+        return
+
+    if sharding.is_sharded():
+        async with ShardedUnitOfWork(len(database.DATABASE_SHARD_URLS), connect=_connect_to_shard) as unit_of_work:
+            yield unit_of_work
+        return
+
+    async with _connection(request, readonly=False) as connection:
+        async with UnitOfWork(connection) as unit_of_work:  # Committed before the write LSN is read
+            yield unit_of_work
@@ -1,15 +1,33 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+import asyncpg
+from fastapi import APIRouter, File, HTTPException, Query, Response, UploadFile, status, Depends
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from app.api import auth
 from app.api.auth import get_current_user, get_current_active_user
 from app.models.user import User, UserInDB
-from app.models.audit_event import AuditEvent, AuditEventAction
-from app.models.user_profile import UserProfile, UserProfileCreate
-from typing import List, Annotated
-from app.database import connect_to_db
+from app.models.audit_event import AuditAnalytics, AuditBucketSize, AuditEvent, AuditEventAction, AuditEventPage, AuditHistory
+from app.models.audit_verification import VerificationRun
+from app.models.user_profile import PROFILE_LIST_INCLUDES, ProfileChangePage, ProfileListItem, UserProfile, UserProfileCreate
+from app.models.profile_import import ProfileImport
+from app.models.purge import PurgeRequest, PurgeRun
+from app.models.slow_query import SlowQuery
+from app.models.profiling import RequestProfile
+from app.models.batch import AuditEventLookup, BatchGetRequest, LookupStatus, ProfileLookup
+from datetime import datetime
+from typing import List, Annotated, Optional
+from app import analytics, profiling, query_log
+from app.pagination import decode_change_cursor, decode_cursor, decode_id_cursor, encode_cursor, encode_id_cursor
+from app.jobs import import_profiles as import_job
+from app.jobs import purge_deleted_profiles as purge_job
+from app.jobs import verify_audit_chain as verify_job
+from app.api.dependencies import (
+    get_user_profile_repository, get_audit_event_repository,
+    get_read_user_profile_repository, get_read_audit_event_repository, get_unit_of_work,
+)
 from app.repositories.user_profile_repository import UserProfileRepository
 from app.repositories.audit_event_repository import AuditEventRepository
 from app.repositories.user_repository import UserRepository
+from app.unit_of_work import UnitOfWork
 from app.api.auth import oauth2_scheme
 # Initialize the API router
 router = APIRouter()
@@ -66,7 +84,8 @@ async def login_user(form_data: OAuth2PasswordRequestForm = Depends()):
 # ===========================
 
 @router.post("/users/profile/", response_model=UserProfile, status_code=status.HTTP_201_CREATED, tags=["User Profile"])
-async def create_user_profile(profile: UserProfileCreate, current_user: User = Depends(get_current_user)):
+async def create_user_profile(profile: UserProfileCreate, current_user: User = Depends(get_current_user),
+                              unit_of_work: UnitOfWork = Depends(get_unit_of_work)):
     """
     Create a new user profile.
 
@@ -77,32 +96,57 @@ async def create_user_profile(profile: UserProfileCreate, current_user: User = D
     Returns:
         UserProfile: The created user profile.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    user_profile_repo = UserProfileRepository(connection)  # Create an instance of the user profile repository
-    
-    new_profile = await user_profile_repo.create(profile)  # Create the new user profile in the database
-    
-    await connection.close()  # Close the connection after use
-    return new_profile
+    return await unit_of_work.user_profiles.create(profile)  # Create the new user profile in the database
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"  # Cursor of the next page of a paginated profile listing
+
+async def _list_profiles(user_profile_repo: UserProfileRepository, response: Response, active_only: bool,
+                        include: List[str], limit: Optional[int], cursor: Optional[str]) -> List[ProfileListItem]:
+    """
+    Serves a profile listing: all profiles, or a page of them, with the activity asked for.
+
+    Raises:
+        HTTPException: 400 if an include option or the cursor is invalid.
+    """
+    options = tuple(dict.fromkeys(option.strip() for value in include for option in value.split(",") if option.strip()))
+    unknown = [option for option in options if option not in PROFILE_LIST_INCLUDES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown include option(s): {', '.join(unknown)}; "
+                                                    f"expected {', '.join(PROFILE_LIST_INCLUDES)}")
+    try:
+        after = decode_id_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-@router.get("/users/profile/", response_model=List[UserProfile], tags=["User Profile"])
-async def get_users_profiles(current_user: User = Depends(get_current_user)):
+    profiles = await user_profile_repo.list_profiles(active_only=active_only, include=options, after=after,
+                                                     limit=limit + 1 if limit else None)  # One extra row tells if there is a next page
+    if limit and len(profiles) > limit:
+        profiles = profiles[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_id_cursor(profiles[-1].id)
+    return profiles
+
+@router.get("/users/profile/", response_model=List[ProfileListItem], response_model_exclude_unset=True, tags=["User Profile"])
+async def get_users_profiles(response: Response, include: List[str] = Query([]),
+                             limit: Optional[int] = Query(None, ge=1, le=1000), cursor: Optional[str] = None,
+                             current_user: User = Depends(get_current_user),
+                             user_profile_repo: UserProfileRepository = Depends(get_read_user_profile_repository)):
     """
-    Retrieve all user profiles.
+    Retrieve all user profiles, ordered by ID (creation order).
+
+    Args:
+        include (List[str]): Activity to embed in every profile, comma separated: "last_event" (the user's
+            latest audit event) and/or "event_count". Read in the same query as the profiles.
+        limit (int): Page size; without it every profile is returned.
+        cursor (str): The X-Next-Cursor header of the previous page.
 
     Returns:
-        List[UserProfile]: A list of all user profiles.
+        List[ProfileListItem]: The user profiles; the X-Next-Cursor header is set when there is a next page.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    user_profile_repo = UserProfileRepository(connection)  # Create an instance of the user profile repository
-    
-    user_profiles = await user_profile_repo.get_all()  # Fetch all user profiles from the database
-    
-    await connection.close()  # Close the connection after use
-    return user_profiles
+    return await _list_profiles(user_profile_repo, response, False, include, limit, cursor)
 
 @router.get("/users/{user_id}/profile/", response_model=UserProfile, tags=["User Profile"])
-async def get_user_profile(user_id: str, current_user: User = Depends(get_current_user)):
+async def get_user_profile(user_id: str, current_user: User = Depends(get_current_user),
+                           user_profile_repo: UserProfileRepository = Depends(get_read_user_profile_repository)):
     """
     Retrieve a user profile by its ID.
 
@@ -115,13 +159,8 @@ async def get_user_profile(user_id: str, current_user: User = Depends(get_curren
     Raises:
         HTTPException: If the user profile is not found or is deleted.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    user_profile_repo = UserProfileRepository(connection)  # Create an instance of the user profile repository
-    
     user_profile = await user_profile_repo.get_by_id(user_id)  # Fetch the user profile by ID
-    
-    await connection.close()  # Close the connection after use
-    
+
     if user_profile is None:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -130,8 +169,33 @@ async def get_user_profile(user_id: str, current_user: User = Depends(get_curren
     
     return user_profile
 
+@router.post("/users/profiles/batch/", response_model=List[ProfileLookup], tags=["User Profile"])
+async def get_user_profiles_batch(request: BatchGetRequest, current_user: User = Depends(get_current_user),
+                                  user_profile_repo: UserProfileRepository = Depends(get_read_user_profile_repository)):
+    """
+    Retrieve several user profiles by ID with a single query.
+
+    Args:
+        request (BatchGetRequest): The IDs to look up (at most 500).
+
+    Returns:
+        List[ProfileLookup]: One result per requested ID, in request order, marking missing and deleted profiles.
+    """
+    profiles = await user_profile_repo.get_many(request.ids)  # One WHERE id = ANY($1) query
+    results = []
+    for user_id in request.ids:
+        profile = profiles.get(user_id)
+        if profile is None:
+            results.append(ProfileLookup(id=user_id, status=LookupStatus.MISSING))
+        elif profile.is_deleted:
+            results.append(ProfileLookup(id=user_id, status=LookupStatus.DELETED))  # Hidden, like the single lookup
+        else:
+            results.append(ProfileLookup(id=user_id, status=LookupStatus.FOUND, profile=profile))
+    return results
+
 @router.put("/users/{user_id}/profile/", response_model=UserProfile, tags=["User Profile"])
-async def update_user_profile(user_id: str, profile: UserProfileCreate, current_user: User = Depends(get_current_user)):
+async def update_user_profile(user_id: str, profile: UserProfileCreate, current_user: User = Depends(get_current_user),
+                              unit_of_work: UnitOfWork = Depends(get_unit_of_work)):
     """
     Update an existing user profile.
 
@@ -142,49 +206,65 @@ async def update_user_profile(user_id: str, profile: UserProfileCreate, current_
     Returns:
         UserProfile: The updated user profile.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    user_profile_repo = UserProfileRepository(connection)  # Create an instance of the user profile repository
-    
-    updated_profile = await user_profile_repo.update(UserProfile(
+    return await unit_of_work.user_profiles.update(UserProfile(
         id=user_id,
         name=profile.name,
         email=profile.email,
         is_deleted=False  # Assuming the profile is not deleted
     ))
 
-    await connection.close()  # Close the connection after use
-    return updated_profile
-
 @router.delete("/users/{user_id}/profile/", status_code=status.HTTP_204_NO_CONTENT, tags=["User Profile"])
-async def delete_user_profile(user_id: str, current_user: User = Depends(get_current_user)):
+async def delete_user_profile(user_id: str, current_user: User = Depends(get_current_user),
+                              unit_of_work: UnitOfWork = Depends(get_unit_of_work)):
     """
     Delete a user profile by its ID.
 
     Args:
         user_id (str): The ID of the user profile to delete.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    user_profile_repo = UserProfileRepository(connection)  # Create an instance of the user profile repository
-    
-    await user_profile_repo.delete(user_id)  # The delete method already logs the audit event
+    await unit_of_work.user_profiles.delete(user_id)  # The delete method already logs the audit event
 
-    await connection.close()  # Close the connection after use
+@router.get("/users/profiles/active/", response_model=List[ProfileListItem], response_model_exclude_unset=True, tags=["User Profile"])
+async def get_active_user_profiles(response: Response, include: List[str] = Query([]),
+                                   limit: Optional[int] = Query(None, ge=1, le=1000), cursor: Optional[str] = None,
+                                   current_user: User = Depends(get_current_user),
+                                   user_profile_repo: UserProfileRepository = Depends(get_read_user_profile_repository)):
+    """
+    Retrieve all active user profiles, ordered by ID (creation order).
 
-@router.get("/users/profiles/active/", response_model=List[UserProfile], tags=["User Profile"])
-async def get_active_user_profiles(current_user: User = Depends(get_current_user)):
+    Args:
+        include (List[str]): Activity to embed in every profile, comma separated: "last_event" and/or "event_count".
+        limit (int): Page size; without it every active profile is returned.
+        cursor (str): The X-Next-Cursor header of the previous page.
+
+    Returns:
+        List[ProfileListItem]: The active user profiles; the X-Next-Cursor header is set when there is a next page.
     """
-    Retrieve all active user profiles.
+    return await _list_profiles(user_profile_repo, response, True, include, limit, cursor)
+
+@router.get("/users/profiles/changes/", response_model=ProfileChangePage, tags=["User Profile"])
+async def get_user_profile_changes(since: Optional[str] = None, limit: int = Query(1000, ge=1, le=5000),
+                                   current_user: User = Depends(get_current_user),
+                                   user_profile_repo: UserProfileRepository = Depends(get_read_user_profile_repository)):
+    """
+    Retrieve the profiles changed since a previous call, for services that keep a copy of the profiles.
+
+    Every change of a profile (creation, update, deletion, restoration, rollback, import) moves it to the
+    end of the feed, with its current state. Deleted profiles are returned as tombstones: soft deleted
+    ones with is_deleted set, purged ones with purged set and only their ID. Changes of transactions
+    that are still running are held back until they all ended, so no change is ever skipped.
+
+    Args:
+        since (str): The cursor of the previous call; omit it for a full sync.
+        limit (int): Maximum number of changes to return.
 
     Returns:
-        List[UserProfile]: A list of active user profiles.
+        ProfileChangePage: The changes in order, the cursor to pass next time and whether more changes are available.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    user_profile_repo = UserProfileRepository(connection)  # Create an instance of the user profile repository
-    
-    active_profiles = await user_profile_repo.get_all_active()  # Fetch all active user profiles from the database
-    
-    await connection.close()  # Close the connection after use
-    return active_profiles
+    try:
+        return await user_profile_repo.get_changes(after=decode_change_cursor(since) if since else None, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 # ===========================
@@ -192,23 +272,38 @@ async def get_active_user_profiles(current_user: User = Depends(get_current_user
 # ===========================
 
 @router.get("/audit/events/", response_model=List[AuditEvent], tags=["Audit Event"])
-async def get_audit_events(current_user: User = Depends(get_current_user)):
+async def get_audit_events(current_user: User = Depends(get_current_user),
+                           audit_event_repo: AuditEventRepository = Depends(get_read_audit_event_repository)):
     """
     Retrieve all audit events.
 
     Returns:
         List[AuditEvent]: A list of all audit events.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    audit_event_repo = AuditEventRepository(connection)  # Create an instance of the audit event repository
-    
-    rows = await audit_event_repo.get_all()  # Fetch all audit events from the database
-    await connection.close()  # Close the connection after use
-    
-    return rows
+    return await audit_event_repo.get_all()  # Fetch all audit events from the database
+
+@router.post("/audit/events/batch/", response_model=List[AuditEventLookup], tags=["Audit Event"])
+async def get_audit_events_batch(request: BatchGetRequest, current_user: User = Depends(get_current_user),
+                                 audit_event_repo: AuditEventRepository = Depends(get_read_audit_event_repository)):
+    """
+    Retrieve several audit events by ID with a single query.
+
+    Args:
+        request (BatchGetRequest): The IDs to look up (at most 500).
+
+    Returns:
+        List[AuditEventLookup]: One result per requested ID, in request order, marking missing events.
+    """
+    events = await audit_event_repo.get_many(request.ids)  # One WHERE id = ANY($1) query
+    return [
+        AuditEventLookup(id=event_id, status=LookupStatus.FOUND, event=events[event_id]) if event_id in events
+        else AuditEventLookup(id=event_id, status=LookupStatus.MISSING)
+        for event_id in request.ids
+    ]
 
 @router.get("/audit/events/{user_id}", response_model=List[AuditEvent], tags=["Audit Event"])
-async def get_user_audit_events(user_id: str, current_user: User = Depends(get_current_user)):
+async def get_user_audit_events(user_id: str, current_user: User = Depends(get_current_user),
+                                audit_event_repo: AuditEventRepository = Depends(get_read_audit_event_repository)):
     """
     Retrieve all audit events associated with a specific user ID.
 
@@ -218,16 +313,82 @@ async def get_user_audit_events(user_id: str, current_user: User = Depends(get_c
     Returns:
         List[AuditEvent]: A list of audit events related to the user.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    audit_event_repo = AuditEventRepository(connection)  # Create an instance of the audit event repository
-    
-    rows = await audit_event_repo.get_by_user_id(user_id)  # Fetch audit events for the user
-    await connection.close()  # Close the connection after use
-    
-    return rows
+    return await audit_event_repo.get_by_user_id(user_id)  # Fetch audit events for the user
+
+@router.get("/audit/events/{user_id}/history", response_model=AuditHistory, tags=["Audit Event"])
+async def get_user_audit_history(user_id: str, current_user: User = Depends(get_current_user),
+                                 audit_event_repo: AuditEventRepository = Depends(get_read_audit_event_repository)):
+    """
+    Retrieve a user's audit history as its compaction checkpoint followed by the events after it.
+
+    Args:
+        user_id (str): The ID of the user whose history should be retrieved.
+
+    Returns:
+        AuditHistory: The checkpoint (null if the history was never compacted) and the recent events.
+    """
+    return await audit_event_repo.get_history(user_id)  # Archived events are summarized by the checkpoint
+
+@router.get("/audit/analytics/", response_model=AuditAnalytics, tags=["Audit Event"])
+async def get_audit_analytics(bucket_size: AuditBucketSize = AuditBucketSize.HOUR, start: Optional[datetime] = None,
+                              end: Optional[datetime] = None, group_by: List[str] = Query(list(analytics.GROUP_COLUMNS)),
+                              current_user: User = Depends(get_current_user),
+                              audit_event_repo: AuditEventRepository = Depends(get_read_audit_event_repository)):
+    """
+    Count audit events per hour or day, grouped by action and/or resource.
+
+    Args:
+        bucket_size (AuditBucketSize): Size of the time buckets.
+        start (datetime): Start of the range; defaults to the last 24 hours or 30 days.
+        end (datetime): End of the range; defaults to now.
+        group_by (List[str]): Columns to group by ("action", "resource"); repeat the parameter for both.
+
+    Returns:
+        AuditAnalytics: The counts per bucket; buckets that already ended are served from a cache.
+    """
+    try:
+        return await analytics.bucketed_counts(audit_event_repo, bucket_size.value, start, end, group_by)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/audit/changes/", response_model=AuditEventPage, tags=["Audit Event"])
+async def get_field_changes(field: str = Query(..., min_length=1, max_length=255), old: Optional[str] = None,
+                            new: Optional[str] = None, value: Optional[str] = None, start: Optional[datetime] = None,
+                            end: Optional[datetime] = None, cursor: Optional[str] = None,
+                            limit: int = Query(100, ge=1, le=500), current_user: User = Depends(get_current_user),
+                            audit_event_repo: AuditEventRepository = Depends(get_read_audit_event_repository)):
+    """
+    Find the audit events that touched a field, e.g. every event that changed "email", or every event
+    where "email" was a given value before or after it.
+
+    Args:
+        field (str): The name of the field.
+        old (str): Only events whose old value of the field was this.
+        new (str): Only events whose new value of the field was this.
+        value (str): Only events where the field had this value, before or after the event.
+            Without any value filter, only events where the field actually changed are returned.
+        start (datetime): Only events at or after this time.
+        end (datetime): Only events before this time.
+        cursor (str): The next_cursor of the previous page.
+        limit (int): Maximum number of events per page.
+
+    Returns:
+        AuditEventPage: The matching events, newest first, and the cursor of the next page.
+    """
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    start, end = (analytics.naive_local(bound) if bound else None for bound in (start, end))  # Stored timestamps are naive
+    events = await audit_event_repo.find_field_changes(field, old=old, new=new, value=value, start=start, end=end,
+                                                       after=after, limit=limit + 1)  # One extra row tells if there is a next page
+    next_cursor = encode_cursor(events[limit - 1].timestamp, events[limit - 1].id) if len(events) > limit else None
+    return AuditEventPage(events=events[:limit], next_cursor=next_cursor)
 
 @router.post("/audit/events/rollback/{audit_event_id}", status_code=status.HTTP_200_OK, tags=["Audit Event"])
-async def rollback_user_profile(audit_event_id: str, current_user: User = Depends(get_current_user)):
+async def rollback_user_profile(audit_event_id: str, current_user: User = Depends(get_current_user),
+                                unit_of_work: UnitOfWork = Depends(get_unit_of_work)):
     """
     Rollback a user profile to a previous state based on an audit event ID and create a new rollback audit event.
 
@@ -237,20 +398,53 @@ async def rollback_user_profile(audit_event_id: str, current_user: User = Depend
     Returns:
         dict: A message indicating the rollback was successful.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    user_profile_repo = UserProfileRepository(connection)  # Create an instance of the user profile repository
-
     try:
-        await user_profile_repo.rollback_changes_by_event_id(audit_event_id)  # Rollback changes based on the audit event ID
+        await unit_of_work.user_profiles.rollback_changes_by_event_id(audit_event_id)  # Rollback changes based on the audit event ID
+    except asyncpg.QueryCanceledError:
+        raise  # Past the request's deadline: answered with 504 by DeadlineMiddleware
     except Exception as e:
-        await connection.close()  # Close the connection in case of an error
         raise HTTPException(status_code=400, detail=str(e))
 
-    await connection.close()  # Close the connection after use
     return {"message": "Rollback successful"}
 
+@router.post("/audit/verify/", response_model=VerificationRun, status_code=status.HTTP_202_ACCEPTED, tags=["Audit Event"])
+async def start_audit_chain_verification(full: bool = False, current_user: User = Depends(get_current_active_user),
+                                         audit_event_repo: AuditEventRepository = Depends(get_audit_event_repository)):
+    """
+    Start a verification of the tamper-evident hash chains of the audit events of all users, in the background.
+
+    Args:
+        full (bool): Verify every event again instead of resuming from the last verified checkpoints.
+
+    Returns:
+        VerificationRun: The report of the new run; poll GET /audit/verify/{run_id} for its summary.
+    """
+    run = verify_job.new_verification_run(full)
+    await audit_event_repo.save_verification_run(run)  # Visible to GET before the verification ends
+    verify_job.start_in_background(run)  # Runs the verification in a process pool, outside the request's deadline
+    return run
+
+@router.get("/audit/verify/{run_id}", response_model=VerificationRun, tags=["Audit Event"])
+async def get_audit_chain_verification(run_id: str, current_user: User = Depends(get_current_active_user),
+                                       audit_event_repo: AuditEventRepository = Depends(get_audit_event_repository)):
+    """
+    Retrieve the report of a verification run.
+
+    Args:
+        run_id (str): The ID of the verification run.
+
+    Returns:
+        VerificationRun: Status of the run and, once completed, the number of verified events and users and
+            the events whose chain is broken.
+    """
+    run = await audit_event_repo.get_verification_run(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Verification run not found")
+    return run
+
 @router.post("/users/{user_id}/profile/restore/", response_model=UserProfile, tags=["User Profile"])
-async def restore_user_profile(user_id: str, current_user: User = Depends(get_current_user)):
+async def restore_user_profile(user_id: str, current_user: User = Depends(get_current_user),
+                               unit_of_work: UnitOfWork = Depends(get_unit_of_work)):
     """
     Restore a deleted user profile.
 
@@ -260,19 +454,156 @@ async def restore_user_profile(user_id: str, current_user: User = Depends(get_cu
     Returns:
         UserProfile: The restored user profile.
     """
-    connection = await connect_to_db()  # Establish a database connection
-    user_profile_repo = UserProfileRepository(connection)  # Create an instance of the user profile repository
-
-    user_profile = await user_profile_repo.get_by_id(user_id)  # Fetch the user profile by ID
+    user_profile = await unit_of_work.user_profiles.get_by_id(user_id)  # Fetch the user profile by ID
     if user_profile is None:
-        await connection.close()  # Close the connection if user not found
         raise HTTPException(status_code=404, detail="User not found")
 
     if not user_profile.is_deleted:
-        await connection.close()  # Close the connection if user is not deleted
         raise HTTPException(status_code=400, detail="User is not deleted")
 
-    updated_profile = await user_profile_repo.restore(user_profile.id)  # Restore the user profile
+    return await unit_of_work.user_profiles.restore(user_profile.id)  # Restore the user profile
+
+
+# ===========================
+# Administration
+# ===========================
 
-    await connection.close()  # Close the connection after use
-    return updated_profile
\ No newline at end of file
+@router.post("/admin/purge/", response_model=PurgeRun, status_code=status.HTTP_202_ACCEPTED, tags=["Administration"])
+async def start_purge(request: PurgeRequest, current_user: User = Depends(get_current_active_user),
+                      user_profile_repo: UserProfileRepository = Depends(get_user_profile_repository)):
+    """
+    Start hard deleting the profiles soft deleted before a cutoff, in the background.
+
+    Args:
+        request (PurgeRequest): Age of the profiles to purge and chunk size.
+
+    Returns:
+        PurgeRun: The progress report of the new run; poll GET /admin/purge/{run_id} to follow it.
+    """
+    run = purge_job.new_purge_run(request.older_than_days, request.chunk_size)
+    await user_profile_repo.save_purge_run(run)  # Visible to GET before the first chunk is purged
+    purge_job.start_in_background(run)
+    return run
+
+@router.get("/admin/purge/{run_id}", response_model=PurgeRun, tags=["Administration"])
+async def get_purge_run(run_id: str, current_user: User = Depends(get_current_active_user),
+                        user_profile_repo: UserProfileRepository = Depends(get_user_profile_repository)):
+    """
+    Retrieve the progress report of a purge run.
+
+    Args:
+        run_id (str): The ID of the purge run.
+
+    Returns:
+        PurgeRun: Profiles purged so far, keyset cursor, status and whether the run can be resumed.
+    """
+    run = await user_profile_repo.get_purge_run(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Purge run not found")
+    return run
+
+@router.post("/admin/purge/{run_id}/resume", response_model=PurgeRun, status_code=status.HTTP_202_ACCEPTED, tags=["Administration"])
+async def resume_purge_run(run_id: str, current_user: User = Depends(get_current_active_user),
+                           user_profile_repo: UserProfileRepository = Depends(get_user_profile_repository)):
+    """
+    Resume an interrupted or failed purge run from its cursor, in the background.
+
+    Args:
+        run_id (str): The ID of the purge run.
+
+    Returns:
+        PurgeRun: The progress report of the resumed run.
+    """
+    run = await user_profile_repo.get_purge_run(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Purge run not found")
+    if not run.resumable or purge_job.is_running(run_id):
+        raise HTTPException(status_code=409, detail="Purge run is completed or still running")
+
+    purge_job.start_in_background(run)
+    return run
+
+@router.post("/admin/import/profiles/", response_model=ProfileImport, tags=["Administration"])
+async def import_user_profiles(file: UploadFile = File(..., description="CSV file with a name,email header"),
+                               current_user: User = Depends(get_current_active_user),
+                               user_profile_repo: UserProfileRepository = Depends(get_user_profile_repository)):
+    """
+    Bulk import user profiles from a CSV file, streamed in chunks into a staging table.
+
+    Args:
+        file (UploadFile): The CSV file.
+
+    Returns:
+        ProfileImport: Rows imported and rejected, with the first rejected rows and why they were rejected.
+    """
+    report = import_job.new_profile_import(file.filename)  # Listed by GET /admin/import/profiles/ while it runs
+    try:
+        return await import_job.import_profiles(user_profile_repo, import_job.iter_upload(file), report)
+    except (ValueError, asyncpg.DataError) as e:
+        raise HTTPException(status_code=400, detail=f"Malformed import file: {e}")
+
+@router.get("/admin/import/profiles/", response_model=List[ProfileImport], tags=["Administration"])
+async def get_profile_imports(current_user: User = Depends(get_current_active_user)):
+    """
+    Retrieve the progress of the running and recent profile imports of this worker.
+
+    Returns:
+        List[ProfileImport]: The imports, newest first.
+    """
+    return import_job.recent_imports()
+
+@router.get("/admin/slow-queries/", response_model=List[SlowQuery], tags=["Administration"])
+async def get_slow_queries(limit: int = Query(50, ge=1, le=1000), current_user: User = Depends(get_current_active_user)):
+    """
+    Retrieve the most recent slow statements of this worker, with the plans captured for a sample of them.
+
+    Args:
+        limit (int): Maximum number of statements to return.
+
+    Returns:
+        List[SlowQuery]: The slow statements, newest first.
+    """
+    return query_log.recent(limit)
+
+@router.delete("/admin/slow-queries/", status_code=status.HTTP_204_NO_CONTENT, tags=["Administration"])
+async def clear_slow_queries(current_user: User = Depends(get_current_active_user)):
+    """
+    Empty the slow query ring of this worker.
+    """
+    query_log.clear()
+
+@router.get("/admin/profiling/", response_model=List[RequestProfile], tags=["Administration"])
+async def get_request_profiles(limit: int = Query(50, ge=1, le=1000), current_user: User = Depends(get_current_active_user)):
+    """
+    Retrieve the most recent request profiles captured by this worker.
+
+    Args:
+        limit (int): Maximum number of profiles to return.
+
+    Returns:
+        List[RequestProfile]: The profiles, newest first, without their stacks.
+    """
+    return profiling.recent(limit)
+
+@router.get("/admin/profiling/{profile_id}", response_class=PlainTextResponse, tags=["Administration"])
+async def get_request_profile_stacks(profile_id: str, current_user: User = Depends(get_current_active_user)):
+    """
+    Retrieve the sampled stacks of a request profile, in the folded format read by flamegraph.pl and speedscope.
+
+    Args:
+        profile_id (str): The ID of the profile (X-Profile-Id header of the profiled response).
+
+    Returns:
+        str: One "frame;frame;frame count" line per distinct stack.
+    """
+    stored = profiling.get(profile_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return stored[1]
+
+@router.delete("/admin/profiling/", status_code=status.HTTP_204_NO_CONTENT, tags=["Administration"])
+async def clear_request_profiles(current_user: User = Depends(get_current_active_user)):
+    """
+    Remove the stored request profiles of this worker.
+    """
+    profiling.clear()
@@ -0,0 +1,93 @@
+import hashlib
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+# Tamper-evident hash chain over audit events.
+#
+# Every event stores its position in the user's history (chain_index, starting at 1), the hash of the
+# previous event of the same user (prev_hash) and its own hash:
+#
+#     hash = sha256(prev_hash + canonical JSON of the event's content)
+#
+# Editing, deleting or reordering any stored event breaks the chain from that point on.
+
+GENESIS_HASH = "0" * 64  # prev_hash of the first event of every user
+
+# Fields covered by the hash, in the order they appear in verification rows
+HASHED_FIELDS = ("id", "user_id", "chain_index", "action", "timestamp", "resource", "details", "changes")
+
+
+def compute_event_hash(prev_hash: str, event: dict) -> str:
+    """
+    Computes the chained hash of an audit event.
+
+    Args:
+        prev_hash (str): Hash of the previous event of the same user (GENESIS_HASH for the first one).
+        event (dict): The event content; must contain every field in HASHED_FIELDS.
+            "changes" is the decoded dictionary (or None), "timestamp" a datetime.
+
+    Returns:
+        str: The hex encoded SHA-256 hash.
+    """
+    content = {field: event[field] for field in HASHED_FIELDS}
+    timestamp = content["timestamp"]
+    content["timestamp"] = timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp
+    payload = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256((prev_hash + payload).encode("utf-8")).hexdigest()
+
+
+def verify_segments(segments: List[Tuple[str, int, str, list]]) -> List[Tuple[str, int, int, str, List[Tuple[str, str]]]]:
+    """
+    Verifies contiguous pieces of user chains. Runs inside worker processes, so it only takes
+    and returns plain picklable data.
+
+    Args:
+        segments (list): (user_id, start_index, start_hash, rows) tuples, where start_index/start_hash
+            describe the last already verified event (0 and GENESIS_HASH for a full check) and each row is
+            (id, chain_index, action, timestamp, resource, details, changes_json, prev_hash, hash).
+
+    Returns:
+        list: (user_id, verified, last_index, last_hash, errors) per segment, where verified is the number of
+            events verified before the first error, last_index/last_hash describe the last of them and
+            errors holds (event_id, reason) pairs.
+    """
+    results = []
+    for user_id, start_index, start_hash, rows in segments:
+        expected_index, expected_prev = start_index + 1, start_hash
+        last_index, last_hash = start_index, start_hash
+        errors = []
+        for event_id, chain_index, action, timestamp, resource, details, changes_json, prev_hash, stored_hash in rows:
+            if chain_index != expected_index:
+                errors.append((event_id, f"expected chain index {expected_index}, found {chain_index}"))
+            elif prev_hash != expected_prev:
+                errors.append((event_id, "previous hash does not match the preceding event"))
+            else:
+                changes = json.loads(changes_json) if isinstance(changes_json, str) else changes_json
+                computed = compute_event_hash(expected_prev, {
+                    "id": event_id, "user_id": user_id, "chain_index": chain_index, "action": action,
+                    "timestamp": timestamp, "resource": resource, "details": details, "changes": changes,
+                })
+                if computed != stored_hash:
+                    errors.append((event_id, "event content does not match its hash"))
+            if errors:
+                break  # Everything after the first broken link is unverifiable
+            last_index, last_hash = chain_index, stored_hash
+            expected_index, expected_prev = chain_index + 1, stored_hash
+        results.append((user_id, last_index - start_index, last_index, last_hash, errors))
+    return results
+
+
+def next_link(last: Optional[Tuple[int, str]]) -> Tuple[int, str]:
+    """
+    Returns the chain index and prev_hash for the event following `last`.
+
+    Args:
+        last (tuple): (chain_index, hash) of the user's latest event, or None if the user has no chained events.
+
+    Returns:
+        tuple: (chain_index, prev_hash) for the new event.
+    """
+    if last is None:
+        return 1, GENESIS_HASH
+    return last[0] + 1, last[1]
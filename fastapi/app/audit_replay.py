@@ -0,0 +1,104 @@
+import json
+from typing import Iterable, List, Optional, Tuple
+from app.models.audit_event import AuditEventAction
+
+# Rebuilds the state of a user profile from its audit trail.
+#
+# The semantics follow UserProfileRepository: every event records {"field": {"old": ..., "new": ...}}
+# for the fields it wrote, deletions only flip the soft delete flag (their "new" values are None),
+# and restores (including rolled back deletions) clear it again.
+
+PROFILE_FIELDS = ("name", "email")
+
+# Reasons a stored profile doesn't match its audit trail (see replay_segments)
+PROFILE_MISSING = "profile missing"  # Events (or a checkpoint) but no profile row, and no purge tombstone
+HISTORY_MISSING = "no audit history"  # A profile row without any event or checkpoint
+PROFILE_DIFFERS = "profile differs from its history"
+
+
+def empty_state() -> dict:
+    """Returns the state of a profile before its first event."""
+    return {"name": None, "email": None, "is_deleted": False}
+
+
+def apply_event(state: dict, action, changes: Optional[dict]) -> dict:
+    """
+    Applies one audit event to a profile state, in place.
+
+    Args:
+        state (dict): The profile state ("name", "email", "is_deleted").
+        action (AuditEventAction | str): The action of the event.
+        changes (dict): The changes recorded by the event.
+
+    Returns:
+        dict: The updated state.
+    """
+    action = AuditEventAction(action)
+    if action == AuditEventAction.DELETE_PROFILE:
+        state["is_deleted"] = True
+        return state
+
+    for field, change in (changes or {}).items():
+        if field in PROFILE_FIELDS and change.get("new") is not None:
+            state[field] = change["new"]
+    if action in (AuditEventAction.CREATE_PROFILE, AuditEventAction.RESTORE_PROFILE, AuditEventAction.ROLLBACK_DELETE):
+        state["is_deleted"] = False
+    return state
+
+
+def replay(events: Iterable[Tuple[str, Optional[dict]]], state: Optional[dict] = None) -> dict:
+    """
+    Replays a sequence of audit events, oldest first.
+
+    Args:
+        events (iterable): (action, changes) pairs.
+        state (dict): State to start from (e.g. a compaction checkpoint); empty by default.
+
+    Returns:
+        dict: The resulting profile state.
+    """
+    state = dict(state) if state else empty_state()
+    for action, changes in events:
+        apply_event(state, action, changes)
+    return state
+
+
+def replay_segments(segments: List[Tuple[str, Optional[dict], list]]) -> List[Tuple[str, str, Optional[dict], object, Optional[int]]]:
+    """
+    Replays the histories of several users and compares the results with their stored profiles.
+
+    Runs in the worker processes of app.jobs.replay_profiles, so it only takes and returns plain data.
+
+    Args:
+        segments (list): (user_id, stored, events) per user. stored holds the profile row ("has_profile", "name",
+            "email", "is_deleted", "change_seq"), whether it was purged ("purged") and the compaction checkpoint ("state" as
+            JSON text, "up_to"), or is None when the user has none of them. events are the user's live
+            (action, timestamp, changes as JSON text) rows, oldest first.
+
+    Returns:
+        list: (user_id, reason, expected state, deleted_at, change_seq) for every user whose profile doesn't
+            match its history; deleted_at is when the replayed profile was last deleted (None while it is
+            active) and change_seq that of the stored profile row (None without one), for the compare-and-set
+            of a rebuild.
+    """
+    mismatches = []
+    for user_id, stored, events in segments:
+        checkpoint = json.loads(stored["state"]) if stored and stored["state"] else None
+        if checkpoint is None and not events:
+            mismatches.append((user_id, HISTORY_MISSING, None, None, None))
+            continue
+
+        state = replay(((action, json.loads(changes) if changes else None) for action, _, changes in events), state=checkpoint)
+        deleted_at = None
+        if state["is_deleted"]:
+            deleted_at = next(
+                (timestamp for action, timestamp, _ in reversed(events) if action == AuditEventAction.DELETE_PROFILE),
+                stored["up_to"] if stored else None  # Deleted before the checkpoint
+            )
+
+        if stored is None or not stored["has_profile"]:
+            if not (stored and stored["purged"]):  # Purged profiles keep their history
+                mismatches.append((user_id, PROFILE_MISSING, state, deleted_at, None))
+        elif (stored["name"], stored["email"], stored["is_deleted"]) != (state["name"], state["email"], state["is_deleted"]):
+            mismatches.append((user_id, PROFILE_DIFFERS, state, deleted_at, stored["change_seq"]))
+    return mismatches
@@ -1,23 +1,345 @@
+import asyncio
+import logging
+import os
+import itertools
+import time
+from pathlib import Path
+from typing import Dict, Optional
 import asyncpg
+from asyncpg.pool import PoolConnectionProxy
 from fastapi import FastAPI
+from app import ids, query_log
+
+logger = logging.getLogger(__name__)
 
 # Database connection URL
-DATABASE_URL = "postgresql://admin:admin@db/audit_db"  # Use the service name 'db'
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://admin:admin@db/audit_db")  # Use the service name 'db'
+
+# Read replicas (comma separated DSNs). GET endpoints read from them; writes always go to DATABASE_URL.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+
+# Shards (comma separated DSNs). When several are listed, profiles and audit events are spread over them by
+# user id (see app/sharding.py) and the API uses them instead of DATABASE_URL and the replicas.
+DATABASE_SHARD_URLS = [url.strip() for url in os.getenv("DATABASE_SHARD_URLS", "").split(",") if url.strip()]
+
+# Storage backend used by the API: "postgres" (default) or "memory" (tests, local load generation)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+
+# Connection pool sizing. The maximum should cover the admission control budgets
+# (see app/middleware/admission.py), since every admitted request holds one connection.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "10"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "52"))
+
+# How long startup keeps retrying while the database container is still booting
+DB_STARTUP_TIMEOUT = float(os.getenv("DB_STARTUP_TIMEOUT", "30"))
+
+# Schema applied at startup. postgres/init.sql is idempotent (CREATE ... IF NOT EXISTS)
+SCHEMA_PATH = Path(os.getenv("SCHEMA_PATH", Path(__file__).resolve().parents[2] / "postgres" / "init.sql"))
+SCHEMA_LOCK_ID = 72_617_001  # Advisory lock key, so concurrent workers don't apply the schema at the same time
+
+# Id that can never belong to a real row, used to warm up statements without touching data
+WARMUP_ID = "00000000-0000-0000-0000-000000000000"
+
+_pool = None  # Connection pool, created by init_db() during application startup
+_replica_pools = []  # One pool per replica, in the order of DATABASE_REPLICA_URLS
+_shard_pools = []  # One pool per shard, in the order of DATABASE_SHARD_URLS
+_replica_cursor = itertools.count()  # Round-robin position over the replicas
+_pool_by_connection: Dict[int, asyncpg.Pool] = {}  # Pool each acquired connection must be released to
+
+
+def parse_lsn(lsn: str) -> int:
+    """
+    Converts a textual WAL position ("16/B374D848") into a comparable integer.
+
+    Args:
+        lsn (str): The LSN as returned by pg_current_wal_lsn()::text.
 
-async def connect_to_db():
+    Returns:
+        int: The LSN as a 64-bit integer.
+    """
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+async def _acquire(pool):
+    """Acquires a pooled connection, remembering which pool it belongs to."""
+    connection = await pool.acquire()
+    _pool_by_connection[id(connection)] = pool
+    return connection
+
+
+async def connect_to_db(readonly: bool = False, min_lsn: Optional[str] = None):
     """
     Establish a connection to the PostgreSQL database.
 
+    Connections are taken from the pool once init_db() has run; before that (e.g. in scripts
+    and tests that don't run the application lifespan) a dedicated connection is opened.
+
+    Args:
+        readonly (bool): Whether the connection is only used for reads and may go to a replica.
+        min_lsn (str): WAL position of the client's last write. A replica is only used once it has
+            replayed up to this position (read-your-writes); otherwise the primary serves the read.
+
     Returns:
         asyncpg.Connection: A connection object to interact with the database.
     """
-    return await asyncpg.connect(DATABASE_URL)
+    if readonly and DATABASE_REPLICA_URLS:
+        connection = await _connect_to_replica(min_lsn)
+        if connection is not None:
+            return connection
+    if _pool is not None:
+        return await _acquire(_pool)
+    return await _connect(DATABASE_URL)
+
+
+async def connect_to_shard(index: int):
+    """
+    Establish a connection to one shard (see app/sharding.py), from its pool once init_db() has run.
+
+    Args:
+        index (int): The index of the shard in DATABASE_SHARD_URLS.
+
+    Returns:
+        asyncpg.Connection: A connection to the shard's database.
+    """
+    if _shard_pools:
+        return await _acquire(_shard_pools[index])
+    return await _connect(DATABASE_SHARD_URLS[index])
+
+
+async def _connect(dsn: str):
+    """Opens a dedicated connection, set up like the pooled ones."""
+    connection = await asyncpg.connect(dsn)
+    query_log.install(connection)
+    await register_codecs(connection)
+    return connection
+
+
+async def register_codecs(connection):
+    """
+    Exchanges uuid columns (profile and audit event ids) as strings, the type the models and the API use.
+
+    Args:
+        connection (asyncpg.Connection): The connection to set up.
+    """
+    await connection.set_type_codec("uuid", schema="pg_catalog", encoder=ids.encode, decoder=ids.decode, format="binary")
+
+
+async def _connect_to_replica(min_lsn: Optional[str]):
+    """
+    Returns a connection to the next replica that has caught up with min_lsn, or None if there is none.
+
+    Args:
+        min_lsn (str): WAL position the replica must have replayed, or None if any replica will do.
+    """
+    start = next(_replica_cursor)
+    for offset in range(len(DATABASE_REPLICA_URLS)):
+        position = (start + offset) % len(DATABASE_REPLICA_URLS)
+        try:
+            if _replica_pools:
+                connection = await _acquire(_replica_pools[position])
+            else:
+                connection = await _connect(DATABASE_REPLICA_URLS[position])
+        except (OSError, asyncpg.PostgresError):
+            continue  # A replica that is down must not fail reads
+
+        try:
+            if min_lsn is None or await _has_replayed(connection, min_lsn):
+                return connection
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            pass  # The replica failed or went away since the connection was opened: try the next one
+        await _discard(connection)  # Lagging behind the client's last write, or broken
+    return None
+
+
+async def _discard(connection):
+    """Gives back a replica connection that won't be used, even if the replica broke it."""
+    try:
+        await close_db_connection(connection)
+    except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+        if not isinstance(connection, PoolConnectionProxy):
+            connection.terminate()  # A pool terminates a connection it can't reset itself
+
+
+async def _has_replayed(connection, min_lsn: str) -> bool:
+    """
+    Checks whether a replica has replayed the WAL up to the given position.
+
+    Args:
+        connection (asyncpg.Connection): Connection to the replica.
+        min_lsn (str): The required WAL position.
+
+    Returns:
+        bool: True if the replica is at or past min_lsn. An instance that isn't replaying WAL
+            (not a standby) can't prove it has the write, so it counts as lagging.
+    """
+    try:
+        replayed = await connection.fetchval("SELECT pg_last_wal_replay_lsn()::text")
+        return replayed is not None and parse_lsn(replayed) >= parse_lsn(min_lsn)
+    except ValueError:
+        return False  # Malformed LSN sent by the client
+
+
+async def current_lsn(connection) -> str:
+    """
+    Returns the current WAL position of the primary, which covers every write committed so far.
+
+    Args:
+        connection (asyncpg.Connection): Connection to the primary.
+
+    Returns:
+        str: The LSN, e.g. "16/B374D848".
+    """
+    return await connection.fetchval("SELECT pg_current_wal_lsn()::text")
+
+async def replication_lag(connection) -> float:
+    """
+    Returns how far the slowest streaming replica is behind the primary.
+
+    Args:
+        connection (asyncpg.Connection): Connection to the primary.
+
+    Returns:
+        float: The replay lag in seconds (0 without replicas).
+    """
+    return await connection.fetchval(
+        "SELECT COALESCE(EXTRACT(EPOCH FROM max(replay_lag)), 0)::float FROM pg_stat_replication"
+    )
 
 async def close_db_connection(connection):
     """
     Close the given database connection.
 
+    Pooled connections are released back to the pool instead of being closed.
+
     Args:
         connection (asyncpg.Connection): The connection object to be closed.
     """
-    await connection.close()
+    if isinstance(connection, PoolConnectionProxy):
+        await _pool_by_connection.pop(id(connection)).release(connection)
+    else:
+        await connection.close()
+
+
+async def _connect_with_retry(dsn: str = DATABASE_URL, timeout: float = DB_STARTUP_TIMEOUT):
+    """
+    Opens a connection, retrying until the database accepts connections or the timeout expires.
+
+    Args:
+        dsn (str): The database to connect to.
+        timeout (float): Maximum number of seconds to keep retrying.
+
+    Returns:
+        asyncpg.Connection: An open connection.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    while True:
+        try:
+            return await asyncpg.connect(dsn)
+        except (OSError, asyncpg.CannotConnectNowError):
+            if time.monotonic() + delay > deadline:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2.0)  # Exponential backoff while the database boots
+
+
+async def apply_schema(connection):
+    """
+    Applies postgres/init.sql if the schema is missing or outdated.
+
+    The script only contains idempotent statements, so it is always safe to run it again;
+    an advisory lock serializes workers that start at the same time.
+
+    Args:
+        connection (asyncpg.Connection): Connection used to apply the schema.
+    """
+    await connection.execute("SELECT pg_advisory_lock($1)", SCHEMA_LOCK_ID)
+    try:
+        await connection.execute(SCHEMA_PATH.read_text())
+    finally:
+        await connection.execute("SELECT pg_advisory_unlock($1)", SCHEMA_LOCK_ID)
+
+
+async def _warm_connection(connection):
+    """
+    Pool "init" callback: installs the slow query log and the uuid codec, and prepares the hot statements on
+    every new connection.
+
+    Running each statement once against an id that cannot exist stores it in asyncpg's
+    statement cache, so the first real request doesn't pay for parsing and planning.
+
+    Args:
+        connection (asyncpg.Connection): The newly opened pooled connection.
+    """
+    from app.repositories.audit_event_repository import HOT_STATEMENTS as AUDIT_EVENT_STATEMENTS
+    from app.repositories.user_profile_repository import HOT_STATEMENTS as USER_PROFILE_STATEMENTS
+
+    query_log.install(connection)
+    await register_codecs(connection)
+    for statement in (*USER_PROFILE_STATEMENTS, *AUDIT_EVENT_STATEMENTS):
+        await connection.fetch(statement, WARMUP_ID)
+
+
+async def init_db():
+    """
+    Startup phase of the database layer: waits for the database, applies the schema and
+    opens the connection pool with DB_POOL_MIN_SIZE warmed connections (one pool per shard when sharded).
+    """
+    global _pool, _replica_pools, _shard_pools
+    if STORAGE_BACKEND == "memory":
+        return  # Nothing to connect to
+
+    if len(DATABASE_SHARD_URLS) > 1:
+        for url in DATABASE_SHARD_URLS:
+            connection = await _connect_with_retry(url)
+            try:
+                await apply_schema(connection)
+            finally:
+                await connection.close()
+        _shard_pools = [
+            await asyncpg.create_pool(url, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, init=_warm_connection)
+            for url in DATABASE_SHARD_URLS
+        ]
+        return
+
+    connection = await _connect_with_retry()
+    try:
+        await apply_schema(connection)
+    finally:
+        await connection.close()
+
+    _pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        init=_warm_connection,  # Runs for the min_size connections opened now and any opened later
+    )
+    _replica_pools = [await _create_replica_pool(url) for url in DATABASE_REPLICA_URLS]
+
+
+async def _create_replica_pool(url: str):
+    """
+    Opens the pool of a replica. A replica that is down at startup must not stop the application: its pool
+    starts empty and connects on demand, and reads skip it (see _connect_to_replica) until it is back.
+
+    Args:
+        url (str): The replica's DSN.
+
+    Returns:
+        asyncpg.Pool: The replica's pool.
+    """
+    try:
+        return await asyncpg.create_pool(url, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, init=_warm_connection)
+    except (OSError, asyncpg.PostgresError) as e:
+        logger.warning("Replica %s is unavailable, reads go elsewhere until it is back: %s", url, e)
+        return await asyncpg.create_pool(url, min_size=0, max_size=DB_POOL_MAX_SIZE, init=_warm_connection)  # Connects nothing yet
+
+
+async def close_db():
+    """Shutdown phase of the database layer: closes the connection pools."""
+    global _pool, _replica_pools, _shard_pools
+    pools = ([_pool] if _pool is not None else []) + _replica_pools + _shard_pools
+    _pool, _replica_pools, _shard_pools = None, [], []
+    for pool in pools:
+        await pool.close()
@@ -0,0 +1,41 @@
+import asyncio
+from contextvars import ContextVar
+from typing import Optional
+
+# Request deadlines.
+#
+# DeadlineMiddleware (app/middleware/deadline.py) gives every API request a deadline, stored here for the
+# duration of the request. The connections the request's repositories use get it as their
+# statement_timeout, so Postgres itself stops a statement that would outlive the request; the middleware
+# cancels the handler (and with it the statement it is waiting for) when the deadline passes or the
+# client disconnects. Jobs and background tasks have no deadline.
+
+current_deadline: ContextVar[Optional[float]] = ContextVar("current_deadline", default=None)  # Event loop time, set by DeadlineMiddleware
+
+
+def remaining() -> Optional[float]:
+    """
+    Returns the time left before the deadline of the request being served.
+
+    Returns:
+        float: Seconds left (negative once the deadline has passed), or None outside of a request.
+    """
+    deadline = current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - asyncio.get_running_loop().time()
+
+
+async def apply_statement_timeout(connection):
+    """
+    Limits the statements of a request's connection to the time left before its deadline.
+
+    The setting lasts for the session; pooled connections are reset (RESET ALL) when they go back to the pool.
+
+    Args:
+        connection (asyncpg.Connection): The connection just acquired for the request.
+    """
+    left = remaining()
+    if left is None:
+        return
+    await connection.execute(f"SET statement_timeout = {max(int(left * 1000), 1)}")  # 0 would disable it
@@ -0,0 +1 @@
+# Este arquivo pode ficar vazio 
\ No newline at end of file
@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from app import database, sharding
+
+# One-off backfills of columns added to existing tables by postgres/init.sql.
+#
+# The schema only adds such columns (a catalog change, applied at every startup); filling them in for the
+# rows that already exist is left to this job, run once after upgrading. Each backfill walks the table in id
+# order and updates the rows still missing their value in small batches, one short transaction each, pausing
+# between batches, so it never holds a lock on the whole table nor scans it again for every batch. Columns
+# that must not stay NULL get a NOT VALID check from the schema, validated here once they are filled in
+# (which only blocks schema changes, not writes). Every backfill is idempotent: an interrupted run is simply
+# started again.
+#
+# Usage: python -m app.jobs.backfill_columns [--batch-size N] [--pause SECONDS]
+
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "1000"))  # Rows updated per transaction
+BACKFILL_PAUSE_SECONDS = float(os.getenv("BACKFILL_PAUSE_SECONDS", "0.05"))  # Pause between two batches
+
+# Next batch of profiles after an id ($2) that match a condition, the value they are given, the number of
+# rows updated and the last id of the batch (NULL once the end of the table is reached)
+BACKFILL_BATCH = """
+    WITH batch AS (
+        SELECT id FROM user_profiles WHERE {missing} AND id > $2 ORDER BY id LIMIT $1 FOR UPDATE
+    ), updated AS (
+        UPDATE user_profiles p SET {column} = {value} FROM batch WHERE p.id = batch.id RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM updated) AS rows, (SELECT id FROM batch ORDER BY id DESC LIMIT 1) AS last_id
+"""
+
+# Column -> statement updating the next batch of rows that still need it ($1: batch size, $2: last id)
+BACKFILLS = {
+    # Profiles deleted before deleted_at existed: their last deletion event, or now if it can't be found.
+    # The purge job only sees them once this has run.
+    "user_profiles.deleted_at": BACKFILL_BATCH.format(
+        missing="is_deleted AND deleted_at IS NULL",
+        column="deleted_at",
+        value="""COALESCE(
+            (SELECT max(e.timestamp) FROM audit_events_all e WHERE e.user_id = p.id AND e.action = 'DELETE_PROFILE'),
+            CURRENT_TIMESTAMP
+        )""",
+    ),
+    # Profiles written before change_seq existed: the backfilling transaction, so delta sync clients get them
+    "user_profiles.change_seq": BACKFILL_BATCH.format(missing="change_seq IS NULL", column="change_seq", value="DEFAULT"),
+}
+
+# Column -> NOT VALID check of postgres/init.sql that holds once the column is filled in
+CHECKS = {
+    "user_profiles.change_seq": "user_profiles_change_seq_not_null",
+}
+
+FIND_UNVALIDATED_CHECK = "SELECT 1 FROM pg_constraint WHERE conname = $1 AND conrelid = $2::regclass AND NOT convalidated"
+
+
+async def backfill(connection, statement: str, batch_size: int = BACKFILL_BATCH_SIZE,
+                   pause: float = BACKFILL_PAUSE_SECONDS) -> int:
+    """
+    Runs a backfill batch after batch until the end of the table.
+
+    Args:
+        connection (asyncpg.Connection): Connection used for the updates.
+        statement (str): One of BACKFILLS.
+        batch_size (int): Rows read per transaction.
+        pause (float): Seconds to pause between two batches.
+
+    Returns:
+        int: The number of rows updated.
+    """
+    updated, last_id = 0, database.WARMUP_ID  # Sorts before every generated id
+    while True:
+        batch = await connection.fetchrow(statement, batch_size, last_id)  # One short transaction per batch
+        updated += batch["rows"]
+        if batch["last_id"] is None:
+            return updated
+        last_id = batch["last_id"]
+        await asyncio.sleep(pause)
+
+
+async def validate_check(connection, column: str) -> bool:
+    """
+    Validates the NOT VALID check of a backfilled column, if it isn't validated yet.
+
+    Args:
+        connection (asyncpg.Connection): Connection used for the validation.
+        column (str): One of CHECKS.
+
+    Returns:
+        bool: Whether the check was validated by this call.
+    """
+    table = column.split(".")[0]
+    if not await connection.fetchval(FIND_UNVALIDATED_CHECK, CHECKS[column], table):
+        return False
+    await connection.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {CHECKS[column]}")  # Scans without blocking writes
+    return True
+
+
+async def backfill_columns(connection, batch_size: int = BACKFILL_BATCH_SIZE, pause: float = BACKFILL_PAUSE_SECONDS) -> dict:
+    """
+    Runs every backfill against one database.
+
+    Args:
+        connection (asyncpg.Connection): Connection used for the updates.
+        batch_size (int): Rows updated per transaction.
+        pause (float): Seconds to pause between two batches.
+
+    Returns:
+        dict: The rows updated per column and the checks validated.
+    """
+    started = time.perf_counter()
+    summary = {"rows_updated": {column: await backfill(connection, statement, batch_size, pause) for column, statement in BACKFILLS.items()}}
+    summary["checks_validated"] = [CHECKS[column] for column in CHECKS if await validate_check(connection, column)]
+    summary["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Fill in the columns added to existing tables, in batches.")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE, help="rows updated per transaction")
+    parser.add_argument("--pause", type=float, default=BACKFILL_PAUSE_SECONDS, help="seconds to pause between batches")
+    args = parser.parse_args()
+
+    shards = range(len(database.DATABASE_SHARD_URLS)) if sharding.is_sharded() else [None]
+    summaries = {}
+    for shard in shards:
+        connection = await (database.connect_to_db() if shard is None else database.connect_to_shard(shard))
+        try:
+            summaries["database" if shard is None else f"shard {shard}"] = await backfill_columns(connection, args.batch_size, args.pause)
+        finally:
+            await database.close_db_connection(connection)
+    print(json.dumps(summaries, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from app import database, sharding
+from app.repositories.audit_event_repository import AuditEventRepository
+
+# Background compaction of long audit histories.
+#
+# Users with more than COMPACTION_MAX_EVENTS live events, or with events older than
+# COMPACTION_MAX_AGE_DAYS, get their oldest events folded into a checkpoint holding the profile
+# state at that point (audit_checkpoints); the folded events move to audit_events_archive.
+# The newest COMPACTION_KEEP_EVENTS events of a user always stay live; at least one must, since a user's
+# next event is linked to their newest live one (an empty live chain would start again from genesis).
+#
+# Usage: python -m app.jobs.compact_audit_history [--max-events N] [--keep-events N] [--max-age-days N]
+# The API also runs it every COMPACTION_INTERVAL_SECONDS (disabled when 0), on every shard when sharded;
+# from the command line, run it on each shard with DATABASE_URL set to the shard.
+
+COMPACTION_MAX_EVENTS = int(os.getenv("COMPACTION_MAX_EVENTS", "1000"))
+COMPACTION_KEEP_EVENTS = int(os.getenv("COMPACTION_KEEP_EVENTS", "100"))
+COMPACTION_MAX_AGE_DAYS = int(os.getenv("COMPACTION_MAX_AGE_DAYS", "365"))
+COMPACTION_INTERVAL_SECONDS = float(os.getenv("COMPACTION_INTERVAL_SECONDS", "0"))
+COMPACTION_LOCK_ID = 72_617_002  # Only one worker compacts at a time
+
+logger = logging.getLogger(__name__)
+
+# Users with something to compact, with the chain index of their newest event and of their newest old event
+CANDIDATES_QUERY = """
+    SELECT user_id, count(*) AS live_events, max(chain_index) AS last_index,
+           max(chain_index) FILTER (WHERE timestamp < $2) AS last_old_index
+    FROM audit_events
+    GROUP BY user_id
+    HAVING count(*) > $1 OR min(timestamp) < $2
+"""
+
+
+def compaction_boundary(live_events: int, last_index: int, last_old_index, max_events: int, keep_events: int):
+    """
+    Returns the chain index up to which a user's history should be folded, or None.
+
+    Args:
+        live_events (int): Number of events of the user in audit_events.
+        last_index (int): Chain index of the user's newest event.
+        last_old_index (int): Chain index of the user's newest event older than the age limit, or None.
+        max_events (int): Event count above which the history is compacted.
+        keep_events (int): Number of newest events that always stay live.
+
+    Returns:
+        int: The boundary chain index, or None if nothing should be folded.
+    """
+    if last_index is None:
+        return None  # Only unsealed legacy events; they are sealed on the user's next write
+    newest_foldable = last_index - keep_events
+    boundary = newest_foldable if live_events > max_events else min(last_old_index or 0, newest_foldable)
+    return boundary if boundary > 0 else None
+
+
+async def compact_audit_history(connection, max_events: int = COMPACTION_MAX_EVENTS,
+                                keep_events: int = COMPACTION_KEEP_EVENTS,
+                                max_age_days: int = COMPACTION_MAX_AGE_DAYS) -> dict:
+    """
+    Compacts the histories of every user past the configured size or age.
+
+    Args:
+        connection (asyncpg.Connection): Connection used for the compaction.
+        max_events (int): Event count above which a history is compacted.
+        keep_events (int): Number of newest events that always stay live (at least 1).
+        max_age_days (int): Age (in days) after which events are folded.
+
+    Returns:
+        dict: Number of users compacted and events archived, or {"skipped": True} if another worker is compacting.
+
+    Raises:
+        ValueError: If keep_events is less than 1.
+    """
+    if keep_events < 1:
+        raise ValueError("keep_events must be at least 1: the next event of a user is linked to their newest live one")
+    if not await connection.fetchval("SELECT pg_try_advisory_lock($1)", COMPACTION_LOCK_ID):
+        return {"skipped": True, "users_compacted": 0, "events_archived": 0}
+
+    summary = {"skipped": False, "users_compacted": 0, "events_archived": 0}
+    try:
+        repository = AuditEventRepository(connection)
+        cutoff = datetime.now() - timedelta(days=max_age_days)
+        for row in await connection.fetch(CANDIDATES_QUERY, max_events, cutoff):
+            boundary = compaction_boundary(row["live_events"], row["last_index"], row["last_old_index"], max_events, keep_events)
+            if boundary is None:
+                continue
+            archived = await repository.compact(row["user_id"], boundary)  # One short transaction per user
+            if archived:
+                summary["users_compacted"] += 1
+                summary["events_archived"] += archived
+    finally:
+        await connection.execute("SELECT pg_advisory_unlock($1)", COMPACTION_LOCK_ID)
+    return summary
+
+
+async def run_periodically(interval: float = COMPACTION_INTERVAL_SECONDS):
+    """
+    Runs the compaction every `interval` seconds until cancelled (started by the application lifespan).
+
+    Args:
+        interval (float): Seconds between two runs.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            shards = range(len(database.DATABASE_SHARD_URLS)) if sharding.is_sharded() else [None]
+            for shard in shards:  # Histories never span shards, so each one is compacted on its own
+                connection = await (database.connect_to_db() if shard is None else database.connect_to_shard(shard))
+                try:
+                    summary = await compact_audit_history(connection)
+                finally:
+                    await database.close_db_connection(connection)
+                if summary["events_archived"]:
+                    logger.info("Audit compaction%s: %s", "" if shard is None else f" of shard {shard}", summary)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Audit compaction failed")  # Try again at the next interval
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Fold old audit events into checkpoints and archive them.")
+    parser.add_argument("--max-events", type=int, default=COMPACTION_MAX_EVENTS, help="compact users with more live events than this")
+    parser.add_argument("--keep-events", type=int, default=COMPACTION_KEEP_EVENTS, help="newest events that always stay live")
+    parser.add_argument("--max-age-days", type=int, default=COMPACTION_MAX_AGE_DAYS, help="fold events older than this")
+    args = parser.parse_args()
+    if args.keep_events < 1:
+        parser.error("--keep-events must be at least 1")
+
+    connection = await database.connect_to_db()
+    try:
+        summary = await compact_audit_history(connection, args.max_events, args.keep_events, args.max_age_days)
+    finally:
+        await database.close_db_connection(connection)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
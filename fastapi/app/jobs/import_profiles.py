@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
+import asyncpg
+from app import database, sharding
+from app.models.profile_import import ProfileImport, ProfileImportStatus
+from app.profile_import import Reject, split_header
+from app.repositories.sharded import sharded_repositories
+from app.repositories.user_profile_repository import UserProfileRepository
+
+# Bulk import of user profiles from a CSV file with a "name,email" header (columns in any order).
+#
+# The file is streamed in IMPORT_CHUNK_SIZE chunks: with Postgres straight into a staging table with COPY,
+# where rows are validated and deduplicated against the unique email constraint with set-based
+# statements before being merged into user_profiles together with their CREATE_PROFILE audit events
+# (validation rules in app/profile_import.py). The whole import is one transaction: valid rows are
+# imported and rejected rows reported, or nothing is imported if the file is malformed or the import
+# outlasts IMPORT_TIMEOUT_SECONDS (its events are stamped before it commits). With several
+# shards (app/sharding.py), rows are imported in batches spread over the shards, each batch committed on
+# its own (ShardedUserProfileRepository.import_csv).
+#
+# Usage: python -m app.jobs.import_profiles FILE [--rejects REJECTS.csv] [--chunk-size BYTES]
+# The API imports uploads too: POST /api/v1/admin/import/profiles/.
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", str(1024 * 1024)))  # Bytes read and sent to COPY at a time
+IMPORT_HISTORY_SIZE = 20  # Finished imports kept in the progress list of this process
+
+logger = logging.getLogger(__name__)
+
+_imports = OrderedDict()  # Imports of this process by id, oldest first: running ones and the last finished ones
+
+
+def new_profile_import(filename: Optional[str] = None) -> ProfileImport:
+    """
+    Creates the progress report of a new import and lists it with the imports of this process.
+
+    Args:
+        filename (str): Name of the imported file.
+
+    Returns:
+        ProfileImport: The new report.
+    """
+    report = ProfileImport(id=str(uuid.uuid4()), filename=filename, status=ProfileImportStatus.RUNNING,
+                           started_at=datetime.now())
+    _imports[report.id] = report
+    finished = [import_id for import_id, other in _imports.items() if other.status != ProfileImportStatus.RUNNING]
+    for import_id in finished[:max(len(finished) - IMPORT_HISTORY_SIZE, 0)]:
+        del _imports[import_id]
+    return report
+
+
+def recent_imports() -> List[ProfileImport]:
+    """Returns the running and recently finished imports of this process, newest first."""
+    return list(reversed(_imports.values()))
+
+
+async def iter_file(path: str, chunk_size: int = IMPORT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Reads a local file in chunks, off the event loop."""
+    with open(path, "rb") as file:
+        while chunk := await asyncio.to_thread(file.read, chunk_size):
+            yield chunk
+
+
+async def iter_upload(upload, chunk_size: int = IMPORT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Reads an uploaded file (fastapi.UploadFile) in chunks."""
+    while chunk := await upload.read(chunk_size):
+        yield chunk
+
+
+async def import_profiles(repository: UserProfileRepository, chunks: AsyncIterator[bytes],
+                          report: Optional[ProfileImport] = None, on_reject: Optional[Reject] = None) -> ProfileImport:
+    """
+    Imports the profiles of a streamed CSV file.
+
+    Args:
+        repository (UserProfileRepository): Repository used for the import.
+        chunks (AsyncIterator[bytes]): The file, in chunks.
+        report (ProfileImport): Progress report to update; a new one is created by default.
+        on_reject (Callable[[ImportReject], None]): Called with every rejected row, in file order.
+
+    Returns:
+        ProfileImport: The completed report.
+
+    Raises:
+        ValueError: If the file is empty, its header is invalid or a row is malformed (the report is marked failed).
+        asyncpg.DataError: If COPY rejects the file (malformed CSV, invalid UTF-8).
+    """
+    report = report or new_profile_import()
+
+    async def counted(source):
+        async for chunk in source:
+            report.bytes_read += len(chunk)
+            yield chunk
+
+    try:
+        columns, chunks = await split_header(counted(chunks))
+        await repository.import_csv(chunks, columns, report, on_reject)
+    except BaseException as e:
+        report.status, report.error = ProfileImportStatus.FAILED, str(e) or type(e).__name__
+        report.finished_at = datetime.now()
+        logger.warning("Profile import %s failed after %s rows: %s", report.id, report.rows, report.error)
+        raise
+
+    report.status, report.phase, report.finished_at = ProfileImportStatus.COMPLETED, "done", datetime.now()
+    logger.info("Profile import %s: %s rows, %s imported, %s rejected", report.id, report.rows, report.imported, report.rejected)
+    return report
+
+
+@asynccontextmanager
+async def _repository():
+    """Provides the repository of a command line import, with its own connections."""
+    if sharding.is_sharded():
+        async with sharded_repositories() as (profiles, _):
+            yield profiles
+        return
+
+    connection = await database.connect_to_db()
+    try:
+        yield UserProfileRepository(connection)
+    finally:
+        await database.close_db_connection(connection)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Import user profiles from a CSV file with a name,email header.")
+    parser.add_argument("file", help="CSV file to import")
+    parser.add_argument("--rejects", help="write every rejected row, with the reason, to this CSV file")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="bytes read at a time")
+    args = parser.parse_args()
+
+    rejects_file = open(args.rejects, "w", newline="") if args.rejects else None
+    on_reject = None
+    if rejects_file:
+        writer = csv.writer(rejects_file)
+        writer.writerow(["row", "name", "email", "reason"])
+        on_reject = lambda reject: writer.writerow([reject.row, reject.name, reject.email, reject.reason])
+
+    report = new_profile_import(os.path.basename(args.file))
+    try:
+        async with _repository() as repository:
+            await import_profiles(repository, iter_file(args.file, args.chunk_size), report, on_reject)
+    except (ValueError, asyncpg.DataError):
+        pass  # A malformed file; reported below
+    finally:
+        if rejects_file:
+            rejects_file.close()
+    print(json.dumps(report.model_dump(exclude={"rejects"}), indent=2, default=str))
+    raise SystemExit(0 if report.status == ProfileImportStatus.COMPLETED else 1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+from typing import Dict, List, Tuple
+import asyncpg
+from app import database
+from app.repositories.audit_event_repository import EVENT_COLUMNS
+
+# Online migration of the VARCHAR ids of databases created before ids were native uuid columns.
+#
+# Every id column still stored as text goes through four phases, none of which holds a long lock:
+#   1. prepare: a shadow uuid column (<column>_uuid) is added and kept in sync by a trigger on every
+#      insert and update; primary key columns also get a NOT VALID "shadow IS NOT NULL" check;
+#   2. backfill: existing rows are converted in keyset-ordered chunks, one short transaction each,
+#      pausing between chunks and while the replicas lag behind;
+#   3. index: the primary key and every other index on the old columns are built again on the shadow
+#      columns with CREATE INDEX CONCURRENTLY, and the checks are validated (neither blocks writes);
+#   4. cutover: one short transaction drops the old columns and their indexes, gives the shadow columns
+#      and indexes their names, attaches the primary keys to the new indexes and recreates the
+#      audit_events_all view. The validated checks let SET NOT NULL skip its table scan.
+# The converted columns end up last in their tables: keeping their position would mean rewriting each table
+# under an exclusive lock. Nothing depends on it: the view and every copy between tables name their columns.
+# Every phase is idempotent: an interrupted migration resumes when the job is run again. The API keeps
+# running throughout; its queries work with both column types.
+#
+# Usage: python -m app.jobs.migrate_uuid_keys [--chunk-size N] [--pause SECONDS] [--no-cutover]
+
+MIGRATION_CHUNK_SIZE = int(os.getenv("MIGRATION_CHUNK_SIZE", "5000"))  # Rows converted per transaction
+MIGRATION_PAUSE_SECONDS = float(os.getenv("MIGRATION_PAUSE_SECONDS", "0.05"))  # Pause between two chunks
+MIGRATION_MAX_REPLICATION_LAG_SECONDS = float(os.getenv("MIGRATION_MAX_REPLICATION_LAG_SECONDS", "5"))
+MIGRATION_LOCK_TIMEOUT_SECONDS = float(os.getenv("MIGRATION_LOCK_TIMEOUT_SECONDS", "5"))  # Per cutover attempt
+CUTOVER_ATTEMPTS = 5
+LAG_POLL_SECONDS = 1.0
+
+# Table -> (keyset column of the backfill, id columns to convert). The keyset column is the current primary key.
+ID_COLUMNS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "user_profiles": ("id", ("id",)),
+    "audit_events": ("id", ("id", "user_id")),
+    "audit_events_archive": ("id", ("id", "user_id")),
+    "audit_chain_checkpoints": ("user_id", ("user_id",)),
+    "audit_checkpoints": ("user_id", ("user_id",)),
+    "purge_runs": ("id", ("cursor_id",)),
+}
+# Views over the converted tables, dropped and created again by the cutover (same definitions as postgres/init.sql)
+VIEWS = {
+    "audit_events_all": (
+        f"SELECT {', '.join(EVENT_COLUMNS)} FROM audit_events_archive "
+        f"UNION ALL SELECT {', '.join(EVENT_COLUMNS)} FROM audit_events"
+    ),
+}
+
+TEXT_COLUMNS_QUERY = """
+    SELECT table_name, column_name FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = ANY($1::text[]) AND data_type <> 'uuid'
+"""
+
+# Indexes covering any of the given columns, with the name of the primary key constraint they back
+INDEXES_QUERY = """
+    SELECT c.relname AS name, pg_get_indexdef(i.indexrelid) AS definition, con.conname AS primary_key
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    LEFT JOIN pg_constraint con ON con.conindid = i.indexrelid AND con.contype = 'p'
+    WHERE i.indrelid = $1::regclass
+      AND EXISTS (
+          SELECT 1 FROM pg_attribute a
+          WHERE a.attrelid = i.indrelid AND a.attname = ANY($2::text[]) AND a.attnum = ANY(i.indkey::int2[])
+      )
+    ORDER BY c.relname
+"""
+
+BACKFILL_CHUNK = """
+    WITH chunk AS (
+        SELECT {key} FROM {table} WHERE {key} > $1 ORDER BY {key} LIMIT $2
+    ), converted AS (
+        UPDATE {table} t SET {assignments} FROM chunk WHERE t.{key} = chunk.{key} AND ({unconverted})
+    )
+    SELECT max({key}) AS last_key, count(*) AS rows FROM chunk
+"""
+
+
+def shadow(name: str) -> str:
+    """Returns the name of the shadow column or index of a column or index (at most 63 characters)."""
+    return f"{name[:58]}_uuid"
+
+
+def not_null_check(table: str, column: str) -> str:
+    """Returns the name of the check that lets SET NOT NULL skip its scan at cutover."""
+    return shadow(f"{table}_{column}_not_null")
+
+
+def shadow_index_definition(name: str, definition: str, columns) -> str:
+    """
+    Rewrites an index definition (pg_get_indexdef) into the concurrent build of the same index on the shadow columns.
+
+    Args:
+        name (str): Name of the index.
+        definition (str): Its definition, e.g. "CREATE UNIQUE INDEX x ON public.t USING btree (user_id, chain_index)".
+        columns (Sequence[str]): The converted columns.
+
+    Returns:
+        str: The CREATE INDEX CONCURRENTLY statement of the shadow index.
+    """
+    head, using, tail = definition.partition(" USING ")
+    unique = "UNIQUE " if head.startswith("CREATE UNIQUE INDEX") else ""
+    table = head.split(" ON ", 1)[1]
+    pattern = re.compile(r'\b(' + "|".join(re.escape(column) for column in columns) + r')\b')
+    return f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {shadow(name)} ON {table}{using}{pattern.sub(lambda m: shadow(m.group(1)), tail)}"
+
+
+async def pending_columns(connection) -> Dict[str, List[str]]:
+    """Returns the id columns still stored as text, by table (tables that don't exist are skipped)."""
+    text_columns = {(row["table_name"], row["column_name"]) for row in await connection.fetch(TEXT_COLUMNS_QUERY, list(ID_COLUMNS))}
+    plan = {}
+    for table, (_, columns) in ID_COLUMNS.items():
+        pending = [column for column in columns if (table, column) in text_columns]
+        if pending:
+            plan[table] = pending
+    return plan
+
+
+async def prepare(connection, table: str, columns: List[str]):
+    """Phase 1: adds the shadow columns, the trigger keeping them in sync and the NOT VALID checks."""
+    key = ID_COLUMNS[table][0]
+    assignments = " ".join(f"NEW.{shadow(column)} := NEW.{column}::uuid;" for column in columns)
+    async with connection.transaction():
+        await connection.execute(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT_SECONDS}s'")
+        for column in columns:
+            await connection.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {shadow(column)} UUID")
+        await connection.execute(
+            f"CREATE OR REPLACE FUNCTION migrate_uuid_keys_{table}() RETURNS trigger LANGUAGE plpgsql AS "
+            f"$$ BEGIN {assignments} RETURN NEW; END $$"
+        )
+        await connection.execute(f"DROP TRIGGER IF EXISTS migrate_uuid_keys ON {table}")
+        await connection.execute(
+            f"CREATE TRIGGER migrate_uuid_keys BEFORE INSERT OR UPDATE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION migrate_uuid_keys_{table}()"
+        )
+        if key in columns and not await connection.fetchval(
+            "SELECT 1 FROM pg_constraint WHERE conrelid = $1::regclass AND conname = $2", table, not_null_check(table, key)
+        ):
+            await connection.execute(
+                f"ALTER TABLE {table} ADD CONSTRAINT {not_null_check(table, key)} CHECK ({shadow(key)} IS NOT NULL) NOT VALID"
+            )
+
+
+async def throttle(connection, pause: float, max_lag: float):
+    """Pauses between two chunks, and keeps waiting while the replicas are too far behind."""
+    await asyncio.sleep(pause)
+    while max_lag and await database.replication_lag(connection) > max_lag:
+        await asyncio.sleep(LAG_POLL_SECONDS)
+
+
+async def backfill(connection, table: str, columns: List[str], chunk_size: int = MIGRATION_CHUNK_SIZE,
+                   pause: float = MIGRATION_PAUSE_SECONDS, max_lag: float = MIGRATION_MAX_REPLICATION_LAG_SECONDS) -> int:
+    """
+    Phase 2: converts the existing rows in chunks, in primary key order. Rows written meanwhile are
+    converted by the trigger.
+
+    Returns:
+        int: The number of rows scanned.
+    """
+    key = ID_COLUMNS[table][0]
+    statement = BACKFILL_CHUNK.format(
+        table=table, key=key,
+        assignments=", ".join(f"{shadow(column)} = t.{column}::uuid" for column in columns),
+        unconverted=" OR ".join(f"(t.{column} IS NOT NULL AND t.{shadow(column)} IS NULL)" for column in columns),
+    )
+    scanned, last_key = 0, ""
+    while True:
+        row = await connection.fetchrow(statement, last_key, chunk_size)  # One short transaction per chunk
+        scanned += row["rows"]
+        if row["rows"] < chunk_size:
+            return scanned
+        last_key = row["last_key"]
+        await throttle(connection, pause, max_lag)
+
+
+async def build_indexes(connection, table: str, columns: List[str]):
+    """Phase 3: builds the shadow indexes concurrently and validates the checks."""
+    for index in await connection.fetch(INDEXES_QUERY, table, columns):
+        valid = await connection.fetchval(
+            "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", shadow(index["name"])
+        )
+        if valid is False:
+            await connection.execute(f"DROP INDEX CONCURRENTLY {shadow(index['name'])}")  # Left over by an interrupted build
+        if not valid:
+            await connection.execute(shadow_index_definition(index["name"], index["definition"], columns))
+    key = ID_COLUMNS[table][0]
+    if key in columns:
+        await connection.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {not_null_check(table, key)}")
+
+
+async def cutover(connection, plan: Dict[str, List[str]]):
+    """
+    Phase 4: swaps the shadow columns and indexes in, in one transaction, retrying when a lock isn't granted in time.
+    """
+    for attempt in range(1, CUTOVER_ATTEMPTS + 1):
+        try:
+            async with connection.transaction():
+                await connection.execute(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT_SECONDS}s'")
+                await connection.execute(f"LOCK TABLE {', '.join(plan)} IN ACCESS EXCLUSIVE MODE")
+                for view in VIEWS:
+                    await connection.execute(f"DROP VIEW IF EXISTS {view}")
+                for table, columns in plan.items():
+                    await _swap_columns(connection, table, columns)
+                for view, definition in VIEWS.items():
+                    await connection.execute(f"CREATE VIEW {view} AS {definition}")
+            return
+        except asyncpg.LockNotAvailableError:
+            if attempt == CUTOVER_ATTEMPTS:
+                raise
+            await asyncio.sleep(attempt)  # Let the queued writers through before trying again
+
+
+async def _swap_columns(connection, table: str, columns: List[str]):
+    """Replaces the text columns of a table by their shadow columns, indexes and primary key included."""
+    key = ID_COLUMNS[table][0]
+    indexes = await connection.fetch(INDEXES_QUERY, table, columns)
+    await connection.execute(f"DROP TRIGGER migrate_uuid_keys ON {table}")
+    await connection.execute(f"DROP FUNCTION migrate_uuid_keys_{table}()")
+    for column in columns:
+        await connection.execute(f"ALTER TABLE {table} DROP COLUMN {column}")  # Drops its indexes and primary key too
+        await connection.execute(f"ALTER TABLE {table} RENAME COLUMN {shadow(column)} TO {column}")
+    for index in indexes:
+        if index["primary_key"]:
+            await connection.execute(f"ALTER TABLE {table} ALTER COLUMN {key} SET NOT NULL")  # Proven by the check
+            await connection.execute(
+                f"ALTER TABLE {table} ADD CONSTRAINT {index['primary_key']} PRIMARY KEY USING INDEX {shadow(index['name'])}"
+            )
+        else:
+            await connection.execute(f"ALTER INDEX {shadow(index['name'])} RENAME TO {index['name']}")
+    await connection.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {not_null_check(table, key)}")
+
+
+async def migrate_uuid_keys(connection, chunk_size: int = MIGRATION_CHUNK_SIZE, pause: float = MIGRATION_PAUSE_SECONDS,
+                            max_lag: float = MIGRATION_MAX_REPLICATION_LAG_SECONDS, cut_over: bool = True) -> dict:
+    """
+    Converts every remaining text id column to uuid.
+
+    Args:
+        connection (asyncpg.Connection): Connection used for the migration.
+        chunk_size (int): Rows converted per transaction.
+        pause (float): Seconds to pause between two chunks.
+        max_lag (float): Replication lag (in seconds) above which the backfill waits; 0 disables the check.
+        cut_over (bool): Whether to swap the columns in; otherwise the shadow columns stay in sync until the next run.
+
+    Returns:
+        dict: The converted columns and scanned rows per table, and whether the cutover ran.
+    """
+    started = time.perf_counter()
+    plan = await pending_columns(connection)
+    summary = {"tables": {table: {"columns": columns, "rows": 0} for table, columns in plan.items()}, "cut_over": False}
+    for table, columns in plan.items():
+        await prepare(connection, table, columns)
+    for table, columns in plan.items():
+        summary["tables"][table]["rows"] = await backfill(connection, table, columns, chunk_size, pause, max_lag)
+    for table, columns in plan.items():
+        await build_indexes(connection, table, columns)
+    if plan and cut_over:
+        await cutover(connection, plan)
+        for table in plan:
+            await connection.execute(f"ANALYZE {table}")
+        summary["cut_over"] = True
+    summary["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Convert the VARCHAR id columns to native uuid columns, online.")
+    parser.add_argument("--chunk-size", type=int, default=MIGRATION_CHUNK_SIZE, help="rows converted per transaction")
+    parser.add_argument("--pause", type=float, default=MIGRATION_PAUSE_SECONDS, help="seconds to pause between chunks")
+    parser.add_argument("--max-lag", type=float, default=MIGRATION_MAX_REPLICATION_LAG_SECONDS, help="wait while the replicas lag more than this (0 disables)")
+    parser.add_argument("--no-cutover", action="store_true", help="only prepare, backfill and index; swap the columns in a later run")
+    args = parser.parse_args()
+
+    connection = await database.connect_to_db()
+    try:
+        summary = await migrate_uuid_keys(connection, args.chunk_size, args.pause, args.max_lag, cut_over=not args.no_cutover)
+    finally:
+        await database.close_db_connection(connection)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from app import database, sharding
+from app.models.audit_event import SYSTEM_USER_ID, AuditEventAction, AuditEventBase
+from app.models.purge import PurgeRun, PurgeStatus
+from app.repositories.memory import InMemoryUserProfileRepository, get_memory_store
+from app.repositories.sharded import sharded_repositories
+from app.repositories.user_profile_repository import UserProfileRepository
+
+# Hard deletion of profiles soft deleted before a cutoff.
+#
+# Profiles are purged in small chunks in (deleted_at, id) order, one short transaction per chunk,
+# pausing between chunks and waiting while the replicas lag behind. Each chunk also saves the run's
+# progress (purge_runs), including the keyset cursor, so an interrupted or failed run can be resumed
+# where it stopped. Rows locked by a concurrent restore are skipped, so the run only completes after a
+# final sweep from the start, which waits for them. Every run ends with a summary audit event recorded
+# under SYSTEM_USER_ID.
+# The audit events of purged profiles are kept.
+#
+# Usage: python -m app.jobs.purge_deleted_profiles [--older-than-days N] [--chunk-size N] [--resume RUN_ID]
+# The API starts runs in the background: POST /api/v1/admin/purge/.
+
+PURGE_RETENTION_DAYS = int(os.getenv("PURGE_RETENTION_DAYS", "30"))
+PURGE_CHUNK_SIZE = int(os.getenv("PURGE_CHUNK_SIZE", "500"))
+PURGE_PAUSE_SECONDS = float(os.getenv("PURGE_PAUSE_SECONDS", "0.1"))  # Pause between two chunks
+PURGE_MAX_REPLICATION_LAG_SECONDS = float(os.getenv("PURGE_MAX_REPLICATION_LAG_SECONDS", "5"))
+LAG_POLL_SECONDS = 1.0  # How often the replication lag is checked while waiting for it to shrink
+
+logger = logging.getLogger(__name__)
+
+_running: Dict[str, asyncio.Task] = {}  # Runs executing in this process, by run id
+
+
+def new_purge_run(older_than_days: int = PURGE_RETENTION_DAYS, chunk_size: int = PURGE_CHUNK_SIZE,
+                  now: Optional[datetime] = None) -> PurgeRun:
+    """
+    Creates the report of a new purge run.
+
+    Args:
+        older_than_days (int): Purge profiles soft deleted more than this many days ago.
+        chunk_size (int): Profiles hard deleted per transaction.
+        now (datetime): Current time (for tests).
+
+    Returns:
+        PurgeRun: The new run, not saved yet.
+    """
+    now = now or datetime.now()
+    return PurgeRun(id=str(uuid.uuid4()), cutoff=now - timedelta(days=older_than_days), chunk_size=chunk_size,
+                    status=PurgeStatus.RUNNING, started_at=now, updated_at=now)
+
+
+async def throttle(repository, pause: float, max_lag: float):
+    """Pauses between two chunks, and keeps waiting while the replicas are too far behind."""
+    await asyncio.sleep(pause)
+    if repository.connection is None or not max_lag:
+        return  # In-memory backend: nothing replicates
+    while await database.replication_lag(repository.connection) > max_lag:
+        await asyncio.sleep(LAG_POLL_SECONDS)
+
+
+async def purge_deleted_profiles(repository: UserProfileRepository, run: PurgeRun, pause: float = PURGE_PAUSE_SECONDS,
+                                 max_lag: float = PURGE_MAX_REPLICATION_LAG_SECONDS) -> PurgeRun:
+    """
+    Purges the profiles of a run chunk by chunk, starting from its cursor (so it also resumes runs).
+
+    Args:
+        repository (UserProfileRepository): Repository used for the purge.
+        run (PurgeRun): The run to execute.
+        pause (float): Seconds to pause between two chunks.
+        max_lag (float): Replication lag (in seconds) above which the purge waits; 0 disables the check.
+
+    Returns:
+        PurgeRun: The run, completed or failed.
+    """
+    run.status, run.error = PurgeStatus.RUNNING, None
+    await repository.save_purge_run(run)
+    purged_before = run.purged
+    try:
+        while await repository.purge_chunk(run):  # A short chunk may only have skipped locked rows
+            await throttle(repository, pause, max_lag)
+        while await repository.purge_chunk(run, sweep=True):  # Rows skipped under a lock are behind the cursor
+            await throttle(repository, pause, max_lag)
+        run.status, run.finished_at = PurgeStatus.COMPLETED, datetime.now()
+    except asyncio.CancelledError:
+        raise  # Shutdown: the run stays "running" and can be resumed
+    except Exception as e:
+        logger.exception("Purge run %s failed", run.id)
+        run.status, run.error = PurgeStatus.FAILED, str(e)
+    run.updated_at = datetime.now()
+    await repository.save_purge_run(run)
+
+    await repository.create_audit_event(AuditEventBase(
+        user_id=SYSTEM_USER_ID,
+        action=AuditEventAction.PURGE_PROFILES,
+        resource="user_profile",
+        details=f"Purged {run.purged - purged_before} profiles soft deleted before {run.cutoff.isoformat()}.",
+        changes={"purge": {"run_id": run.id, "cutoff": run.cutoff.isoformat(), "purged": run.purged - purged_before,
+                           "total_purged": run.purged, "status": run.status.value}},
+    ))
+    return run
+
+
+@asynccontextmanager
+async def purge_repository():
+    """Provides a repository with its own connection, for runs that outlive the request starting them."""
+    if database.STORAGE_BACKEND == "memory":
+        yield InMemoryUserProfileRepository(get_memory_store())
+        return
+    if sharding.is_sharded():
+        async with sharded_repositories() as (profiles, _):
+            yield profiles  # Chunks are filled shard after shard (ShardedUserProfileRepository.purge_chunk)
+        return
+
+    connection = await database.connect_to_db()
+    try:
+        yield UserProfileRepository(connection)
+    finally:
+        await database.close_db_connection(connection)
+
+
+def is_running(run_id: str) -> bool:
+    """Returns whether a run is executing in this process."""
+    return run_id in _running
+
+
+def start_in_background(run: PurgeRun) -> asyncio.Task:
+    """
+    Executes a run in a background task of the current event loop.
+
+    Args:
+        run (PurgeRun): The run to execute (already saved).
+
+    Returns:
+        asyncio.Task: The task executing the run.
+    """
+    async def execute():
+        async with purge_repository() as repository:
+            await purge_deleted_profiles(repository, run)
+
+    task = asyncio.create_task(execute())
+    _running[run.id] = task
+    task.add_done_callback(lambda _: _running.pop(run.id, None))
+    return task
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Hard delete profiles soft deleted before a cutoff.")
+    parser.add_argument("--older-than-days", type=int, default=PURGE_RETENTION_DAYS, help="purge profiles deleted more than N days ago")
+    parser.add_argument("--chunk-size", type=int, default=PURGE_CHUNK_SIZE, help="profiles deleted per transaction")
+    parser.add_argument("--pause", type=float, default=PURGE_PAUSE_SECONDS, help="seconds to pause between chunks")
+    parser.add_argument("--resume", metavar="RUN_ID", help="resume an interrupted or failed run")
+    args = parser.parse_args()
+
+    async with purge_repository() as repository:
+        if args.resume:
+            run = await repository.get_purge_run(args.resume)
+            if run is None or not run.resumable:
+                raise SystemExit(f"No resumable purge run {args.resume}")
+        else:
+            run = new_purge_run(args.older_than_days, args.chunk_size)
+        run = await purge_deleted_profiles(repository, run, pause=args.pause)
+    print(json.dumps(run.model_dump(mode="json"), indent=2))
+    raise SystemExit(0 if run.status == PurgeStatus.COMPLETED else 1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import get_context
+from typing import Tuple
+import asyncpg
+from app import database, sharding
+from app.audit_replay import PROFILE_DIFFERS, PROFILE_MISSING, replay_segments
+from app.models.audit_event import SYSTEM_USER_ID
+from app.repositories.audit_event_repository import LOCK_USERS
+from app.repositories.sharded import sharded_repositories
+
+# Consistency check of user_profiles against the audit trail, which it can also rebuild the table from.
+#
+# Profile writes and their audit events aren't committed together, so the two can drift apart. Two
+# server-side cursors read the same exported snapshot in user id order: the live events, through the
+# (user_id, chain_index) index, and the stored state of every user (profile row, compaction checkpoint,
+# purge tombstone). They are merged per user, and each batch of users is replayed (app/audit_replay.py,
+# the semantics the repositories and rollback_changes_by_event_id rely on) and compared by a pool of
+# worker processes while the next batch is being read. With --rebuild, the profiles that are missing or
+# differ are written back from their replayed state (no audit event is recorded: the trail already says
+# what they should be). Writes made while the check runs can show up as transient mismatches, so the
+# rebuild is safe with the API running: each profile is written under its user's advisory lock (the one
+# audit writes take) and only if its change_seq is still the one of the snapshot, or if it is still missing.
+# Profiles written since are left alone and counted as skipped; the next run checks them again. On
+# sharded deployments the writes also hold the emails' cross-shard lock, and a profile whose email is now
+# used on another shard counts as a rebuild failure, like one breaking its own shard's unique constraint.
+# Profiles without a change_seq yet are skipped too: run app.jobs.backfill_columns first.
+#
+# Users with events written before the hash chain existed are skipped until
+# `python -m app.jobs.verify_audit_chain --seal-legacy` has ordered them.
+#
+# Usage: python -m app.jobs.replay_profiles [--rebuild] [--workers N] [--batch-size N]
+
+DEFAULT_BATCH_SIZE = 20_000  # Events fetched from the cursor, and replayed by one worker task, at a time
+REBUILD_FLUSH_SIZE = 1_000  # Profiles rebuilt per transaction
+MAX_REPORTED_MISMATCHES = 100  # Mismatches listed in the summary (all of them are counted)
+
+# Live events of every user, oldest first; archived events are folded into the checkpoints
+EVENTS_QUERY = """
+    SELECT user_id, action, timestamp, changes FROM audit_events
+    WHERE chain_index IS NOT NULL AND user_id <> $1
+    ORDER BY user_id, chain_index
+"""
+
+# Stored state of every user: their profile row, checkpoint and tombstone, whichever exist
+STORED_QUERY = """
+    SELECT COALESCE(p.id, c.user_id, t.id) AS user_id, p.id IS NOT NULL AS has_profile, p.name, p.email, p.is_deleted,
+           p.change_seq, t.id IS NOT NULL AS purged, c.state, c.up_to
+    FROM user_profiles p
+    FULL JOIN audit_checkpoints c ON c.user_id = p.id
+    FULL JOIN user_profile_tombstones t ON t.id = COALESCE(p.id, c.user_id)
+    ORDER BY 1
+"""
+
+UNSEALED_USERS_QUERY = "SELECT DISTINCT user_id FROM audit_events WHERE chain_index IS NULL"  # Served by a partial index
+
+# Writes the replayed state if the profile hasn't changed since the snapshot ($6: its change_seq then, NULL
+# if it was missing); soft-deleted profiles keep their deletion time if they have one
+REBUILD_PROFILE = """
+    INSERT INTO user_profiles (id, name, email, is_deleted, deleted_at) VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, email = EXCLUDED.email, is_deleted = EXCLUDED.is_deleted,
+        deleted_at = CASE WHEN EXCLUDED.is_deleted THEN COALESCE(user_profiles.deleted_at, EXCLUDED.deleted_at) END,
+        change_seq = DEFAULT, updated_at = DEFAULT
+    WHERE user_profiles.change_seq = $6
+"""
+REBUILT_REASONS = (PROFILE_MISSING, PROFILE_DIFFERS)  # Profiles without any history are only reported
+
+
+def new_summary() -> dict:
+    """Returns an empty replay summary."""
+    return {
+        "users_checked": 0,
+        "events_replayed": 0,
+        "unsealed_users": 0,
+        "mismatch_count": 0,
+        "mismatches": [],
+        "profiles_rebuilt": 0,
+        "rebuild_skipped": 0,
+        "rebuild_failures": 0,
+        "elapsed_seconds": 0.0,
+    }
+
+
+def add_mismatch(summary: dict, user_id: str, reason: str, expected: dict):
+    """Counts a mismatch and lists it if the report isn't full yet."""
+    summary["mismatch_count"] += 1
+    if len(summary["mismatches"]) < MAX_REPORTED_MISMATCHES:
+        summary["mismatches"].append({"user_id": user_id, "reason": reason, "expected": expected})
+
+
+def add_summary(total: dict, summary: dict):
+    """Adds the summary of one shard to the total."""
+    for key, value in summary.items():
+        if key == "mismatches":
+            total[key].extend(value[:MAX_REPORTED_MISMATCHES - len(total[key])])
+        else:
+            total[key] += value
+
+
+async def histories(cursor, batch_size: int):
+    """
+    Groups the rows of EVENTS_QUERY by user.
+
+    Args:
+        cursor (asyncpg.cursor.Cursor): Cursor over EVENTS_QUERY.
+        batch_size (int): Rows fetched at a time.
+
+    Yields:
+        tuple: (user_id, events) for every user with live events, in user id order.
+    """
+    user_id, events = None, []
+    while rows := await cursor.fetch(batch_size):
+        for row in rows:
+            if row["user_id"] != user_id:
+                if events:
+                    yield user_id, events
+                user_id, events = row["user_id"], []
+            events.append((row["action"], row["timestamp"], row["changes"]))
+    if events:
+        yield user_id, events
+
+
+async def stored_profiles(cursor, batch_size: int):
+    """Yields (user_id, stored state) for every row of STORED_QUERY, in user id order."""
+    while rows := await cursor.fetch(batch_size):
+        for row in rows:
+            yield row["user_id"], dict(row)
+
+
+async def _next(iterator):
+    """Returns the next (user_id, value) pair of an async iterator, or (None, None) once it is exhausted."""
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None, None
+
+
+async def merge_users(stored, events):
+    """
+    Merges the stored states and the histories of the users, both in user id order.
+
+    Args:
+        stored (async iterator): (user_id, stored state) pairs.
+        events (async iterator): (user_id, events) pairs.
+
+    Yields:
+        tuple: (user_id, stored state or None, events) for every user found on either side.
+    """
+    left, right = await _next(stored), await _next(events)
+    while left[0] is not None or right[0] is not None:
+        if right[0] is None or (left[0] is not None and left[0] < right[0]):
+            yield left[0], left[1], []
+            left = await _next(stored)
+        elif left[0] is None or right[0] < left[0]:
+            yield right[0], None, right[1]
+            right = await _next(events)
+        else:
+            yield left[0], left[1], right[1]
+            left, right = await _next(stored), await _next(events)
+
+
+async def _write_profiles(connection, fixes: list) -> int:
+    """Writes some profiles in one transaction, under their users' locks; returns how many were written."""
+    async with connection.transaction():
+        await connection.execute(LOCK_USERS, [fix[0] for fix in fixes])
+        return sum([int((await connection.execute(REBUILD_PROFILE, *fix)).split()[-1]) for fix in fixes])
+
+
+async def rebuild_profiles(connection, fixes: list, sharded=None) -> Tuple[int, int]:
+    """
+    Writes the replayed state of some profiles, one by one if the batch breaks a constraint.
+
+    Args:
+        connection (asyncpg.Connection): Connection used for the writes.
+        fixes (list): (user_id, name, email, is_deleted, deleted_at, change_seq) of the profiles to write, with
+            the change_seq they had in the snapshot (None if they were missing).
+        sharded (ShardedUserProfileRepository): The profiles of every shard, when the connection is one of
+            them; the emails are then locked and checked across shards.
+
+    Returns:
+        Tuple[int, int]: The number of profiles written, and of those that couldn't be (e.g. their email belongs
+            to another profile). The others changed since the snapshot.
+    """
+    failures = 0
+    async with (sharded.shards.email_lock([fix[2] for fix in fixes]) if sharded else nullcontext()):
+        if sharded:
+            taken = await sharded.foreign_emails({fix[0]: fix[2] for fix in fixes})
+            failures = sum(fix[2] in taken for fix in fixes)
+            fixes = [fix for fix in fixes if fix[2] not in taken]
+        try:
+            return (await _write_profiles(connection, fixes) if fixes else 0), failures
+        except asyncpg.IntegrityConstraintViolationError:
+            written = 0
+            for fix in fixes:
+                try:
+                    written += await _write_profiles(connection, [fix])
+                except asyncpg.IntegrityConstraintViolationError:
+                    failures += 1
+            return written, failures
+
+
+async def replay_profiles(connect=database.connect_to_db, rebuild: bool = False, workers: int = None,
+                          batch_size: int = DEFAULT_BATCH_SIZE, sharded=None) -> dict:
+    """
+    Replays the audit trail of every user in parallel and compares it with the stored profiles.
+
+    Args:
+        connect (callable): Opens a connection to the database to check (three are used).
+        rebuild (bool): Whether to write the replayed state of the profiles that are missing or differ.
+        workers (int): Number of worker processes (defaults to the number of CPUs).
+        batch_size (int): Number of events fetched and handed to a worker at a time.
+        sharded (ShardedUserProfileRepository): The profiles of every shard, when the database is one of them.
+
+    Returns:
+        dict: Summary with the number of users and events replayed, and the mismatches found.
+    """
+    started = time.perf_counter()
+    summary = new_summary()
+    workers = workers or os.cpu_count() or 1
+    loop = asyncio.get_running_loop()
+
+    events_connection, stored_connection, write_connection = await connect(), await connect(), await connect()
+    try:
+        fixes = []
+        pending = set()
+
+        async def flush():
+            written, failures = await rebuild_profiles(write_connection, fixes, sharded)
+            summary["profiles_rebuilt"] += written
+            summary["rebuild_failures"] += failures
+            summary["rebuild_skipped"] += len(fixes) - written - failures
+            fixes.clear()
+
+        async def drain(return_when):
+            nonlocal pending
+            done, pending = await asyncio.wait(pending, return_when=return_when)
+            for future in done:
+                for user_id, reason, expected, deleted_at, change_seq in future.result():
+                    add_mismatch(summary, user_id, reason, expected)
+                    if rebuild and reason in REBUILT_REASONS:
+                        fixes.append((user_id, expected["name"], expected["email"], expected["is_deleted"], deleted_at, change_seq))
+            if len(fixes) >= REBUILD_FLUSH_SIZE or (fixes and not pending):
+                await flush()
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+            # Both cursors read the same snapshot, so a user's history and stored state agree as of one moment
+            async with events_connection.transaction(isolation="repeatable_read", readonly=True):
+                snapshot = await events_connection.fetchval("SELECT pg_export_snapshot()")
+                async with stored_connection.transaction(isolation="repeatable_read", readonly=True):
+                    await stored_connection.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+                    unsealed = {row["user_id"] for row in await events_connection.fetch(UNSEALED_USERS_QUERY)}
+                    summary["unsealed_users"] = len(unsealed)
+
+                    users = merge_users(
+                        stored_profiles(await stored_connection.cursor(STORED_QUERY), batch_size),
+                        histories(await events_connection.cursor(EVENTS_QUERY, SYSTEM_USER_ID), batch_size),
+                    )
+                    segments, events = [], 0
+                    async for user_id, stored, history in users:
+                        if user_id in unsealed:
+                            continue
+                        segments.append((user_id, stored, history))
+                        events += len(history)
+                        if events >= batch_size:
+                            pending.add(loop.run_in_executor(pool, replay_segments, segments))
+                            summary["users_checked"] += len(segments)
+                            summary["events_replayed"] += events
+                            segments, events = [], 0
+                            if len(pending) >= workers * 2:
+                                await drain(asyncio.FIRST_COMPLETED)  # Backpressure: don't read faster than we replay
+                    if segments:
+                        pending.add(loop.run_in_executor(pool, replay_segments, segments))
+                        summary["users_checked"] += len(segments)
+                        summary["events_replayed"] += events
+            if pending:
+                await drain(asyncio.ALL_COMPLETED)
+    finally:
+        for connection in (events_connection, stored_connection, write_connection):
+            await database.close_db_connection(connection)
+
+    summary["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Check the profiles against their audit trail, and optionally rebuild them from it.")
+    parser.add_argument("--rebuild", action="store_true", help="write the replayed state of the profiles that are missing or differ")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="events per batch")
+    args = parser.parse_args()
+
+    if sharding.is_sharded():
+        # Histories never span shards, so each one is checked on its own; emails are checked across them
+        summary = new_summary()
+        async with sharded_repositories() as (profiles, _):
+            for shard in range(len(database.DATABASE_SHARD_URLS)):
+                add_summary(summary, await replay_profiles(partial(database.connect_to_shard, shard), args.rebuild,
+                                                           args.workers, args.batch_size, profiles))
+    else:
+        summary = await replay_profiles(rebuild=args.rebuild, workers=args.workers, batch_size=args.batch_size)
+    print(json.dumps(summary, indent=2, default=str))
+    raise SystemExit(1 if summary["mismatch_count"] > summary["profiles_rebuilt"] else 0)  # Something is still inconsistent
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
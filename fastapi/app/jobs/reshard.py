@@ -0,0 +1,176 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from typing import List
+import asyncpg
+from app import database
+from app.sharding import shard_for
+
+# Moves profiles and their audit trail to the shard their user id maps to after the list of shards changes.
+#
+# Jump consistent hashing (app/sharding.py) only moves users to the shards that were added, so growing
+# from N to N + 1 shards moves about 1 / (N + 1) of them. For every table keyed by user, the keys of each
+# source shard are scanned in batches; the rows of the users that now belong elsewhere are copied to their
+# new shard (in one transaction per batch, skipping rows already there) and then deleted from the source.
+# An interrupted run can simply be started again.
+#
+# The move is offline: stop the API and the jobs, run the tool, then restart them with the new
+# DATABASE_SHARD_URLS. Moved profiles get a new change_seq on their new shard; delta sync clients resync
+# from the start, since their cursors have one position per shard.
+#
+# Usage: python -m app.jobs.reshard --to URL,URL,... [--from URL,URL,...] [--batch-size N] [--dry-run]
+
+RESHARD_BATCH_SIZE = int(os.getenv("RESHARD_BATCH_SIZE", "1000"))  # Users moved per transaction and table
+
+# Tables holding per-user rows, with the column naming the user; profiles first, so a crash never leaves
+# audit events without their profile on the new shard
+SHARDED_TABLES = [
+    ("user_profiles", "id"),
+    ("user_profile_tombstones", "id"),
+    ("audit_events", "user_id"),
+    ("audit_events_archive", "user_id"),
+    ("audit_chain_checkpoints", "user_id"),
+    ("audit_checkpoints", "user_id"),
+]
+REASSIGNED_COLUMNS = {"change_seq"}  # Defaulted on the new shard: transaction ids are per database
+
+COLUMNS_QUERY = """
+    SELECT column_name FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = $1
+    ORDER BY ordinal_position
+"""
+
+
+def keys_query(table: str, key: str) -> str:
+    """
+    Returns the keyset query listing the distinct users of a table ($1: last key of the previous batch, or NULL).
+
+    Keys are ordered and compared as uuid values, the order of the index that serves the scan; uuid order
+    differs from the order of their text form, so mixing both would skip or repeat keys.
+    """
+    return f"""
+        SELECT DISTINCT {key} AS key FROM {table}
+        WHERE {key} IS NOT NULL AND ($1::uuid IS NULL OR {key} > $1::uuid)
+        ORDER BY {key} LIMIT $2
+    """
+
+
+def plan_moves(keys: List[str], source: str, targets: List[str]) -> dict:
+    """
+    Groups the keys of a batch by the shard they now belong to, leaving out those already there.
+
+    Args:
+        keys (List[str]): User ids found on the source shard.
+        source (str): DSN of the source shard.
+        targets (List[str]): DSNs of the new list of shards.
+
+    Returns:
+        dict: The keys to move, by index of their target shard.
+    """
+    moves = defaultdict(list)
+    for key in keys:
+        target = shard_for(key, len(targets))
+        if targets[target] != source:
+            moves[target].append(key)
+    return moves
+
+
+async def _connect(dsn: str):
+    connection = await asyncpg.connect(dsn)
+    await database.register_codecs(connection)
+    return connection
+
+
+async def move_rows(source, target, table: str, key: str, columns: List[str], keys: List[str]) -> int:
+    """
+    Copies the rows of some users to their new shard, then deletes them from the source.
+
+    Args:
+        source (asyncpg.Connection): Connection to the source shard.
+        target (asyncpg.Connection): Connection to the target shard.
+        table (str): The table.
+        key (str): The column naming the user.
+        columns (List[str]): The columns copied.
+        keys (List[str]): The users to move.
+
+    Returns:
+        int: The number of rows moved.
+    """
+    column_list = ", ".join(columns)
+    async with source.transaction():
+        rows = await source.fetch(f"SELECT {column_list} FROM {table} WHERE {key} = ANY($1::uuid[]) FOR UPDATE", keys)
+        if rows:
+            async with target.transaction():
+                await target.execute(f"CREATE TEMP TABLE reshard_rows ON COMMIT DROP AS SELECT {column_list} FROM {table} WITH NO DATA")
+                await target.copy_records_to_table("reshard_rows", records=rows, columns=columns)
+                await target.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM reshard_rows ON CONFLICT DO NOTHING")
+            # Deleted once the copy is committed: a failure in between leaves the rows on both shards, and the next run skips the copy
+            await source.execute(f"DELETE FROM {table} WHERE {key} = ANY($1::uuid[])", keys)
+    return len(rows)
+
+
+async def reshard(sources: List[str], targets: List[str], batch_size: int = RESHARD_BATCH_SIZE, dry_run: bool = False) -> dict:
+    """
+    Moves every user whose shard changed from the old list of shards to the new one.
+
+    Args:
+        sources (List[str]): DSNs of the shards holding the data (the old DATABASE_SHARD_URLS).
+        targets (List[str]): DSNs of the new list of shards, in order.
+        batch_size (int): Users moved per transaction and table.
+        dry_run (bool): Only count the users that would move.
+
+    Returns:
+        dict: Users and rows moved per table, and the users moved between each pair of shards.
+    """
+    started = time.perf_counter()
+    summary = {"dry_run": dry_run, "users_moved": Counter(), "rows_moved": Counter(), "moves": Counter()}
+    connections = {}
+    try:
+        for dsn in dict.fromkeys(sources + targets):
+            connections[dsn] = await _connect(dsn)
+        if not dry_run:
+            for dsn in targets:
+                await database.apply_schema(connections[dsn])  # New shards start empty
+
+        for source in dict.fromkeys(sources):
+            for table, key in SHARDED_TABLES:
+                columns = [row["column_name"] for row in await connections[source].fetch(COLUMNS_QUERY, table)]
+                columns = [column for column in columns if column not in REASSIGNED_COLUMNS]
+                last = None
+                while keys := [row["key"] for row in await connections[source].fetch(keys_query(table, key), last, batch_size)]:
+                    last = keys[-1]
+                    for target, moved in plan_moves(keys, source, targets).items():
+                        summary["users_moved"][table] += len(moved)
+                        summary["moves"][f"{sources.index(source)}->{target}"] += len(moved)
+                        if not dry_run:
+                            summary["rows_moved"][table] += await move_rows(
+                                connections[source], connections[targets[target]], table, key, columns, moved
+                            )
+    finally:
+        for connection in connections.values():
+            await connection.close()
+    summary["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Move profiles and audit events to their shard after the list of shards changed.")
+    parser.add_argument("--from", dest="sources", default=",".join(database.DATABASE_SHARD_URLS), help="current shards, comma separated (default: DATABASE_SHARD_URLS)")
+    parser.add_argument("--to", dest="targets", required=True, help="new shards, comma separated, in order")
+    parser.add_argument("--batch-size", type=int, default=RESHARD_BATCH_SIZE, help="users moved per transaction and table")
+    parser.add_argument("--dry-run", action="store_true", help="only count the users that would move")
+    args = parser.parse_args()
+
+    sources = [url.strip() for url in args.sources.split(",") if url.strip()]
+    targets = [url.strip() for url in args.targets.split(",") if url.strip()]
+    if not sources or not targets:
+        parser.error("both the current and the new list of shards are needed")
+    summary = await reshard(sources, targets, args.batch_size, args.dry_run)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
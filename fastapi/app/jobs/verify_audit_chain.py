@@ -0,0 +1,347 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+from functools import partial
+from multiprocessing import get_context
+from typing import Dict
+from app import database, sharding
+from app.audit_chain import GENESIS_HASH, verify_segments
+from app.models.audit_verification import VerificationRun, VerificationStatus
+from app.repositories.audit_event_repository import AuditEventRepository
+
+# Verification of the audit event hash chains (see app/audit_chain.py).
+#
+# One server-side cursor streams the events, live and archived, ordered by (user_id, chain_index)
+# through the (user_id, chain_index) indexes, in batches. Each batch is grouped into per-user segments and
+# hashed by a pool of worker processes while the next batch is being fetched. Every verified
+# prefix is recorded in audit_chain_checkpoints, so later runs only look at new events. When sharded, every
+# shard is verified against its own checkpoints, one after the other, by the same pool of workers.
+#
+# Usage: python -m app.jobs.verify_audit_chain [--full] [--workers N] [--batch-size N] [--seal-legacy]
+# The API starts runs in the background: POST /api/v1/audit/verify/, then GET /api/v1/audit/verify/{run_id}.
+# A run interrupted by a shutdown stays "running"; start a new one (checkpoints keep the work already done).
+
+DEFAULT_BATCH_SIZE = 20_000  # Rows fetched from the cursor, and hashed by one worker task, at a time
+CHECKPOINT_FLUSH_SIZE = 5_000  # Checkpoints written per round trip
+MAX_REPORTED_MISMATCHES = 100  # Mismatches listed in the summary (all of them are counted)
+
+logger = logging.getLogger(__name__)
+
+_running: Dict[str, asyncio.Task] = {}  # Runs executing in this process, by run id
+
+# Events after each user's checkpoint, with the checkpoint the segment starts from
+STREAM_QUERY = """
+    SELECT e.user_id, COALESCE(c.chain_index, 0) AS start_index, COALESCE(c.hash, $1) AS start_hash,
+           e.id, e.chain_index, e.action, e.timestamp, e.resource, e.details, e.changes, e.prev_hash, e.hash
+    FROM audit_events_all e
+    LEFT JOIN audit_chain_checkpoints c ON c.user_id = e.user_id AND NOT $2
+    WHERE e.chain_index > COALESCE(c.chain_index, 0)
+    ORDER BY e.user_id, e.chain_index
+"""
+
+# Checkpoints whose event disappeared or changed: the only way to notice a truncated chain tail
+BROKEN_CHECKPOINTS_QUERY = """
+    SELECT c.user_id, c.chain_index FROM audit_chain_checkpoints c
+    WHERE NOT EXISTS (
+        SELECT 1 FROM audit_events_all e WHERE e.user_id = c.user_id AND e.chain_index = c.chain_index AND e.hash = c.hash
+    )
+"""
+
+UPSERT_CHECKPOINT = """
+    INSERT INTO audit_chain_checkpoints (user_id, chain_index, hash, verified_at) VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id) DO UPDATE SET chain_index = EXCLUDED.chain_index, hash = EXCLUDED.hash, verified_at = EXCLUDED.verified_at
+"""
+
+
+def new_summary() -> dict:
+    """Returns an empty verification summary."""
+    return {
+        "events_verified": 0,
+        "users_verified": 0,
+        "users_failed": 0,
+        "mismatch_count": 0,
+        "mismatches": [],
+        "unsealed_events": 0,
+        "elapsed_seconds": 0.0,
+    }
+
+
+def record_results(summary: dict, results: list, checkpoints: list):
+    """
+    Adds worker results to the summary and collects the checkpoints to write.
+
+    Args:
+        summary (dict): The summary being built.
+        results (list): Output of app.audit_chain.verify_segments.
+        checkpoints (list): Receives (user_id, chain_index, hash) for every user with newly verified events.
+    """
+    for user_id, verified, last_index, last_hash, errors in results:
+        summary["events_verified"] += verified
+        if verified:
+            checkpoints.append((user_id, last_index, last_hash))
+        if errors:
+            summary["users_failed"] += 1
+            for event_id, reason in errors:
+                add_mismatch(summary, user_id, event_id, reason)
+        else:
+            summary["users_verified"] += 1
+
+
+def add_summary(total: dict, summary: dict):
+    """Adds the summary of one shard to the total."""
+    for key in ("events_verified", "users_verified", "users_failed", "unsealed_events", "elapsed_seconds"):
+        total[key] += summary[key]
+    total["mismatch_count"] += summary["mismatch_count"] - len(summary["mismatches"])
+    for mismatch in summary["mismatches"]:
+        add_mismatch(total, mismatch["user_id"], mismatch["event_id"], mismatch["reason"])
+
+
+@contextmanager
+def worker_pool(workers: int = None, pool: ProcessPoolExecutor = None):
+    """
+    Provides a pool of worker processes for the verification: the given one, or a new one shut down on exit.
+
+    When the block fails or is cancelled, the new pool is shut down without waiting for the batches still
+    queued, which would block the event loop until they are hashed.
+
+    Args:
+        workers (int): Number of worker processes of a new pool (defaults to the number of CPUs).
+        pool (ProcessPoolExecutor): A pool shared with other verifications, left running on exit.
+
+    Yields:
+        ProcessPoolExecutor: The pool.
+    """
+    if pool:
+        yield pool
+        return
+    pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, mp_context=get_context("spawn"))
+    try:
+        yield pool
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+
+def add_mismatch(summary: dict, user_id: str, event_id, reason: str):
+    """Counts a mismatch and lists it if the report isn't full yet."""
+    summary["mismatch_count"] += 1
+    if len(summary["mismatches"]) < MAX_REPORTED_MISMATCHES:
+        summary["mismatches"].append({"user_id": user_id, "event_id": event_id, "reason": reason})
+
+
+def group_segments(rows, carry):
+    """
+    Groups streamed rows into per-user segments.
+
+    Args:
+        rows (list): Rows of STREAM_QUERY, ordered by user and chain index.
+        carry (tuple): The possibly incomplete segment of the last user of the previous batch, or None.
+
+    Returns:
+        list: (user_id, start_index, start_hash, rows) segments, starting with the carried one.
+    """
+    segments = [carry] if carry else []
+    for row in rows:
+        if not segments or segments[-1][0] != row["user_id"]:
+            segments.append((row["user_id"], row["start_index"], row["start_hash"], []))
+        segments[-1][3].append(tuple(row)[3:])
+    return segments
+
+
+async def verify_audit_chain(connection, full: bool = False, workers: int = None,
+                             batch_size: int = DEFAULT_BATCH_SIZE, connect=database.connect_to_db, pool=None) -> dict:
+    """
+    Verifies the audit event hash chains of all users in parallel.
+
+    Args:
+        connection (asyncpg.Connection): Connection used to stream the events.
+        full (bool): Whether to ignore the checkpoints and verify every event again.
+        workers (int): Number of worker processes (defaults to the number of CPUs, or the pool's size).
+        batch_size (int): Number of rows fetched and handed to a worker at a time.
+        connect (callable): Opens a second connection to the same database, for the checkpoints.
+        pool (ProcessPoolExecutor): Pool of worker processes to use (see worker_pool); one is started by default.
+
+    Returns:
+        dict: Summary with the number of verified events and users, and the mismatches found.
+    """
+    started = time.perf_counter()
+    summary = new_summary()
+    workers = pool._max_workers if pool else workers or os.cpu_count() or 1
+    loop = asyncio.get_running_loop()
+
+    summary["unsealed_events"] = await connection.fetchval(
+        "SELECT count(*) FROM audit_events WHERE chain_index IS NULL"  # Served by a partial index
+    )
+    if not full:
+        for row in await connection.fetch(BROKEN_CHECKPOINTS_QUERY):
+            summary["users_failed"] += 1
+            add_mismatch(summary, row["user_id"], None, f"verified event {row['chain_index']} is missing or was modified")
+
+    checkpoint_connection = await connect()  # Checkpoints are committed while the cursor is still open
+    try:
+        checkpoints = []
+        pending = set()
+
+        async def drain(return_when):
+            nonlocal pending
+            done, pending = await asyncio.wait(pending, return_when=return_when)
+            for future in done:
+                record_results(summary, future.result(), checkpoints)
+            if len(checkpoints) >= CHECKPOINT_FLUSH_SIZE or (checkpoints and not pending):
+                await checkpoint_connection.executemany(UPSERT_CHECKPOINT, checkpoints)
+                checkpoints.clear()
+
+        with worker_pool(workers, pool) as pool:
+            async with connection.transaction():  # Server-side cursors only live inside a transaction
+                cursor = await connection.cursor(STREAM_QUERY, GENESIS_HASH, full)
+                carry = None
+                while True:
+                    rows = await cursor.fetch(batch_size)
+                    segments = group_segments(rows, carry)
+                    # The last user may continue in the next batch; hold it back until it is complete
+                    carry = segments.pop() if rows and segments else None
+                    if segments:
+                        pending.add(loop.run_in_executor(pool, verify_segments, segments))
+                    if len(pending) >= workers * 2:
+                        await drain(asyncio.FIRST_COMPLETED)  # Backpressure: don't read faster than we hash
+                    if not rows:
+                        break
+            if pending:
+                await drain(asyncio.ALL_COMPLETED)
+    finally:
+        await database.close_db_connection(checkpoint_connection)
+
+    summary["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+async def seal_legacy_events(connection) -> int:
+    """
+    Seals the events written before the hash chain existed, for every user that still has some.
+
+    Args:
+        connection (asyncpg.Connection): Connection used to seal the events.
+
+    Returns:
+        int: Number of users whose events were sealed.
+    """
+    repository = AuditEventRepository(connection)
+    sealed = 0
+    while True:
+        user_ids = await connection.fetch(
+            "SELECT DISTINCT user_id FROM audit_events WHERE chain_index IS NULL LIMIT 1000"
+        )
+        if not user_ids:
+            return sealed
+        for row in user_ids:
+            await repository.seal_legacy_events(row["user_id"])
+            sealed += 1
+
+
+def new_verification_run(full: bool = False) -> VerificationRun:
+    """Creates the report of a new verification run, not saved yet."""
+    return VerificationRun(id=str(uuid.uuid4()), full=full, status=VerificationStatus.RUNNING, started_at=datetime.now())
+
+
+async def run_verification(repository, run: VerificationRun) -> VerificationRun:
+    """
+    Executes a verification run and saves its outcome.
+
+    Args:
+        repository (AuditEventRepository): Repository whose chains are verified (sharded ones verify every shard).
+        run (VerificationRun): The run to execute (already saved).
+
+    Returns:
+        VerificationRun: The run, completed or failed.
+    """
+    try:
+        run.summary = await repository.verify_chain(full=run.full)
+        run.status = VerificationStatus.COMPLETED
+    except asyncio.CancelledError:
+        raise  # Shutdown: the run stays "running"
+    except Exception as e:
+        logger.exception("Verification run %s failed", run.id)
+        run.status, run.error = VerificationStatus.FAILED, str(e)
+    run.finished_at = datetime.now()
+    await repository.save_verification_run(run)
+    return run
+
+
+@asynccontextmanager
+async def verification_repository():
+    """Provides a repository with its own connection, for runs that outlive the request starting them."""
+    # Imported here: these repositories use this module
+    from app.repositories.memory import InMemoryAuditEventRepository, get_memory_store
+    from app.repositories.sharded import sharded_repositories
+
+    if database.STORAGE_BACKEND == "memory":
+        yield InMemoryAuditEventRepository(get_memory_store())
+        return
+    if sharding.is_sharded():
+        async with sharded_repositories() as (_, events):
+            yield events
+        return
+
+    connection = await database.connect_to_db()
+    try:
+        yield AuditEventRepository(connection)
+    finally:
+        await database.close_db_connection(connection)
+
+
+def start_in_background(run: VerificationRun) -> asyncio.Task:
+    """
+    Executes a run in a background task of the current event loop.
+
+    Args:
+        run (VerificationRun): The run to execute (already saved).
+
+    Returns:
+        asyncio.Task: The task executing the run.
+    """
+    async def execute():
+        async with verification_repository() as repository:
+            await run_verification(repository, run)
+
+    task = asyncio.create_task(execute())
+    _running[run.id] = task
+    task.add_done_callback(lambda _: _running.pop(run.id, None))
+    return task
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Verify the hash chains of the audit events.")
+    parser.add_argument("--full", action="store_true", help="ignore checkpoints and verify every event")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="rows per batch")
+    parser.add_argument("--seal-legacy", action="store_true", help="chain events written before the hash chain existed first")
+    args = parser.parse_args()
+
+    shards = range(len(database.DATABASE_SHARD_URLS)) if sharding.is_sharded() else [None]
+    summary = new_summary()
+    with worker_pool(args.workers) as pool:
+        for shard in shards:  # Chains never span shards, so each one is verified on its own
+            connect = database.connect_to_db if shard is None else partial(database.connect_to_shard, shard)
+            connection = await connect()
+            try:
+                if args.seal_legacy:
+                    print(f"Sealed legacy events of {await seal_legacy_events(connection)} users"
+                          + ("" if shard is None else f" on shard {shard}"))
+                add_summary(summary, await verify_audit_chain(connection, full=args.full, batch_size=args.batch_size,
+                                                              connect=connect, pool=pool))
+            finally:
+                await database.close_db_connection(connection)
+    print(json.dumps(summary, indent=2, default=str))
+    raise SystemExit(1 if summary["mismatch_count"] else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
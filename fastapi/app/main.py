@@ -1,6 +1,74 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List
+
+_IMPORT_STARTED = time.perf_counter()  # Origin of the cold start measurement
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
 from app.api.endpoints import router
+from app import database
+from app.database import init_db, close_db
+from app.jobs import compact_audit_history
+from app.middleware.admission import AdmissionControlMiddleware
+from app.middleware.deadline import DeadlineMiddleware
+from app.middleware.first_request import FirstRequestTimerMiddleware
+from app.middleware.profiling import ProfilingMiddleware
+from app.middleware.query_route import QueryRouteMiddleware
+from app.middleware.read_your_writes import ReadYourWritesMiddleware
+from app.models.audit_event import AuditEvent, AuditEventAction
+from app.models.user_profile import UserProfile
+from app import metrics
+
+
+def warm_serializers():
+    """
+    Runs the response models through validation and JSON serialization once, so the
+    first request doesn't pay for any lazily built validator or serializer.
+    """
+    profile = UserProfile(id="warmup", name="Warm Up", email="warmup@example.com", is_deleted=False)
+    event = AuditEvent(
+        id="warmup",
+        user_id="warmup",
+        action=AuditEventAction.CREATE_PROFILE,
+        timestamp=datetime.now(),
+        resource="user_profile",
+        changes={"name": {"old": None, "new": "Warm Up"}},
+    )
+    for model_type, sample in ((UserProfile, profile), (AuditEvent, event)):
+        adapter = TypeAdapter(List[model_type])
+        adapter.dump_json(adapter.validate_python([sample.model_dump()]))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Application lifespan: applies the schema, opens and warms the connection pool and builds
+    the serializers before the worker reports itself as ready.
+    """
+    warmup_started = time.perf_counter()
+    await init_db()
+    warm_serializers()
+    now = time.perf_counter()
+    metrics.set_gauge("startup.warmup_seconds", now - warmup_started)
+    metrics.set_gauge("startup.cold_start_seconds", now - _IMPORT_STARTED)
+    app.state.ready = True
+
+    compaction = None
+    if compact_audit_history.COMPACTION_INTERVAL_SECONDS > 0 and database.STORAGE_BACKEND != "memory":
+        compaction = asyncio.create_task(compact_audit_history.run_periodically())  # Background history compaction
+
+    yield
+
+    app.state.ready = False
+    if compaction is not None:
+        compaction.cancel()
+    await close_db()
+
 
 # Initialize the FastAPI application with metadata
 app = FastAPI(
@@ -8,8 +76,32 @@ app = FastAPI(
     description="This API manages user audit events, providing functionality to track changes and actions performed on user profiles.",
     version="1.0.0",
     contact={"name": "Joao Costa", "email": "jgabrielzcost@gmail.com"},
-    license_info={"name": "MIT License"}
+    license_info={"name": "MIT License"},
+    lifespan=lifespan
 )
+app.state.ready = False  # Set by the lifespan once warm-up has finished
+
+# Samples the stacks of requests that ask to be profiled, or of a random fraction of them.
+# Added first so it wraps nothing but the routing and the handlers.
+app.add_middleware(ProfilingMiddleware)
+
+# Measures the latency of the first API request served by this worker
+app.add_middleware(FirstRequestTimerMiddleware)
+
+# Attributes the statements recorded by the slow query log to the request's route
+app.add_middleware(QueryRouteMiddleware)
+
+# Returns the WAL position of each write so the client's next reads can be served by caught-up replicas
+app.add_middleware(ReadYourWritesMiddleware)
+
+# Deadlines: per-route defaults (or X-Request-Timeout), passed on as statement_timeout; handlers are
+# cancelled with 504 when the deadline passes and dropped when the client disconnects (499).
+# Added before admission control, so the deadline starts once the request is admitted.
+app.add_middleware(DeadlineMiddleware)
+
+# Admission control: per-route concurrency budgets that shed load with 503 + Retry-After
+# before the database runs out of connections. Added before CORS so rejections still carry CORS headers.
+app.add_middleware(AdmissionControlMiddleware)
 
 # CORS (Cross-Origin Resource Sharing) configuration
 app.add_middleware(
@@ -33,3 +125,29 @@ async def read_root():
     """
     return {"message": "Welcome to the User Audit API!"}
 
+@app.get("/ready")
+async def read_readiness():
+    """
+    Readiness endpoint: reports ready only after the startup warm-up has finished.
+
+    Returns:
+        dict: The readiness status and the cold start measurements (503 while warming up).
+    """
+    snapshot = metrics.snapshot()["gauges"]
+    body = {
+        "status": "ready" if app.state.ready else "starting",
+        "cold_start_seconds": snapshot.get("startup.cold_start_seconds"),
+        "warmup_seconds": snapshot.get("startup.warmup_seconds"),
+        "first_request_seconds": snapshot.get("startup.first_request_seconds"),
+    }
+    return JSONResponse(body, status_code=200 if app.state.ready else 503)
+
+@app.get("/metrics")
+async def read_metrics():
+    """
+    Endpoint that exposes the in-process counters and gauges (admission control, load shedding, ...).
+
+    Returns:
+        dict: A JSON object with the current counters and gauges.
+    """
+    return metrics.snapshot()
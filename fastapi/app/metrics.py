@@ -0,0 +1,50 @@
+from collections import defaultdict
+from threading import Lock
+from typing import Dict
+
+# In-process counters and gauges, keyed by metric name
+_counters: Dict[str, int] = defaultdict(int)
+_gauges: Dict[str, float] = {}
+_lock = Lock()  # Guards updates coming from worker threads (e.g. the profiler or process pools)
+
+
+def increment(name: str, value: int = 1):
+    """
+    Increments a counter.
+
+    Args:
+        name (str): Name of the counter, e.g. "admission.shed.read".
+        value (int): Amount to add to the counter.
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value: float):
+    """
+    Sets a gauge to the given value.
+
+    Args:
+        name (str): Name of the gauge, e.g. "admission.active.read".
+        value (float): Current value of the gauge.
+    """
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot() -> dict:
+    """
+    Returns a copy of all counters and gauges.
+
+    Returns:
+        dict: A dictionary with "counters" and "gauges" entries.
+    """
+    with _lock:
+        return {"counters": dict(_counters), "gauges": dict(_gauges)}
+
+
+def reset():
+    """Clears all counters and gauges (used by tests)."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import re
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from app import metrics
+
+
+class Overloaded(Exception):
+    """Raised when a budget cannot admit a request before its deadline."""
+
+
+class Budget:
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float, retry_after: int = 1):
+        """
+        Initializes a concurrency budget shared by a group of routes.
+
+        Args:
+            name (str): Name of the budget, used in metrics.
+            max_concurrency (int): Maximum number of requests executing at the same time.
+            max_queue (int): Maximum number of requests waiting for a free slot.
+            queue_timeout (float): Maximum time (seconds) a request may wait in the queue.
+            retry_after (int): Value of the Retry-After header sent when the budget is saturated.
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0  # Requests currently holding a slot
+        self.waiters = deque()  # Futures of the requests waiting for a slot, in arrival order
+
+    async def acquire(self):
+        """
+        Acquires a slot, waiting in the bounded queue if necessary.
+
+        Raises:
+            Overloaded: If the queue is full or the wait exceeds the queue timeout.
+        """
+        if self.active < self.max_concurrency and not self.waiters:
+            self.active += 1
+            return
+
+        if len(self.waiters) >= self.max_queue:
+            raise Overloaded(self.name)  # Shed immediately instead of piling up work
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            raise Overloaded(self.name)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        # The releasing request transferred its slot to us, so "active" is unchanged
+
+    def release(self):
+        """Releases a slot, handing it directly to the oldest waiter if there is one."""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def _abandon(self, waiter):
+        """Removes a waiter that gave up, returning its slot if one was handed over meanwhile."""
+        if waiter.done() and not waiter.cancelled():
+            self.release()
+            return
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+
+# Budgets used when none are given explicitly. The sum of the concurrency limits should stay
+# below Postgres' max_connections (100 by default), since every admitted request holds a connection.
+DEFAULT_BUDGETS = {
+    "read": Budget(
+        "read",
+        max_concurrency=int(os.getenv("ADMISSION_READ_CONCURRENCY", "32")),
+        max_queue=int(os.getenv("ADMISSION_READ_QUEUE", "64")),
+        queue_timeout=float(os.getenv("ADMISSION_READ_QUEUE_TIMEOUT", "0.5")),
+    ),
+    "write": Budget(
+        "write",
+        max_concurrency=int(os.getenv("ADMISSION_WRITE_CONCURRENCY", "16")),
+        max_queue=int(os.getenv("ADMISSION_WRITE_QUEUE", "32")),
+        queue_timeout=float(os.getenv("ADMISSION_WRITE_QUEUE_TIMEOUT", "1.0")),
+    ),
+    "expensive": Budget(
+        "expensive",
+        max_concurrency=int(os.getenv("ADMISSION_EXPENSIVE_CONCURRENCY", "4")),
+        max_queue=int(os.getenv("ADMISSION_EXPENSIVE_QUEUE", "8")),
+        queue_timeout=float(os.getenv("ADMISSION_EXPENSIVE_QUEUE_TIMEOUT", "2.0")),
+        retry_after=5,
+    ),
+}
+
+# Routes that scan whole tables or run multi-statement rollbacks: (method, path pattern, budget name)
+DEFAULT_ROUTE_BUDGETS: List[Tuple[str, str, str]] = [
+    ("GET", r"^/api/v1/users/profile/$", "expensive"),
+    ("GET", r"^/api/v1/users/profiles/active/$", "expensive"),
+    ("GET", r"^/api/v1/audit/events/$", "expensive"),
+    ("POST", r"^/api/v1/audit/events/rollback/[^/]+$", "expensive"),
+    ("POST", r"^/api/v1/audit/verify/$", "expensive"),
+    ("POST", r"^/api/v1/admin/import/profiles/$", "expensive"),
+    ("POST", r"^/api/v1/users/profiles/batch/$", "read"),  # Reads that take their ids in the body
+    ("POST", r"^/api/v1/audit/events/batch/$", "read"),
+]
+
+
+class AdmissionControlMiddleware:
+    def __init__(self, app, budgets: Optional[Dict[str, Budget]] = None,
+                 route_budgets: Optional[List[Tuple[str, str, str]]] = None, prefix: str = "/api/"):
+        """
+        ASGI middleware that limits how many requests run concurrently per budget.
+
+        Requests wait in a bounded queue for a free slot; when the queue is full or the wait
+        exceeds its deadline, the request is rejected right away with 503 and a Retry-After header.
+
+        Args:
+            app: The ASGI application to wrap.
+            budgets (dict): Budgets by name. Must contain "read" and "write".
+            route_budgets (list): (method, path regex, budget name) overrides for specific routes.
+            prefix (str): Only paths starting with this prefix are subject to admission control.
+        """
+        self.app = app
+        self.budgets = budgets if budgets is not None else DEFAULT_BUDGETS
+        self.route_budgets = [
+            (method, re.compile(pattern), name)
+            for method, pattern, name in (route_budgets if route_budgets is not None else DEFAULT_ROUTE_BUDGETS)
+        ]
+        self.prefix = prefix
+
+    def classify(self, method: str, path: str) -> Optional[Budget]:
+        """
+        Returns the budget that applies to a request, or None if it is not limited.
+
+        Args:
+            method (str): HTTP method of the request.
+            path (str): Path of the request.
+        """
+        if not path.startswith(self.prefix):
+            return None  # Root, docs, health checks and metrics are never shed
+        for route_method, pattern, name in self.route_budgets:
+            if route_method == method and pattern.match(path):
+                return self.budgets[name]
+        if method in ("GET", "HEAD", "OPTIONS"):
+            return self.budgets["read"]
+        return self.budgets["write"]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        budget = self.classify(scope["method"], scope["path"])
+        if budget is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await budget.acquire()
+        except Overloaded:
+            metrics.increment(f"admission.shed.{budget.name}")
+            await self._reject(budget, send)
+            return
+
+        metrics.increment(f"admission.admitted.{budget.name}")
+        metrics.set_gauge(f"admission.active.{budget.name}", budget.active)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            budget.release()
+            metrics.set_gauge(f"admission.active.{budget.name}", budget.active)
+
+    @staticmethod
+    async def _reject(budget: Budget, send):
+        """Sends a 503 response telling the client when to retry."""
+        body = json.dumps({"detail": "Service overloaded, please retry later."}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(budget.retry_after).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from typing import List, Optional, Tuple
+
+import asyncpg
+
+from app import deadlines, metrics
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_HEADER = b"x-request-timeout"  # Per-request override of the deadline, in seconds
+CLIENT_CLOSED_REQUEST = 499  # Status logged for requests abandoned by their client (nginx convention)
+
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "10"))  # Deadline of the routes not listed below
+MAX_REQUEST_TIMEOUT = float(os.getenv("MAX_REQUEST_TIMEOUT_SECONDS", "600"))  # Upper bound of the X-Request-Timeout header
+
+# Routes that legitimately take longer: (method, path pattern, seconds)
+DEFAULT_ROUTE_TIMEOUTS: List[Tuple[str, str, float]] = [
+    ("GET", r"^/api/v1/users/profile/$", 30),
+    ("GET", r"^/api/v1/users/profiles/active/$", 30),
+    ("GET", r"^/api/v1/users/profiles/changes/$", 30),
+    ("GET", r"^/api/v1/audit/events/$", 30),
+    ("GET", r"^/api/v1/audit/analytics/$", 30),
+    ("GET", r"^/api/v1/audit/changes/$", 30),
+    ("POST", r"^/api/v1/admin/import/profiles/$", 600),
+]
+
+
+class DeadlineMiddleware:
+    def __init__(self, app, default_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+                 route_timeouts: Optional[List[Tuple[str, str, float]]] = None,
+                 max_timeout: float = MAX_REQUEST_TIMEOUT, prefix: str = "/api/"):
+        """
+        ASGI middleware that bounds the time a request may run, and stops the work of abandoned requests.
+
+        Every request gets a deadline: the default of its route, or the X-Request-Timeout header (seconds,
+        up to max_timeout). It is stored in app.deadlines, so the request's connections get it as their
+        statement_timeout. The handler runs in its own task, cancelled when the deadline passes (504) or the
+        client disconnects (499, only logged); cancelling it cancels the statement it is waiting for.
+        Statements stopped by the statement_timeout also end in a 504.
+
+        Args:
+            app: The ASGI application to wrap.
+            default_timeout (float): Deadline (seconds) of the routes without their own.
+            route_timeouts (list): (method, path regex, seconds) deadlines of specific routes.
+            max_timeout (float): Largest deadline a client may ask for.
+            prefix (str): Only paths starting with this prefix get a deadline.
+        """
+        self.app = app
+        self.default_timeout = default_timeout
+        self.route_timeouts = [
+            (method, re.compile(pattern), seconds)
+            for method, pattern, seconds in (route_timeouts if route_timeouts is not None else DEFAULT_ROUTE_TIMEOUTS)
+        ]
+        self.max_timeout = max_timeout
+        self.prefix = prefix
+
+    def timeout_for(self, scope) -> float:
+        """
+        Returns the deadline (in seconds from now) of a request.
+
+        Args:
+            scope (dict): The ASGI scope of the request.
+
+        Raises:
+            ValueError: If the X-Request-Timeout header isn't a positive number of seconds.
+        """
+        for name, value in scope.get("headers", []):
+            if name == TIMEOUT_HEADER:
+                try:
+                    seconds = float(value)
+                except ValueError:
+                    seconds = float("nan")
+                if not 0 < seconds < float("inf"):
+                    raise ValueError("X-Request-Timeout must be a positive number of seconds.")
+                return min(seconds, self.max_timeout)
+        for method, pattern, seconds in self.route_timeouts:
+            if method == scope["method"] and pattern.match(scope["path"]):
+                return seconds
+        return self.default_timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            timeout = self.timeout_for(scope)
+        except ValueError as e:
+            await _send_error(send, 400, str(e))
+            return
+
+        loop = asyncio.get_running_loop()
+        token = deadlines.current_deadline.set(loop.time() + timeout)
+        response = {"started": False, "complete": False}
+        disconnected = asyncio.Event()
+        messages = asyncio.Queue(maxsize=1)  # Request body chunks are read ahead one at a time
+
+        async def watch_client():
+            # Owns `receive`, so a disconnect is seen even while the handler isn't reading
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect" and not response["complete"]:
+                    disconnected.set()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    return
+
+        async def tracked_send(message):
+            if message["type"] == "http.response.start":
+                response["started"] = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                response["complete"] = True
+            await send(message)
+
+        handler = asyncio.create_task(self.app(scope, messages.get, tracked_send))
+        watcher = asyncio.create_task(watch_client())
+        disconnect = asyncio.create_task(disconnected.wait())
+        try:
+            await asyncio.wait({handler, disconnect}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if handler.done():
+                try:
+                    handler.result()
+                except asyncpg.QueryCanceledError:
+                    await self._timed_out(scope, send, response, "statement")  # Stopped by the statement_timeout
+                return
+
+            handler.cancel()
+            try:
+                await handler
+            except (asyncio.CancelledError, Exception):
+                pass  # The work is abandoned; whatever it raised while being cancelled doesn't matter
+            if disconnected.is_set():
+                metrics.increment("deadline.client_closed")
+                logger.info("%s %s abandoned by the client", scope["method"], scope["path"])
+                if not response["started"]:
+                    await _send_error(send, CLIENT_CLOSED_REQUEST, "Client closed request.")  # Dropped by the server, but logged
+            else:
+                await self._timed_out(scope, send, response, "request")
+        finally:
+            watcher.cancel()
+            disconnect.cancel()
+            deadlines.current_deadline.reset(token)
+
+    @staticmethod
+    async def _timed_out(scope, send, response: dict, cause: str):
+        """Counts a request that ran past its deadline and answers 504 if nothing was sent yet."""
+        metrics.increment("deadline.exceeded")
+        metrics.increment(f"deadline.exceeded.{cause}")
+        logger.warning("%s %s exceeded its deadline (%s)", scope["method"], scope["path"], cause)
+        if not response["started"]:
+            await _send_error(send, 504, "Request deadline exceeded.")
+
+
+async def _send_error(send, status: int, detail: str):
+    """Sends a JSON error response."""
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,32 @@
+import time
+
+from app import metrics
+
+
+class FirstRequestTimerMiddleware:
+    def __init__(self, app, prefix: str = "/api/"):
+        """
+        ASGI middleware that records how long the first API request of the worker took.
+
+        The value is published as the "startup.first_request_seconds" gauge, next to the
+        cold start measurements recorded by the application lifespan.
+
+        Args:
+            app: The ASGI application to wrap.
+            prefix (str): Only requests whose path starts with this prefix are measured.
+        """
+        self.app = app
+        self.prefix = prefix
+        self.measured = False
+
+    async def __call__(self, scope, receive, send):
+        if self.measured or scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        self.measured = True
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            metrics.set_gauge("startup.first_request_seconds", time.perf_counter() - started)
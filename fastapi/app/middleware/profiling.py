@@ -0,0 +1,80 @@
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from app import profiling
+from app.models.profiling import RequestProfile
+
+
+class ProfilingMiddleware:
+    def __init__(self, app, prefix: str = "/api/"):
+        """
+        ASGI middleware that runs the sampling profiler on selected requests (see app/profiling.py).
+
+        A request is profiled when its X-Profile header or "profile" query parameter carries the
+        privileged token, or when it is drawn by the route's sampling rate. Its response then carries an
+        X-Profile-Id header naming the stored profile.
+
+        Args:
+            app: The ASGI application to wrap.
+            prefix (str): Only paths starting with this prefix can be profiled.
+        """
+        self.app = app
+        self.prefix = prefix
+
+    def trigger(self, scope) -> str:
+        """Returns why a request is profiled ("requested" or "sampled"), or an empty string if it isn't."""
+        if not scope["path"].startswith(self.prefix):
+            return ""
+        token = dict(scope["headers"]).get(b"x-profile")
+        if token is None:
+            token = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("profile", [None])[0]
+        else:
+            token = token.decode("latin-1")
+        if profiling.is_authorized(token):
+            return "requested"
+        return "sampled" if profiling.should_sample(scope["method"], scope["path"]) else ""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trigger = self.trigger(scope)
+        if not trigger or not profiling.try_acquire():
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = str(uuid.uuid4())
+        status_code = None
+
+        async def send_with_profile_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile_id.encode())]}
+            await send(message)
+
+        coroutine = self.app(scope, receive, send_with_profile_id)
+        profiler = profiling.Profiler(coroutine)
+        started_at, started = datetime.now(), time.perf_counter()
+        profiler.start()
+        try:
+            await coroutine
+        finally:
+            profiler.stop()
+            profiling.release()
+            route = scope.get("route")  # Set by FastAPI's router once the request is matched
+            profiling.save(RequestProfile(
+                id=profile_id,
+                method=scope["method"],
+                path=scope["path"],
+                route=scope.get("root_path", "") + route.path if route is not None else None,
+                trigger=trigger,
+                status_code=status_code,
+                started_at=started_at,
+                duration_ms=round((time.perf_counter() - started) * 1000, 3),
+                samples=profiler.samples,
+                interval_ms=profiler.interval * 1000,
+            ), profiler.folded())
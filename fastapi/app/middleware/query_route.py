@@ -0,0 +1,27 @@
+from app import query_log
+
+
+class QueryRouteMiddleware:
+    def __init__(self, app):
+        """
+        ASGI middleware that makes the current request visible to the slow query log.
+
+        The request's scope is stored in a context variable for the duration of the request;
+        queries logged while it runs are attributed to its method and route template
+        (e.g. "GET /api/v1/users/{user_id}/profile/"), see app/query_log.py.
+
+        Args:
+            app: The ASGI application to wrap.
+        """
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = query_log.current_request.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            query_log.current_request.reset(token)
@@ -0,0 +1,37 @@
+LSN_HEADER = b"x-last-write-lsn"
+LSN_COOKIE = "last_write_lsn"
+LSN_COOKIE_MAX_AGE = 300  # Replicas lagging more than this are a problem of their own
+
+
+class ReadYourWritesMiddleware:
+    def __init__(self, app):
+        """
+        ASGI middleware that returns the WAL position reached by a write request to the client.
+
+        The repository dependencies store it in request.state.last_write_lsn after a write; it is sent
+        back both as the X-Last-Write-LSN header (for API clients) and the last_write_lsn cookie (for
+        browsers), so the client's next reads are only served by replicas that have replayed it.
+
+        Args:
+            app: The ASGI application to wrap.
+        """
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_lsn(message):
+            if message["type"] == "http.response.start":
+                lsn = scope.get("state", {}).get("last_write_lsn")
+                if lsn:
+                    # "/" is a valid cookie-octet, so the LSN is sent unquoted
+                    cookie = f"{LSN_COOKIE}={lsn}; Max-Age={LSN_COOKIE_MAX_AGE}; Path=/; HttpOnly; SameSite=Lax"
+                    headers = list(message.get("headers", []))
+                    headers.append((LSN_HEADER, lsn.encode()))
+                    headers.append((b"set-cookie", cookie.encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_lsn)
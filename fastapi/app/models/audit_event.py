@@ -1,6 +1,6 @@
 from datetime import datetime
 from pydantic import BaseModel, Field
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional
 from enum import Enum
 
 # Enum class to define the possible actions for audit events
@@ -11,6 +11,10 @@ class AuditEventAction(str, Enum):
     ROLLBACK_DELETE = "ROLLBACK_DELETE"  # Action for rolling back a delete operation
     ROLLBACK_EVENT = "ROLLBACK_EVENT"  # Action for rolling back any event
     RESTORE_PROFILE = "RESTORE_PROFILE"  # Action for restoring a deleted user profile
+    PURGE_PROFILES = "PURGE_PROFILES"  # Action for hard deleting long soft-deleted profiles (system event)
+
+# user_id of the events recorded by the system itself (e.g. purges) rather than for one profile
+SYSTEM_USER_ID = "00000000-0000-0000-0000-000000000000"
 
 # Base model for audit events, containing common attributes
 class AuditEventBase(BaseModel):
@@ -31,6 +35,52 @@ class AuditEventCreate(AuditEventBase):
 # Model representing a complete audit event with an ID
 class AuditEvent(AuditEventBase):
     id: str = Field(..., description="Unique ID of the audit event")  # Unique identifier for the audit event
+    chain_index: Optional[int] = Field(None, description="Position of the event in the user's hash chain")  # 1 for the first event
+    prev_hash: Optional[str] = Field(None, description="Hash of the previous event of the same user")  # Links the event to its predecessor
+    hash: Optional[str] = Field(None, description="SHA-256 over prev_hash and the event content")  # Tamper-evidence seal
 
     class Config:
-        from_attributes = True  # Allows the model to be populated from attributes
\ No newline at end of file
+        from_attributes = True  # Allows the model to be populated from attributes
+
+# Model for the compaction checkpoint of a user's audit history: the profile state after
+# the oldest events, which were moved to the archive
+class AuditCheckpoint(BaseModel):
+    user_id: str  # ID of the user the checkpoint belongs to
+    chain_index: int = Field(..., description="Chain index of the last event folded into the checkpoint")
+    event_count: int = Field(..., description="Number of events folded into the checkpoint")
+    up_to: datetime = Field(..., description="Timestamp of the last event folded into the checkpoint")
+    state: Dict[str, Any] = Field(..., description="Profile state after the folded events: name, email, is_deleted")
+
+    class Config:
+        from_attributes = True  # Allows the model to be populated from attributes
+
+# Model for a user's audit history: the checkpoint (if the history was compacted) followed by the recent events
+class AuditHistory(BaseModel):
+    checkpoint: Optional[AuditCheckpoint] = None  # State before the first event in "events"
+    events: List[AuditEvent]  # Events after the checkpoint, oldest first
+
+# Model for one page of audit events, paginated with an opaque keyset cursor
+class AuditEventPage(BaseModel):
+    events: List[AuditEvent]  # Events of the page, newest first
+    next_cursor: Optional[str] = Field(None, description="Cursor of the next page; null on the last page")
+
+# Enum class to define the time buckets audit analytics can be computed for
+class AuditBucketSize(str, Enum):
+    HOUR = "hour"  # One bucket per hour
+    DAY = "day"  # One bucket per day
+
+# Model for the number of audit events of one group in one time bucket
+class AuditBucketCount(BaseModel):
+    bucket: datetime  # Start of the time bucket
+    action: Optional[str] = None  # Set when the counts are grouped by action
+    resource: Optional[str] = None  # Set when the counts are grouped by resource
+    count: int  # Number of audit events
+
+# Model for time-bucketed audit event counts
+class AuditAnalytics(BaseModel):
+    bucket_size: AuditBucketSize  # Size of the time buckets
+    start: datetime = Field(..., description="Start of the first bucket")
+    end: datetime = Field(..., description="End of the last bucket (exclusive)")
+    group_by: List[str]  # Columns the counts are grouped by
+    buckets: List[AuditBucketCount]  # Counts ordered by bucket; empty groups are omitted
+    cached_buckets: int = Field(..., description="Number of closed buckets served from the cache")
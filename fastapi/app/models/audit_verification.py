@@ -0,0 +1,23 @@
+from datetime import datetime
+from enum import Enum
+from pydantic import BaseModel, Field
+from typing import Optional
+
+# Enum class describing the state of a verification of the audit event hash chains
+class VerificationStatus(str, Enum):
+    RUNNING = "running"  # The chains are being verified (or the process stopped without finishing)
+    COMPLETED = "completed"  # Every chain was verified; the summary lists the mismatches found
+    FAILED = "failed"  # The verification stopped on an error
+
+# Model for the report of a verification run
+class VerificationRun(BaseModel):
+    id: str = Field(..., description="Unique ID of the verification run")  # Used to follow the run
+    full: bool = False  # Whether the checkpoints were ignored and every event verified again
+    status: VerificationStatus  # Current state of the run
+    summary: Optional[dict] = None  # Events and users verified and mismatches found, once completed
+    error: Optional[str] = None  # Why the run failed
+    started_at: datetime  # When the run was started
+    finished_at: Optional[datetime] = None  # When the run completed or failed
+
+    class Config:
+        from_attributes = True  # Allows the model to be populated from attributes
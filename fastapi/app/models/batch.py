@@ -0,0 +1,30 @@
+from enum import Enum
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from app.models.audit_event import AuditEvent
+from app.models.user_profile import UserProfile
+
+# Maximum number of ids accepted by the batch lookup endpoints
+MAX_BATCH_SIZE = 500
+
+# Enum class describing the outcome of looking up one id in a batch
+class LookupStatus(str, Enum):
+    FOUND = "found"  # The record exists
+    MISSING = "missing"  # No record has this id
+    DELETED = "deleted"  # The profile exists but was soft deleted
+
+# Request body of the batch lookup endpoints
+class BatchGetRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE, description="IDs to look up, answered in this order")
+
+# Result of looking up one profile id
+class ProfileLookup(BaseModel):
+    id: str  # The requested ID
+    status: LookupStatus  # Whether the profile was found, is missing or was deleted
+    profile: Optional[UserProfile] = None  # Only set when the profile was found
+
+# Result of looking up one audit event id
+class AuditEventLookup(BaseModel):
+    id: str  # The requested ID
+    status: LookupStatus  # Whether the audit event was found or is missing
+    event: Optional[AuditEvent] = None  # Only set when the audit event was found
@@ -0,0 +1,33 @@
+from datetime import datetime
+from enum import Enum
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional
+
+# Enum class describing the state of a bulk profile import
+class ProfileImportStatus(str, Enum):
+    RUNNING = "running"  # The file is being staged, validated or merged
+    COMPLETED = "completed"  # Every valid row was imported
+    FAILED = "failed"  # Nothing was imported (malformed file or database error)
+
+# Model for a row of an import file that was not imported
+class ImportReject(BaseModel):
+    row: int  # Position of the row in the file, not counting the header (1 = first data row)
+    name: Optional[str] = None
+    email: Optional[str] = None
+    reason: str  # Why the row was rejected
+
+# Model for the progress report of a bulk profile import
+class ProfileImport(BaseModel):
+    id: str = Field(..., description="Unique ID of the import")
+    filename: Optional[str] = None  # Name of the uploaded or imported file
+    status: ProfileImportStatus  # Current state of the import
+    phase: str = "staging"  # staging, validating, merging or done
+    bytes_read: int = 0  # Bytes of the file streamed so far
+    rows: int = 0  # Data rows staged
+    imported: int = 0  # Profiles created
+    rejected: int = 0  # Rows not imported
+    rejected_by_reason: Dict[str, int] = {}  # Rejected rows per reason
+    rejects: List[ImportReject] = []  # The first rejected rows, in file order
+    error: Optional[str] = None  # Why the import failed
+    started_at: datetime  # When the import was started
+    finished_at: Optional[datetime] = None  # When the import completed or failed
@@ -0,0 +1,16 @@
+from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import Optional
+
+# Model for a request captured by the sampling profiler (see app/profiling.py); its stacks are served separately
+class RequestProfile(BaseModel):
+    id: str = Field(..., description="Unique ID of the profile, also sent in the X-Profile-Id response header")
+    method: str  # HTTP method of the request
+    path: str  # Path of the request
+    route: Optional[str] = Field(None, description="Route template the request matched")
+    trigger: str = Field(..., description='"requested" (header or query parameter) or "sampled" (random fraction)')
+    status_code: Optional[int] = None  # Status of the response (None if the handler raised)
+    started_at: datetime  # When the request started
+    duration_ms: float  # Wall time of the request in milliseconds
+    samples: int  # Stacks sampled while the request ran
+    interval_ms: float  # Sampling interval in milliseconds
@@ -0,0 +1,39 @@
+from datetime import datetime
+from enum import Enum
+from pydantic import BaseModel, Field, computed_field
+from typing import Optional
+
+# Enum class describing the state of a purge run
+class PurgeStatus(str, Enum):
+    RUNNING = "running"  # Chunks are being deleted (or the process stopped without finishing)
+    COMPLETED = "completed"  # Every profile deleted before the cutoff was purged
+    FAILED = "failed"  # A chunk failed; the run can be resumed
+
+# Request body for starting a purge of soft-deleted profiles
+class PurgeRequest(BaseModel):
+    older_than_days: int = Field(30, ge=0, description="Purge profiles soft deleted more than this many days ago")
+    chunk_size: int = Field(500, ge=1, le=10_000, description="Profiles hard deleted per transaction")
+
+# Model for the progress report of a purge run
+class PurgeRun(BaseModel):
+    id: str = Field(..., description="Unique ID of the purge run")  # Used to follow and resume the run
+    cutoff: datetime = Field(..., description="Profiles soft deleted before this time are purged")
+    chunk_size: int  # Profiles hard deleted per transaction
+    status: PurgeStatus  # Current state of the run
+    purged: int = 0  # Profiles hard deleted so far
+    chunks: int = 0  # Chunks committed so far
+    cursor_deleted_at: Optional[datetime] = None  # Keyset position: (deleted_at, id) of the last purged profile
+    cursor_id: Optional[str] = None
+    error: Optional[str] = None  # Why the run failed
+    started_at: datetime  # When the run was started
+    updated_at: datetime  # When the last chunk was committed
+    finished_at: Optional[datetime] = None  # When the run completed
+
+    @computed_field
+    @property
+    def resumable(self) -> bool:
+        """Whether the run still has work left that resuming it would pick up."""
+        return self.status != PurgeStatus.COMPLETED
+
+    class Config:
+        from_attributes = True  # Allows the model to be populated from attributes
@@ -0,0 +1,14 @@
+from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+# Model for a statement recorded by the slow query log (see app/query_log.py)
+class SlowQuery(BaseModel):
+    timestamp: datetime  # When the statement finished
+    route: Optional[str] = Field(None, description="Method and route of the request that issued the statement")
+    statement: str  # The statement, with its $n placeholders
+    params: List[str] = Field(..., description="Types of the parameters; their values are never recorded")
+    elapsed_ms: float  # Execution time in milliseconds
+    error: Optional[str] = None  # Exception raised by the statement, if any
+    plan: Optional[str] = Field(None, description="Captured EXPLAIN output, for sampled statements")
+    plan_error: Optional[str] = None  # Why the plan couldn't be captured
@@ -1,5 +1,7 @@
+from datetime import datetime
 from pydantic import BaseModel, EmailStr, Field
-from typing import Optional
+from typing import List, Optional
+from app.models.audit_event import AuditEvent
 
 # Base model for user profiles, containing common attributes
 class UserProfileBase(BaseModel):
@@ -14,6 +16,33 @@ class UserProfileCreate(UserProfileBase):
 class UserProfile(UserProfileBase):
     id: str = Field(..., description="Unique ID of the user")  # Unique identifier for the user
     is_deleted: bool = Field(..., description="Indicates if the user has been deleted")  # Status of the user's profile
+    deleted_at: Optional[datetime] = Field(None, description="When the profile was soft deleted")  # Used by the purge job
     
     class Config:
-        from_attributes = True  # Allows the model to be populated from attributes
\ No newline at end of file
+        from_attributes = True  # Allows the model to be populated from attributes
+
+# Activity that profile listings can embed with include= (comma separated)
+PROFILE_LIST_INCLUDES = ("last_event", "event_count")
+
+# A profile of a listing, with the activity asked for; fields that weren't asked for are left out of the response
+class ProfileListItem(UserProfile):
+    last_event: Optional[AuditEvent] = Field(None, description="Most recent audit event of the user (include=last_event)")
+    event_count: Optional[int] = Field(None, description="Number of audit events of the user, compacted ones included (include=event_count)")
+
+# One entry of the delta sync feed: the current state of a changed profile. Deleted profiles are tombstones:
+# soft deleted ones keep their fields, purged ones only have their ID.
+class ProfileChange(BaseModel):
+    id: str = Field(..., description="Unique ID of the user")
+    change_seq: int = Field(..., description="Change sequence of the row; a later change of the profile has a higher one")
+    updated_at: datetime  # When the profile was last changed (or purged)
+    is_deleted: bool  # The profile is deleted (soft deleted or purged)
+    purged: bool = Field(False, description="The profile was hard deleted by the purge job")
+    name: Optional[str] = None  # The name of the user (None once purged)
+    email: Optional[str] = None  # The email address of the user (None once purged)
+    deleted_at: Optional[datetime] = None  # When the profile was soft deleted
+
+# A page of the delta sync feed
+class ProfileChangePage(BaseModel):
+    changes: List[ProfileChange]  # Changed profiles, in change order
+    cursor: str = Field(..., description="Pass as `since` to get the changes after this page")
+    has_more: bool  # Whether more changes can be fetched right away
@@ -0,0 +1,133 @@
+import base64
+import json
+from datetime import datetime
+from typing import List, Tuple
+from app import ids
+
+# Opaque keyset pagination cursors.
+#
+# A cursor encodes the sort key of the last row of a page, e.g. (timestamp, id); the next page
+# continues strictly after it. Clients must treat cursors as opaque strings.
+
+NO_ID = "00000000-0000-0000-0000-000000000000"  # Sorts before every other uuid
+
+
+def _encode_payload(payload) -> str:
+    """Encodes a JSON value as a URL-safe string."""
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def _decode_payload(cursor: str):
+    """Decodes a string produced by _encode_payload, raising ValueError if it is malformed."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _check_key(key, value_type) -> Tuple:
+    """Checks that a decoded sort key is a (value, id) pair, raising ValueError otherwise."""
+    if not isinstance(key, list) or len(key) != 2 or not isinstance(key[0], value_type) or isinstance(key[0], bool):
+        raise ValueError("Invalid cursor")
+    if not ids.is_valid(key[1]):
+        raise ValueError("Invalid cursor")  # Row ids are uuids
+    return key[0], str(key[1])
+
+
+def encode_cursor(timestamp: datetime, row_id: str) -> str:
+    """
+    Encodes the (timestamp, id) sort key of the last row of a page.
+
+    Args:
+        timestamp (datetime): The timestamp of the row.
+        row_id (str): The ID of the row.
+
+    Returns:
+        str: The URL-safe cursor.
+    """
+    return _encode_payload([timestamp.isoformat(), row_id])
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """
+    Decodes a cursor produced by encode_cursor.
+
+    Args:
+        cursor (str): The cursor sent by the client.
+
+    Returns:
+        Tuple[datetime, str]: The (timestamp, id) sort key.
+
+    Raises:
+        ValueError: If the cursor is malformed or its id isn't a uuid.
+    """
+    timestamp, row_id = _check_key(_decode_payload(cursor), str)
+    try:
+        return datetime.fromisoformat(timestamp), row_id
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def encode_id_cursor(row_id: str) -> str:
+    """
+    Encodes the id of the last row of a page ordered by id (time-ordered uuids).
+
+    Args:
+        row_id (str): The ID of the row.
+
+    Returns:
+        str: The URL-safe cursor.
+    """
+    return _encode_payload([row_id])
+
+
+def decode_id_cursor(cursor: str) -> str:
+    """
+    Decodes a cursor produced by encode_id_cursor.
+
+    Args:
+        cursor (str): The cursor sent by the client.
+
+    Returns:
+        str: The id.
+
+    Raises:
+        ValueError: If the cursor is malformed or its id isn't a uuid.
+    """
+    payload = _decode_payload(cursor)
+    if not isinstance(payload, list) or len(payload) != 1 or not isinstance(payload[0], str) or not ids.is_valid(payload[0]):
+        raise ValueError("Invalid cursor")
+    return payload[0]
+
+
+def encode_change_cursor(positions: List[Tuple[int, str]]) -> str:
+    """
+    Encodes the position reached in the delta sync feed: the (change_seq, id) of the last change returned,
+    per shard (a single position when the storage isn't sharded).
+
+    Args:
+        positions (List[Tuple[int, str]]): The positions, in shard order.
+
+    Returns:
+        str: The URL-safe cursor.
+    """
+    return _encode_payload([[change_seq, row_id] for change_seq, row_id in positions])
+
+
+def decode_change_cursor(cursor: str) -> List[Tuple[int, str]]:
+    """
+    Decodes a cursor produced by encode_change_cursor.
+
+    Args:
+        cursor (str): The cursor sent by the client.
+
+    Returns:
+        List[Tuple[int, str]]: The (change_seq, id) positions, in shard order.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    positions = _decode_payload(cursor)
+    if not isinstance(positions, list) or not positions:
+        raise ValueError("Invalid cursor")
+    return [_check_key(position, int) for position in positions]
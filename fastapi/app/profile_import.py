@@ -0,0 +1,193 @@
+import codecs
+import csv
+import os
+from datetime import datetime
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+from pydantic import EmailStr, TypeAdapter, ValidationError
+from app import ids
+from app.audit_chain import GENESIS_HASH, compute_event_hash
+from app.models.audit_event import AuditEventAction
+from app.models.profile_import import ImportReject, ProfileImport
+
+# Validation rules shared by the storage backends for bulk profile imports (see app/jobs/import_profiles.py).
+#
+# Rows are checked in this order, and only the first failing check is reported:
+#   1. the name and email are present and fit their columns (checked in SQL by the Postgres backend);
+#   2. the email isn't used by an earlier row of the file (the first occurrence wins);
+#   3. the email isn't used by an existing profile;
+#   4. the email is valid for the API (the same validator as UserProfileCreate), so every imported
+#      profile can be read back.
+# Imported profiles get the same CREATE_PROFILE event as profiles created through the API, as the first
+# link of their hash chain.
+#
+# Events are stamped when their row is validated, but a Postgres import commits the whole file at once,
+# so they become visible up to the length of the import later. Imports are therefore cut off after
+# IMPORT_TIMEOUT_SECONDS, and app.analytics waits at least that long before caching a bucket.
+
+REQUIRED_COLUMNS = ("name", "email")  # Header of an import file, in any order
+MAX_FIELD_LENGTH = 255  # Size of the name and email columns
+MAX_REPORTED_REJECTS = 100  # Rejected rows listed in the report (all of them are counted)
+IMPORT_DETAILS = "User profile imported."  # Details of the CREATE_PROFILE events of imported profiles
+IMPORT_TIMEOUT_SECONDS = float(os.getenv("IMPORT_TIMEOUT_SECONDS", "600"))  # Longest import transaction
+
+MISSING_NAME = "missing name"
+NAME_TOO_LONG = "name too long"
+MISSING_EMAIL = "missing email"
+EMAIL_TOO_LONG = "email too long"
+DUPLICATE_EMAIL = "duplicate email in file"
+EMAIL_EXISTS = "email already exists"
+INVALID_EMAIL = "invalid email"
+
+_email_adapter = TypeAdapter(EmailStr)
+
+Reject = Callable[[ImportReject], None]
+
+
+def check_fields(name: Optional[str], email: Optional[str]) -> Optional[str]:
+    """
+    Checks that the (trimmed) name and email of a row are present and fit their columns.
+
+    Returns:
+        str: Why the row is rejected, or None if it passes.
+    """
+    if not name:
+        return MISSING_NAME
+    if len(name) > MAX_FIELD_LENGTH:
+        return NAME_TOO_LONG
+    if not email:
+        return MISSING_EMAIL
+    if len(email) > MAX_FIELD_LENGTH:
+        return EMAIL_TOO_LONG
+    return None
+
+
+def is_valid_email(email: str) -> bool:
+    """Returns whether an email would be accepted by the API."""
+    try:
+        _email_adapter.validate_python(email)
+    except ValidationError:
+        return False
+    return True
+
+
+def import_event(user_id: str, name: str, email: str, timestamp: Optional[datetime] = None) -> dict:
+    """
+    Builds the sealed CREATE_PROFILE event row of an imported profile.
+
+    Args:
+        user_id (str): The ID of the new profile.
+        name (str): Its name.
+        email (str): Its email.
+        timestamp (datetime): When the event happened; defaults to now.
+
+    Returns:
+        dict: The audit_events row, with its hash (first link of the user's chain).
+    """
+    row = {
+        "id": ids.new_id(),
+        "user_id": user_id,
+        "action": AuditEventAction.CREATE_PROFILE.value,
+        "timestamp": timestamp or datetime.now(),
+        "resource": "user_profile",
+        "details": IMPORT_DETAILS,
+        "changes": {"name": {"old": None, "new": name}, "email": {"old": None, "new": email}},
+        "chain_index": 1,
+        "prev_hash": GENESIS_HASH,
+    }
+    row["hash"] = compute_event_hash(GENESIS_HASH, row)
+    return row
+
+
+def record_reject(report: ProfileImport, reject: ImportReject, on_reject: Optional[Reject] = None):
+    """Counts a rejected row, lists it if the report isn't full yet and hands it to on_reject."""
+    report.rejected += 1
+    report.rejected_by_reason[reject.reason] = report.rejected_by_reason.get(reject.reason, 0) + 1
+    if len(report.rejects) < MAX_REPORTED_REJECTS:
+        report.rejects.append(reject)
+    if on_reject is not None:
+        on_reject(reject)
+
+
+def parse_header(line: bytes) -> List[str]:
+    """
+    Parses the header line of an import file.
+
+    Returns:
+        List[str]: The column names, in file order.
+
+    Raises:
+        ValueError: If the columns aren't exactly the required ones.
+    """
+    columns = [column.strip().lower() for column in next(csv.reader([line.decode("utf-8-sig")]), [])]
+    if sorted(columns) != sorted(REQUIRED_COLUMNS):
+        raise ValueError(f"The header must name the columns {', '.join(REQUIRED_COLUMNS)}; found {', '.join(columns) or 'none'}")
+    return columns
+
+
+async def split_header(chunks: AsyncIterator[bytes]) -> Tuple[List[str], AsyncIterator[bytes]]:
+    """
+    Reads the header of a streamed import file, without consuming the rest of the stream.
+
+    Args:
+        chunks (AsyncIterator[bytes]): The file, in chunks.
+
+    Returns:
+        tuple: The column names, and the chunks of the whole file (header included).
+
+    Raises:
+        ValueError: If the file is empty or its header is invalid.
+    """
+    head = b""
+    async for chunk in chunks:
+        head += chunk
+        if b"\n" in head:
+            break
+    if not head.strip():
+        raise ValueError("The file is empty")
+    columns = parse_header(head.split(b"\n", 1)[0])
+
+    async def replay():
+        yield head
+        async for chunk in chunks:
+            yield chunk
+
+    return columns, replay()
+
+
+async def iter_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[str]]:
+    """
+    Parses a streamed CSV file into records, one chunk at a time. Quoted fields may span lines and chunks.
+
+    Args:
+        chunks (AsyncIterator[bytes]): The file, in chunks (UTF-8, with or without a byte order mark).
+
+    Yields:
+        List[str]: The fields of each record, header included.
+
+    Raises:
+        ValueError: If the file isn't valid UTF-8 or CSV.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer, pending = "", ""
+
+    def complete(lines):
+        nonlocal pending
+        for line in lines:
+            pending += line
+            if pending.count('"') % 2 == 0:  # Outside of a quoted field: the record ends with this line
+                record, pending = pending, ""
+                if record.strip("\r\n"):
+                    try:
+                        yield next(csv.reader([record], strict=True))
+                    except csv.Error as e:
+                        raise ValueError(f"Malformed CSV record: {e}") from e
+
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for record in complete(line + "\n" for line in lines):
+            yield record
+    for record in complete([buffer + decoder.decode(b"", final=True)]):
+        yield record
+    if pending:
+        raise ValueError("The file ends inside a quoted field")
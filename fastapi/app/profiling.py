@@ -0,0 +1,221 @@
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from app import metrics
+from app.models.profiling import RequestProfile
+
+# On-demand sampling profiler for single requests.
+#
+# A profiled request gets a sampler thread that looks at the request every PROFILING_INTERVAL_MS.
+# While the request runs on the event loop, the sample is the loop thread's Python stack from the
+# request's handler down (routing, dependencies, Pydantic validation and serialization, repository
+# calls). While it is suspended in an await (waiting for Postgres, a lock, the thread pool) the sample
+# is its chain of awaiting coroutines ending in "(waiting)". Both kinds of samples are counted, so the
+# profile shows where the wall time of the request went, not only its CPU time.
+#
+# A request is profiled when it carries the privileged token in the X-Profile header or the "profile"
+# query parameter, or for a random fraction of the requests to a route. Stacks are kept in the "folded"
+# format of flamegraph.pl, speedscope and inferno ("frame;frame;frame count" per line) for the last
+# PROFILING_STORE_SIZE profiles, served by GET /api/v1/admin/profiling/.
+
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")  # Token that switches the profiler on for a request; empty disables it
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))  # Share of all API requests profiled
+PROFILING_ROUTE_RATES = os.getenv("PROFILING_ROUTE_RATES", "")  # Per route rates: "GET ^/api/v1/users/profile/$=0.01;..."
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", "5"))  # Time between two samples
+PROFILING_STORE_SIZE = int(os.getenv("PROFILING_STORE_SIZE", "50"))  # Profiles kept for the admin endpoint
+PROFILING_MAX_CONCURRENT = int(os.getenv("PROFILING_MAX_CONCURRENT", "4"))  # Requests profiled at the same time
+MAX_STACK_DEPTH = 256  # Frames kept per sample, innermost dropped first
+
+WAITING_FRAME = "(waiting)"  # Leaf of the samples taken while the request was suspended
+
+_store = OrderedDict()  # Profile id -> (RequestProfile, folded stacks), oldest first
+_store_lock = threading.Lock()
+_active = 0  # Requests being profiled
+
+
+def parse_route_rates(value: str) -> List[Tuple[str, "re.Pattern", float]]:
+    """
+    Parses per route sampling rates.
+
+    Args:
+        value (str): ";"-separated "METHOD path-regex=rate" entries, e.g. "GET ^/api/v1/audit/events/$=0.05".
+
+    Returns:
+        list: (method, compiled pattern, rate) tuples.
+
+    Raises:
+        ValueError: If an entry is malformed.
+    """
+    rates = []
+    for entry in filter(None, (entry.strip() for entry in value.split(";"))):
+        route, _, rate = entry.rpartition("=")
+        method, _, pattern = route.strip().partition(" ")
+        if not method or not pattern or not rate:
+            raise ValueError(f"Invalid profiling route rate {entry!r}; expected \"METHOD path-regex=rate\"")
+        rates.append((method.upper(), re.compile(pattern.strip()), float(rate)))
+    return rates
+
+
+_route_rates = parse_route_rates(PROFILING_ROUTE_RATES)
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """Returns whether a token from a request matches the privileged profiling token."""
+    return bool(PROFILING_TOKEN) and token is not None and hmac.compare_digest(token, PROFILING_TOKEN)
+
+
+def sample_rate(method: str, path: str) -> float:
+    """Returns the share of the requests to a route that is profiled (the first matching route rate wins)."""
+    for route_method, pattern, rate in _route_rates:
+        if route_method == method and pattern.match(path):
+            return rate
+    return PROFILING_SAMPLE_RATE
+
+
+def should_sample(method: str, path: str) -> bool:
+    """Draws whether a request without a profiling token is profiled."""
+    rate = sample_rate(method, path)
+    return rate > 0 and random.random() < rate
+
+
+@lru_cache(maxsize=4096)
+def _short_path(filename: str) -> str:
+    """Shortens a source path to its module path, relative to the longest sys.path entry containing it."""
+    for root in sorted((entry for entry in sys.path if entry), key=len, reverse=True):
+        if filename.startswith(root.rstrip(os.sep) + os.sep):
+            return filename[len(root.rstrip(os.sep)) + 1:]
+    return filename
+
+
+def frame_label(frame) -> str:
+    """Labels a frame by function, file and first line, so every call of a function folds into one frame."""
+    code = frame.f_code
+    return f"{code.co_qualname} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+
+
+def await_chain(awaitable) -> list:
+    """
+    Returns the frames of a suspended coroutine and of everything it awaits, outermost first.
+
+    The chain ends at the first awaited object without a frame (usually a future).
+    """
+    frames = []
+    while awaitable is not None and len(frames) < MAX_STACK_DEPTH:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None) or getattr(awaitable, "ag_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None) or getattr(awaitable, "ag_await", None)
+    return frames
+
+
+class Profiler:
+    def __init__(self, coroutine, interval: float = PROFILING_INTERVAL_MS / 1000):
+        """
+        Initializes a sampling profiler for one request.
+
+        Args:
+            coroutine: The coroutine serving the request; it must run on the calling thread.
+            interval (float): Seconds between two samples.
+        """
+        self.coroutine = coroutine
+        self.interval = interval
+        self.stacks = Counter()  # Folded stack -> number of samples
+        self.samples = 0
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        """Starts sampling in the background."""
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and waits for the sampler thread."""
+        self._stop.set()
+        self._thread.join()
+
+    def sample(self) -> Optional[List[str]]:
+        """
+        Samples the request once.
+
+        Returns:
+            List[str]: Frame labels from the handler down, or None once the coroutine has finished.
+        """
+        root = self.coroutine.cr_frame
+        if root is None:
+            return None
+        running = []
+        frame = sys._current_frames().get(self._thread_id)
+        while frame is not None:
+            running.append(frame)
+            if frame is root:  # The request is running on the loop thread
+                return [frame_label(frame) for frame in reversed(running[-MAX_STACK_DEPTH:])]
+            frame = frame.f_back
+        # Running something else (or nothing): the request is suspended in an await
+        return [frame_label(frame) for frame in await_chain(self.coroutine)] + [WAITING_FRAME]
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                stack = self.sample()
+            except (AttributeError, RuntimeError, ValueError):
+                continue  # The coroutine moved on while it was being walked
+            if stack:
+                self.stacks[";".join(stack)] += 1
+                self.samples += 1
+
+    def folded(self) -> str:
+        """Returns the samples in the folded stack format, heaviest stacks first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def try_acquire() -> bool:
+    """Claims a profiling slot, unless PROFILING_MAX_CONCURRENT requests are already profiled."""
+    global _active
+    with _store_lock:
+        if _active >= PROFILING_MAX_CONCURRENT:
+            metrics.increment("profiling.skipped")
+            return False
+        _active += 1
+        return True
+
+
+def release():
+    """Returns a profiling slot."""
+    global _active
+    with _store_lock:
+        _active -= 1
+
+
+def save(profile: RequestProfile, folded: str):
+    """Stores a profile, evicting the oldest one when the store is full."""
+    with _store_lock:
+        _store[profile.id] = (profile, folded)
+        while len(_store) > PROFILING_STORE_SIZE:
+            _store.popitem(last=False)
+    metrics.increment("profiling.captured")
+
+
+def recent(limit: int = PROFILING_STORE_SIZE) -> List[RequestProfile]:
+    """Returns the most recent profiles, newest first."""
+    with _store_lock:
+        return [profile for profile, _ in reversed(_store.values())][:limit]
+
+
+def get(profile_id: str) -> Optional[Tuple[RequestProfile, str]]:
+    """Returns a profile and its folded stacks, or None if it isn't stored (anymore)."""
+    with _store_lock:
+        return _store.get(profile_id)
+
+
+def clear():
+    """Removes every stored profile."""
+    with _store_lock:
+        _store.clear()
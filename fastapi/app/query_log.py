@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+from typing import List, Optional
+from app import metrics
+
+# Slow query log.
+#
+# A query logger installed on every database connection (asyncpg add_query_logger) reports each
+# statement slower than SLOW_QUERY_THRESHOLD_MS: it is logged with its parameters redacted (only their
+# types are kept) and the route of the request that issued it. A sample of the slow statements also
+# gets its plan captured on another connection: EXPLAIN (ANALYZE, BUFFERS) for reads, run in a read-only
+# transaction that is rolled back, and a plain EXPLAIN for writes, which must not run twice. SELECTs that
+# call a function with side effects (advisory locks, sequences, ...) count as writes: running them again
+# would e.g. wait for the lock the slow statement was waiting for.
+# The most recent entries are kept in a bounded ring, served by GET /api/v1/admin/slow-queries/.
+
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "200"))  # Negative disables the log
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_SAMPLE_RATE", "0.1"))  # Share of slow statements explained
+SLOW_QUERY_RING_SIZE = int(os.getenv("SLOW_QUERY_RING_SIZE", "100"))  # Entries kept for the admin endpoint
+SLOW_QUERY_MAX_CAPTURES = int(os.getenv("SLOW_QUERY_MAX_CAPTURES", "2"))  # EXPLAINs running at the same time
+EXPLAIN_TIMEOUT_SECONDS = 30.0
+
+logger = logging.getLogger(__name__)
+
+current_request: ContextVar[Optional[dict]] = ContextVar("current_request", default=None)  # ASGI scope, set by QueryRouteMiddleware
+_capturing: ContextVar[bool] = ContextVar("capturing_plan", default=False)  # Don't trace the EXPLAIN statements themselves
+
+_ring = deque(maxlen=SLOW_QUERY_RING_SIZE)
+_captures = set()  # Plan captures started and not finished yet, at most SLOW_QUERY_MAX_CAPTURES
+_READ_STATEMENT = re.compile(r"^\s*select\b", re.IGNORECASE)
+_VOLATILE_CALL = re.compile(  # Functions with side effects a SELECT may call
+    r"\b(pg_(try_)?advisory\w*|nextval|setval|pg_notify|pg_sleep\w*|set_config|txid_current|pg_current_xact_id\w*"
+    r"|pg_cancel_backend|pg_terminate_backend)\s*\(", re.IGNORECASE
+)
+
+
+def current_route() -> Optional[str]:
+    """
+    Returns the method and route template of the request being served, e.g. "GET /api/v1/users/{user_id}/profile/".
+
+    Returns:
+        str: The route, the raw path if no route matched (yet), or None outside of a request.
+    """
+    scope = current_request.get()
+    if scope is None:
+        return None
+    route = scope.get("route")  # Set by FastAPI's router once the request is matched
+    path = scope.get("root_path", "") + route.path if route is not None else scope["path"]
+    return f"{scope['method']} {path}"
+
+
+def redact(args) -> List[str]:
+    """
+    Replaces query parameters by their type, so profile data never ends up in the logs.
+
+    Args:
+        args (tuple): The parameters of the statement.
+
+    Returns:
+        List[str]: One placeholder per parameter, e.g. "<str>", "<datetime>", "<NULL>".
+    """
+    return ["<NULL>" if arg is None else f"<{type(arg).__name__}>" for arg in args or ()]
+
+
+def _normalize(statement: str) -> str:
+    """Collapses the whitespace of a statement so it fits on one log line."""
+    return " ".join(statement.split())
+
+
+def log_query(record, sample_rate: Optional[float] = None, connect=None):
+    """
+    Query logger callback (see asyncpg Connection.add_query_logger); records the statement if it was slow.
+
+    Args:
+        record (asyncpg.connection.LoggedQuery): The executed statement, its parameters and elapsed time.
+        sample_rate (float): Share of slow statements whose plan is captured (SLOW_QUERY_EXPLAIN_SAMPLE_RATE).
+        connect (callable): Opens the connection used to capture plans (database.connect_to_db).
+
+    Returns:
+        dict: The ring entry, or None if the statement wasn't slow.
+    """
+    elapsed_ms = record.elapsed * 1000
+    if SLOW_QUERY_THRESHOLD_MS < 0 or elapsed_ms < SLOW_QUERY_THRESHOLD_MS or _capturing.get():
+        return None
+
+    entry = {
+        "timestamp": datetime.now(),
+        "route": current_route(),
+        "statement": _normalize(record.query),
+        "params": redact(record.args),
+        "elapsed_ms": round(elapsed_ms, 3),
+        "error": type(record.exception).__name__ if record.exception else None,
+        "plan": None,
+    }
+    _ring.append(entry)
+    metrics.increment("db.slow_queries")
+    logger.warning("Slow query (%.1f ms) from %s: %s params=%s", elapsed_ms, entry["route"] or "-",
+                   entry["statement"], entry["params"])
+
+    sample_rate = SLOW_QUERY_EXPLAIN_SAMPLE_RATE if sample_rate is None else sample_rate
+    if record.exception is None and random.random() < sample_rate and len(_captures) < SLOW_QUERY_MAX_CAPTURES:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return entry  # Not in the event loop: nothing can run the EXPLAIN
+        task = loop.create_task(capture_plan(entry, record.query, record.args, connect))
+        _captures.add(task)  # Counted right away, so a burst of slow statements can't start more captures
+        task.add_done_callback(_captures.discard)
+    return entry
+
+
+def is_plain_read(statement: str) -> bool:
+    """Tells if a statement only reads, so running it again under EXPLAIN ANALYZE has no side effects."""
+    return bool(_READ_STATEMENT.match(statement)) and not _VOLATILE_CALL.search(statement)
+
+
+async def capture_plan(entry: dict, statement: str, args, connect=None):
+    """
+    Runs EXPLAIN for a slow statement on a separate connection and stores the plan in its ring entry.
+
+    Args:
+        entry (dict): The ring entry of the statement.
+        statement (str): The statement, with its $n placeholders.
+        args (tuple): The original parameters (needed to plan the statement; never stored).
+        connect (callable): Opens the connection to run EXPLAIN on (database.connect_to_db).
+    """
+    from app import database
+
+    _capturing.set(True)  # This task's context only
+    connection = None
+    try:
+        connection = await (connect or database.connect_to_db)()
+        is_read = is_plain_read(statement)
+        transaction = connection.transaction(readonly=is_read)
+        explain = "EXPLAIN (ANALYZE, BUFFERS)" if is_read else "EXPLAIN"
+        await transaction.start()
+        try:
+            rows = await connection.fetch(f"{explain} {statement}", *(args or ()), timeout=EXPLAIN_TIMEOUT_SECONDS)
+        finally:
+            await transaction.rollback()  # EXPLAIN ANALYZE executes the statement; keep nothing
+        entry["plan"] = "\n".join(row[0] for row in rows)
+    except Exception as e:
+        entry["plan_error"] = str(e)
+    finally:
+        if connection is not None:
+            await (database.close_db_connection(connection) if connect is None else connection.close())
+
+
+def install(connection):
+    """
+    Installs the slow query logger on a connection.
+
+    Args:
+        connection (asyncpg.Connection): A newly opened connection.
+    """
+    connection.add_query_logger(log_query)
+
+
+def recent(limit: Optional[int] = None) -> List[dict]:
+    """
+    Returns the slow statements kept in the ring, newest first.
+
+    Args:
+        limit (int): Maximum number of entries to return.
+
+    Returns:
+        List[dict]: The entries, with their captured plans.
+    """
+    entries = list(reversed(_ring))
+    return entries[:limit] if limit else entries
+
+
+def clear():
+    """Empties the ring."""
+    _ring.clear()
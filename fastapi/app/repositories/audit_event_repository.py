@@ -1,34 +1,146 @@
-import uuid
 import asyncpg
-from app.models.audit_event import AuditEvent, AuditEventAction
+from app.models.audit_event import AuditCheckpoint, AuditEvent, AuditEventAction, AuditEventBase, AuditHistory
+from app.models.audit_verification import VerificationRun
 import json
-from typing import List
+from typing import Dict, List, Optional
 from datetime import datetime
+from app import database, ids
+from app.audit_chain import compute_event_hash, next_link
+from app.analytics import check_group_by
+from app.audit_replay import replay
+
+# Single-id lookups used by the history and rollback endpoints; prepared on each pooled connection at startup.
+# Events not yet sealed into the hash chain (written before it existed) have no chain_index and come first.
+SELECT_BY_USER_ID = "SELECT * FROM audit_events WHERE user_id = $1 ORDER BY chain_index NULLS FIRST, timestamp"
+SELECT_BY_ID = "SELECT * FROM audit_events WHERE id = $1"
+HOT_STATEMENTS = (SELECT_BY_USER_ID, SELECT_BY_ID)
+
+# Chain locks of several users in one round trip, taken in a fixed order
+LOCK_USERS = "SELECT pg_advisory_xact_lock(hashtext(u)) FROM (SELECT u FROM unnest($1::text[]) AS u ORDER BY u) AS users"
+# Last chained event of each user
+LAST_LINKS = """
+    SELECT DISTINCT ON (user_id) user_id, chain_index, hash FROM audit_events
+    WHERE user_id = ANY($1) AND chain_index IS NOT NULL
+    ORDER BY user_id, chain_index DESC
+"""
+# Columns of audit_events and audit_events_archive, named wherever rows are copied: their physical order may differ
+EVENT_COLUMNS = ("id", "user_id", "action", "timestamp", "resource", "details", "changes", "chain_index", "prev_hash", "hash")
+INSERT_EVENT = (
+    f"INSERT INTO audit_events ({', '.join(EVENT_COLUMNS)}) "
+    "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)"
+)
+# Moves a user's events up to a chain index to the archive in a single statement
+ARCHIVE_EVENTS = (
+    f"WITH moved AS (DELETE FROM audit_events WHERE user_id = $1 AND chain_index <= $2 RETURNING {', '.join(EVENT_COLUMNS)}) "
+    f"INSERT INTO audit_events_archive ({', '.join(EVENT_COLUMNS)}) SELECT {', '.join(EVENT_COLUMNS)} FROM moved"
+)
+UPSERT_VERIFICATION_RUN = """
+    INSERT INTO audit_verification_runs (id, full_check, status, summary, error, started_at, finished_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (id) DO UPDATE SET status = EXCLUDED.status, summary = EXCLUDED.summary, error = EXCLUDED.error,
+        finished_at = EXCLUDED.finished_at
+"""
 
 class AuditEventRepository:
-    def __init__(self, connection):
+    def __init__(self, connection, buffered: bool = False):
         """
         Initializes the AuditEventRepository with a database connection.
 
         :param connection: The database connection to be used for executing queries.
+        :param buffered: Whether created events are held until flush() (used by app.unit_of_work.UnitOfWork).
         """
         self.connection = connection
+        self.buffered = buffered
+        self.pending: List[AuditEventBase] = []  # Events waiting for flush() in buffered mode
 
     async def create(self, audit_event: AuditEvent):
         """
-        Creates a new audit event in the database.
+        Creates a new audit event in the database (or queues it, in buffered mode).
 
         :param audit_event: Instance of AuditEvent containing the details of the event to be recorded.
         """
-        # Convert changes to JSON format for storage
-        changes_json = json.dumps(audit_event.changes)
-        # Generate a unique ID for the new audit event
-        audit_event_id = str(uuid.uuid4())
-        # Insert the audit event into the database
-        await self.connection.execute(
-            "INSERT INTO audit_events (id, user_id, action, resource, details, changes) VALUES ($1, $2, $3, $4, $5, $6)",
-            audit_event_id, audit_event.user_id, audit_event.action.value, audit_event.resource, audit_event.details, changes_json
+        if self.buffered:
+            self.pending.append(audit_event)
+            return
+        await self.create_many([audit_event])
+
+    async def flush(self):
+        """
+        Writes the events queued in buffered mode.
+        """
+        pending, self.pending = self.pending, []
+        await self.create_many(pending)
+
+    async def create_many(self, audit_events: List[AuditEventBase]):
+        """
+        Creates audit events in the database, in order, with one lock, one lookup and one pipelined insert.
+
+        :param audit_events: The events to be recorded; events of the same user are chained in list order.
+        """
+        if not audit_events:
+            return
+        user_ids = sorted({audit_event.user_id for audit_event in audit_events})
+
+        async with self.connection.transaction():
+            # Serialize writers of the same users so the chains can't fork (locks taken in id order: no deadlocks)
+            await self.connection.execute(LOCK_USERS, user_ids)
+            last = {row["user_id"]: (row["chain_index"], row["hash"]) for row in await self.connection.fetch(LAST_LINKS, user_ids)}
+            rows = []
+            for audit_event in audit_events:
+                if audit_event.user_id not in last:
+                    last[audit_event.user_id] = await self._seal_legacy_events(audit_event.user_id)
+                # Generate a unique ID for the new audit event
+                audit_event_id = ids.new_id()
+                # The timestamp is set here rather than by the column default, because it is part of the hash
+                timestamp = datetime.now()
+                chain_index, prev_hash = next_link(last[audit_event.user_id])
+                event_hash = compute_event_hash(prev_hash, {
+                    "id": audit_event_id, "user_id": audit_event.user_id, "chain_index": chain_index,
+                    "action": audit_event.action.value, "timestamp": timestamp, "resource": audit_event.resource,
+                    "details": audit_event.details, "changes": audit_event.changes,
+                })
+                last[audit_event.user_id] = (chain_index, event_hash)
+                rows.append((audit_event_id, audit_event.user_id, audit_event.action.value, timestamp, audit_event.resource,
+                             audit_event.details, json.dumps(audit_event.changes), chain_index, prev_hash, event_hash))
+            # Insert the audit events into the database; executemany sends them in one pipelined batch
+            await self.connection.executemany(INSERT_EVENT, rows)
+
+    async def seal_legacy_events(self, user_id: str):
+        """
+        Seals a user's events written before the hash chain existed into the chain.
+
+        :param user_id: ID of the user whose events should be sealed.
+        :return: (chain_index, hash) of the user's last sealed event, or None if nothing had to be sealed.
+        """
+        async with self.connection.transaction():
+            await self.connection.execute("SELECT pg_advisory_xact_lock(hashtext($1))", user_id)
+            return await self._seal_legacy_events(user_id)
+
+    async def _seal_legacy_events(self, user_id: str):
+        """
+        Chains the events a user had before the hash chain existed, oldest first.
+        Must run inside the transaction holding the user's chain lock.
+
+        :param user_id: ID of the user whose events should be sealed.
+        :return: (chain_index, hash) of the last sealed event, or None if the user had no events.
+        """
+        rows = await self.connection.fetch(
+            "SELECT * FROM audit_events WHERE user_id = $1 AND chain_index IS NULL ORDER BY timestamp, id", user_id
         )
+        last = None
+        updates = []
+        for row in rows:
+            chain_index, prev_hash = next_link(last)
+            event_hash = compute_event_hash(prev_hash, {
+                **row, "chain_index": chain_index, "changes": json.loads(row["changes"]) if row["changes"] else None,
+            })
+            updates.append((chain_index, prev_hash, event_hash, row["id"]))
+            last = (chain_index, event_hash)
+        if updates:
+            await self.connection.executemany(
+                "UPDATE audit_events SET chain_index = $1, prev_hash = $2, hash = $3 WHERE id = $4", updates
+            )
+        return last
 
     async def get_by_user_id(self, user_id: str):
         """
@@ -37,8 +149,10 @@ class AuditEventRepository:
         :param user_id: ID of the user whose audit events should be retrieved.
         :return: List of audit events related to the user.
         """
-        # Fetch all audit events for the specified user ID
-        rows = await self.connection.fetch("SELECT * FROM audit_events WHERE user_id = $1", user_id)
+        if not ids.is_valid(user_id):
+            return []  # Can't be stored in the uuid column, so no event has it
+        # Fetch all audit events for the specified user ID, oldest first
+        rows = await self.connection.fetch(SELECT_BY_USER_ID, user_id)
         # Return a list of AuditEvent instances created from the fetched rows
         return [AuditEvent(**{**row, "changes": json.loads(row["changes"]) if row["changes"] else {}, "id": row["id"]}) for row in rows]
 
@@ -48,8 +162,8 @@ class AuditEventRepository:
 
         :return: List of all audit events.
         """
-        # Fetch all audit events from the database
-        rows = await self.connection.fetch("SELECT * FROM audit_events")
+        # Fetch all audit events from the database, including the ones moved to the archive by compaction
+        rows = await self.connection.fetch("SELECT * FROM audit_events_all")
         # Return a list of AuditEvent instances created from the fetched rows
         return [AuditEvent(**{**row, "changes": json.loads(row["changes"]) if row["changes"] else {}}) for row in rows]
 
@@ -60,9 +174,197 @@ class AuditEventRepository:
         :param event_id: ID of the audit event to be retrieved.
         :return: The audit event if found, otherwise None.
         """
-        # Fetch the audit event by its ID
-        row = await self.connection.fetchrow("SELECT * FROM audit_events WHERE id = $1", event_id)
+        if not ids.is_valid(event_id):
+            return None  # Can't be stored in the uuid column, so no event has it
+        # Fetch the audit event by its ID, looking in the archive if it was compacted
+        row = await self.connection.fetchrow(SELECT_BY_ID, event_id)
+        if row is None:
+            row = await self.connection.fetchrow("SELECT * FROM audit_events_archive WHERE id = $1", event_id)
         if row:
             # Return an AuditEvent instance if found
             return AuditEvent(**{**row, "changes": json.loads(row["changes"]) if row["changes"] else {}})
         return None  # Return None if the event is not found
+
+    async def get_many(self, event_ids: List[str]) -> Dict[str, AuditEvent]:
+        """
+        Retrieves several audit events, live or archived, with a single query.
+
+        :param event_ids: IDs of the audit events to be retrieved.
+        :return: The audit events found, indexed by ID (missing IDs are absent).
+        """
+        event_ids = [event_id for event_id in set(event_ids) if ids.is_valid(event_id)]
+        rows = await self.connection.fetch("SELECT * FROM audit_events_all WHERE id = ANY($1)", event_ids)
+        return {row["id"]: AuditEvent(**{**row, "changes": json.loads(row["changes"]) if row["changes"] else {}}) for row in rows}
+
+    async def count_by_bucket(self, bucket_size: str, group_by: tuple, start: datetime, end: datetime) -> List[dict]:
+        """
+        Counts the audit events, live and archived, per time bucket (see app.analytics).
+
+        :param bucket_size: date_trunc unit of the buckets ("hour" or "day").
+        :param group_by: Columns to group by within each bucket, from app.analytics.GROUP_COLUMNS.
+        :param start: Start of the range (inclusive).
+        :param end: End of the range (exclusive).
+        :return: Rows with "bucket", the grouped columns and "count", ordered by bucket.
+        """
+        columns = "".join(f", {column}" for column in check_group_by(group_by))  # Whitelisted column names
+        rows = await self.connection.fetch(
+            f"SELECT date_trunc($1, timestamp) AS bucket{columns}, count(*) AS count FROM audit_events_all "
+            f"WHERE timestamp >= $2 AND timestamp < $3 GROUP BY 1{columns} ORDER BY 1{columns}",
+            bucket_size, start, end
+        )
+        return [dict(row) for row in rows]
+
+    async def replayed_until(self) -> Optional[datetime]:
+        """
+        Tells how far this connection's server is behind the primary (see app.analytics).
+
+        :return: Commit time of the last transaction replayed on a replica, or None on the primary.
+        """
+        return await self.connection.fetchval(
+            "SELECT CASE WHEN pg_is_in_recovery() THEN coalesce(pg_last_xact_replay_timestamp(), 'epoch') END"
+        )
+
+    async def find_field_changes(self, field: str, old: Optional[str] = None, new: Optional[str] = None,
+                                 value: Optional[str] = None, start: Optional[datetime] = None,
+                                 end: Optional[datetime] = None, after: Optional[tuple] = None,
+                                 limit: int = 100) -> List[AuditEvent]:
+        """
+        Finds the audit events, live and archived, that touched a field, newest first.
+
+        Value filters are JSONB containment tests served by the GIN (jsonb_path_ops) indexes on changes.
+
+        :param field: Name of the field, e.g. "email".
+        :param old: Only events whose old value of the field was this.
+        :param new: Only events whose new value of the field was this.
+        :param value: Only events where the field had this value, before or after the event.
+        :param start: Only events at or after this time.
+        :param end: Only events before this time.
+        :param after: (timestamp, id) of the last event of the previous page.
+        :param limit: Maximum number of events to return.
+        :return: The matching audit events, ordered by timestamp and id, descending.
+        """
+        conditions, args = [], []
+
+        def param(arg):
+            args.append(arg)
+            return f"${len(args)}"
+
+        if value is not None:
+            conditions.append(f"(changes @> {param(json.dumps({field: {'old': value}}))}::jsonb "
+                              f"OR changes @> {param(json.dumps({field: {'new': value}}))}::jsonb)")
+        if old is not None:
+            conditions.append(f"changes @> {param(json.dumps({field: {'old': old}}))}::jsonb")
+        if new is not None:
+            conditions.append(f"changes @> {param(json.dumps({field: {'new': new}}))}::jsonb")
+        if value is None and old is None and new is None:
+            # No value to look up: events that actually changed the field
+            key = param(field)
+            conditions.append(f"changes ? {key} AND changes -> {key} -> 'old' IS DISTINCT FROM changes -> {key} -> 'new'")
+        if start is not None:
+            conditions.append(f"timestamp >= {param(start)}")
+        if end is not None:
+            conditions.append(f"timestamp < {param(end)}")
+        if after is not None:
+            conditions.append(f"(timestamp, id) < ({param(after[0])}, {param(after[1])})")
+
+        rows = await self.connection.fetch(
+            f"SELECT * FROM audit_events_all WHERE {' AND '.join(conditions)} "
+            f"ORDER BY timestamp DESC, id DESC LIMIT {param(limit)}",
+            *args
+        )
+        return [AuditEvent(**{**row, "changes": json.loads(row["changes"]) if row["changes"] else {}}) for row in rows]
+
+    async def verify_chain(self, full: bool = False, connect=None, pool=None) -> dict:
+        """
+        Verifies the hash chains of all users, resuming from the last checkpoints unless a full check is requested.
+
+        :param full: Whether to ignore the checkpoints and verify every event again.
+        :param connect: Opens another connection to this repository's database, for the checkpoints (DATABASE_URL by default).
+        :param pool: Pool of worker processes to use; one is started by default.
+        :return: Summary of the verification (see app.jobs.verify_audit_chain).
+        """
+        from app.jobs.verify_audit_chain import verify_audit_chain
+        return await verify_audit_chain(self.connection, full=full, connect=connect or database.connect_to_db, pool=pool)
+
+    async def save_verification_run(self, run: VerificationRun):
+        """
+        Creates or updates the report of a verification run.
+
+        :param run: The verification run.
+        """
+        await self.connection.execute(
+            UPSERT_VERIFICATION_RUN, run.id, run.full, run.status.value,
+            json.dumps(run.summary, default=str) if run.summary is not None else None, run.error, run.started_at, run.finished_at
+        )
+
+    async def get_verification_run(self, run_id: str) -> Optional[VerificationRun]:
+        """
+        Retrieves the report of a verification run.
+
+        :param run_id: The ID of the verification run.
+        :return: The verification run or None if not found.
+        """
+        row = await self.connection.fetchrow("SELECT * FROM audit_verification_runs WHERE id = $1", run_id)
+        if row is None:
+            return None
+        return VerificationRun(**{**row, "full": row["full_check"], "summary": json.loads(row["summary"]) if row["summary"] else None})
+
+    async def get_checkpoint(self, user_id: str):
+        """
+        Retrieves the compaction checkpoint of a user's audit history.
+
+        :param user_id: ID of the user.
+        :return: The checkpoint, or None if the user's history was never compacted.
+        """
+        if not ids.is_valid(user_id):
+            return None
+        row = await self.connection.fetchrow("SELECT * FROM audit_checkpoints WHERE user_id = $1", user_id)
+        if row:
+            return AuditCheckpoint(**{**row, "state": json.loads(row["state"])})
+        return None
+
+    async def get_history(self, user_id: str) -> AuditHistory:
+        """
+        Retrieves a user's audit history as the compaction checkpoint followed by the events after it.
+        The cost stays bounded for users with long histories, since archived events are never read.
+
+        :param user_id: ID of the user.
+        :return: The checkpoint (if any) and the remaining events, oldest first.
+        """
+        return AuditHistory(checkpoint=await self.get_checkpoint(user_id), events=await self.get_by_user_id(user_id))
+
+    async def compact(self, user_id: str, up_to_index: int) -> int:
+        """
+        Folds a user's events up to a chain index into the compaction checkpoint and moves them to the archive.
+
+        :param user_id: ID of the user whose history should be compacted.
+        :param up_to_index: Chain index of the last event to fold.
+        :return: Number of events folded.
+        """
+        async with self.connection.transaction():
+            # Same lock as create(), so no event is appended while the history is being folded
+            await self.connection.execute("SELECT pg_advisory_xact_lock(hashtext($1))", user_id)
+            await self._seal_legacy_events(user_id)
+            rows = await self.connection.fetch(
+                "SELECT action, timestamp, changes, chain_index FROM audit_events "
+                "WHERE user_id = $1 AND chain_index <= $2 ORDER BY chain_index",
+                user_id, up_to_index
+            )
+            if not rows:
+                return 0
+
+            checkpoint = await self.get_checkpoint(user_id)
+            state = replay(
+                ((row["action"], json.loads(row["changes"]) if row["changes"] else None) for row in rows),
+                state=checkpoint.state if checkpoint else None
+            )
+            await self.connection.execute(
+                "INSERT INTO audit_checkpoints (user_id, chain_index, event_count, up_to, state) VALUES ($1, $2, $3, $4, $5) "
+                "ON CONFLICT (user_id) DO UPDATE SET chain_index = EXCLUDED.chain_index, "
+                "event_count = audit_checkpoints.event_count + EXCLUDED.event_count, up_to = EXCLUDED.up_to, "
+                "state = EXCLUDED.state, created_at = CURRENT_TIMESTAMP",
+                user_id, rows[-1]["chain_index"], len(rows), rows[-1]["timestamp"], json.dumps(state)
+            )
+            # Move the folded events to the archive in a single statement
+            await self.connection.execute(ARCHIVE_EVENTS, user_id, rows[-1]["chain_index"])
+            return len(rows)
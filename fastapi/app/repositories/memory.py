@@ -0,0 +1,523 @@
+import copy
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+import asyncpg
+from app import ids, profile_import
+from app.analytics import check_group_by, truncate
+from app.audit_chain import GENESIS_HASH, compute_event_hash, next_link, verify_segments
+from app.audit_replay import replay
+from app.jobs.verify_audit_chain import new_summary, record_results
+from app.models.audit_event import AuditCheckpoint, AuditEvent
+from app.models.audit_verification import VerificationRun
+from app.models.profile_import import ImportReject, ProfileImport
+from app.models.purge import PurgeRun
+from app.models.user_profile import ProfileChange, ProfileListItem, UserProfile
+from app.repositories.audit_event_repository import AuditEventRepository
+from app.repositories.user_profile_repository import UserProfileRepository, advance_purge_run
+
+
+class InMemoryStore:
+    def __init__(self):
+        """Initializes an empty store holding the same data as the user_profiles and audit_events tables."""
+        self.profiles: Dict[str, dict] = {}  # Profile rows indexed by id
+        self.emails: Dict[str, str] = {}  # Unique email index: email -> profile id
+        self.events: Dict[str, dict] = {}  # Audit event rows indexed by id
+        self.events_by_user: Dict[str, List[str]] = defaultdict(list)  # Event ids per user, in insertion order
+        self.chain_checkpoints: Dict[str, tuple] = {}  # Last verified (chain_index, hash) per user
+        self.archived_events: Dict[str, dict] = {}  # Events moved out by compaction, indexed by id
+        self.archived_by_user: Dict[str, List[str]] = defaultdict(list)  # Archived event ids per user, in order
+        self.audit_checkpoints: Dict[str, dict] = {}  # Compaction checkpoint rows per user
+        self.purge_runs: Dict[str, dict] = {}  # Purge progress reports indexed by run id
+        self.verification_runs: Dict[str, dict] = {}  # Hash chain verification reports indexed by run id
+        self.tombstones: Dict[str, dict] = {}  # Purged profiles indexed by id
+        self.change_seq = 0  # Last change sequence handed out; every write is committed at once
+
+    def next_change_seq(self) -> int:
+        """Returns the change sequence of a new write, like the transaction ids of the Postgres backend."""
+        self.change_seq += 1
+        return self.change_seq
+
+    def reset(self):
+        """Removes all profiles and audit events."""
+        self.__init__()
+
+
+_store = InMemoryStore()  # Process-wide store used when STORAGE_BACKEND is "memory"
+
+
+def get_memory_store() -> InMemoryStore:
+    """
+    Returns the process-wide in-memory store.
+
+    Returns:
+        InMemoryStore: The shared store.
+    """
+    return _store
+
+
+class InMemoryAuditEventRepository(AuditEventRepository):
+    def __init__(self, store: InMemoryStore, buffered: bool = False):
+        """
+        Initializes the repository with an in-memory store instead of a database connection.
+
+        :param store: The store holding the audit events.
+        :param buffered: Whether created events are held until flush().
+        """
+        super().__init__(connection=None, buffered=buffered)
+        self.store = store
+
+    async def create_many(self, audit_events: List[AuditEvent]):
+        """
+        Creates audit events in the store, in order.
+
+        :param audit_events: The events to be recorded; events of the same user are chained in list order.
+        """
+        for audit_event in audit_events:
+            audit_event_id = ids.new_id()  # Generate a unique, time-ordered ID for the new audit event
+            user_events = self.store.events_by_user[audit_event.user_id]
+            last = self.store.events[user_events[-1]] if user_events else None
+            chain_index, prev_hash = next_link((last["chain_index"], last["hash"]) if last else None)
+            row = {
+                "id": audit_event_id,
+                "user_id": audit_event.user_id,
+                "action": audit_event.action.value,
+                "timestamp": datetime.now(),
+                "resource": audit_event.resource,
+                "details": audit_event.details,
+                "changes": copy.deepcopy(audit_event.changes),  # Stored by value, like the JSONB column
+                "chain_index": chain_index,
+                "prev_hash": prev_hash,
+            }
+            row["hash"] = compute_event_hash(prev_hash, row)
+            self.store.events[audit_event_id] = row
+            user_events.append(audit_event_id)
+
+    async def get_by_user_id(self, user_id: str):
+        """
+        Retrieves all audit events associated with a specific user ID, oldest first.
+
+        :param user_id: ID of the user whose audit events should be retrieved.
+        :return: List of audit events related to the user.
+        """
+        return [self._to_model(self.store.events[event_id]) for event_id in self.store.events_by_user.get(user_id, [])]
+
+    async def get_all(self) -> List[AuditEvent]:
+        """
+        Retrieves all audit events recorded in the store.
+
+        :return: List of all audit events.
+        """
+        return [self._to_model(row) for row in (*self.store.archived_events.values(), *self.store.events.values())]
+
+    async def get_by_id(self, event_id: str):
+        """
+        Retrieves a specific audit event by its ID.
+
+        :param event_id: ID of the audit event to be retrieved.
+        :return: The audit event if found, otherwise None.
+        """
+        row = self.store.events.get(event_id) or self.store.archived_events.get(event_id)
+        return self._to_model(row) if row else None
+
+    async def get_many(self, event_ids: List[str]) -> Dict[str, AuditEvent]:
+        """
+        Retrieves several audit events, live or archived.
+
+        :param event_ids: IDs of the audit events to be retrieved.
+        :return: The audit events found, indexed by ID (missing IDs are absent).
+        """
+        rows = (self.store.events.get(event_id) or self.store.archived_events.get(event_id) for event_id in set(event_ids))
+        return {row["id"]: self._to_model(row) for row in rows if row}
+
+    async def get_checkpoint(self, user_id: str):
+        """
+        Retrieves the compaction checkpoint of a user's audit history.
+
+        :param user_id: ID of the user.
+        :return: The checkpoint, or None if the user's history was never compacted.
+        """
+        row = self.store.audit_checkpoints.get(user_id)
+        return AuditCheckpoint(**copy.deepcopy(row)) if row else None
+
+    async def compact(self, user_id: str, up_to_index: int) -> int:
+        """
+        Folds a user's events up to a chain index into the compaction checkpoint and moves them to the archive.
+
+        :param user_id: ID of the user whose history should be compacted.
+        :param up_to_index: Chain index of the last event to fold.
+        :return: Number of events folded.
+        """
+        event_ids = self.store.events_by_user.get(user_id, [])
+        folded = [self.store.events[event_id] for event_id in event_ids if self.store.events[event_id]["chain_index"] <= up_to_index]
+        if not folded:
+            return 0
+
+        previous = self.store.audit_checkpoints.get(user_id)
+        self.store.audit_checkpoints[user_id] = {
+            "user_id": user_id,
+            "chain_index": folded[-1]["chain_index"],
+            "event_count": (previous["event_count"] if previous else 0) + len(folded),
+            "up_to": folded[-1]["timestamp"],
+            "state": replay(((row["action"], row["changes"]) for row in folded), state=previous["state"] if previous else None),
+        }
+        for row in folded:
+            self.store.archived_events[row["id"]] = self.store.events.pop(row["id"])
+            self.store.archived_by_user[user_id].append(row["id"])
+        self.store.events_by_user[user_id] = event_ids[len(folded):]
+        return len(folded)
+
+    async def count_by_bucket(self, bucket_size: str, group_by: tuple, start: datetime, end: datetime) -> List[dict]:
+        """
+        Counts the audit events, live and archived, per time bucket (see app.analytics).
+
+        :param bucket_size: Unit of the buckets ("hour" or "day").
+        :param group_by: Columns to group by within each bucket, from app.analytics.GROUP_COLUMNS.
+        :param start: Start of the range (inclusive).
+        :param end: End of the range (exclusive).
+        :return: Rows with "bucket", the grouped columns and "count", ordered by bucket.
+        """
+        group_by = check_group_by(group_by)
+        counts = Counter(
+            (truncate(row["timestamp"], bucket_size), *(row[column] for column in group_by))
+            for row in (*self.store.archived_events.values(), *self.store.events.values())
+            if start <= row["timestamp"] < end
+        )
+        return [
+            {"bucket": key[0], **dict(zip(group_by, key[1:])), "count": count}
+            for key, count in sorted(counts.items(), key=lambda item: tuple(str(value) for value in item[0]))
+        ]
+
+    async def replayed_until(self) -> Optional[datetime]:
+        """
+        Tells how far the store is behind the primary: never, there is no replica.
+
+        :return: None.
+        """
+        return None
+
+    async def find_field_changes(self, field: str, old: Optional[str] = None, new: Optional[str] = None,
+                                 value: Optional[str] = None, start: Optional[datetime] = None,
+                                 end: Optional[datetime] = None, after: Optional[tuple] = None,
+                                 limit: int = 100) -> List[AuditEvent]:
+        """
+        Finds the audit events, live and archived, that touched a field, newest first.
+
+        :param field: Name of the field, e.g. "email".
+        :param old: Only events whose old value of the field was this.
+        :param new: Only events whose new value of the field was this.
+        :param value: Only events where the field had this value, before or after the event.
+        :param start: Only events at or after this time.
+        :param end: Only events before this time.
+        :param after: (timestamp, id) of the last event of the previous page.
+        :param limit: Maximum number of events to return.
+        :return: The matching audit events, ordered by timestamp and id, descending.
+        """
+        def matches(row):
+            change = (row["changes"] or {}).get(field)
+            if not isinstance(change, dict):
+                return False
+            if value is not None and value not in (change.get("old"), change.get("new")):
+                return False
+            if (old is not None and change.get("old") != old) or (new is not None and change.get("new") != new):
+                return False
+            if value is None and old is None and new is None and change.get("old") == change.get("new"):
+                return False
+            return ((start is None or row["timestamp"] >= start) and (end is None or row["timestamp"] < end)
+                    and (after is None or (row["timestamp"], row["id"]) < after))
+
+        rows = [row for row in (*self.store.archived_events.values(), *self.store.events.values()) if matches(row)]
+        rows.sort(key=lambda row: (row["timestamp"], row["id"]), reverse=True)
+        return [self._to_model(row) for row in rows[:limit]]
+
+    async def verify_chain(self, full: bool = False, connect=None, pool=None) -> dict:
+        """
+        Verifies the hash chains of all users, resuming from the last checkpoints unless a full check is requested.
+
+        :param full: Whether to ignore the checkpoints and verify every event again.
+        :param connect: Unused: the checkpoints are kept in the store.
+        :param pool: Unused: the segments are verified in this process.
+        :return: Summary of the verification (see app.jobs.verify_audit_chain).
+        """
+        summary = new_summary()
+        segments = []
+        for user_id, live_ids in self.store.events_by_user.items():
+            event_ids = [*self.store.archived_by_user.get(user_id, []), *live_ids]
+            start_index, start_hash = (0, GENESIS_HASH) if full else self.store.chain_checkpoints.get(user_id, (0, GENESIS_HASH))
+            rows = [
+                (row["id"], row["chain_index"], row["action"], row["timestamp"], row["resource"], row["details"],
+                 row["changes"], row["prev_hash"], row["hash"])
+                for row in (self.store.events.get(event_id) or self.store.archived_events[event_id] for event_id in event_ids)
+                if row["chain_index"] > start_index
+            ]
+            if rows:
+                segments.append((user_id, start_index, start_hash, rows))
+        checkpoints = []
+        record_results(summary, verify_segments(segments), checkpoints)
+        for user_id, chain_index, event_hash in checkpoints:
+            self.store.chain_checkpoints[user_id] = (chain_index, event_hash)
+        return summary
+
+    async def save_verification_run(self, run: VerificationRun):
+        """
+        Creates or updates the report of a verification run.
+
+        :param run: The verification run.
+        """
+        self.store.verification_runs[run.id] = run.model_dump()
+
+    async def get_verification_run(self, run_id: str) -> Optional[VerificationRun]:
+        """
+        Retrieves the report of a verification run.
+
+        :param run_id: The ID of the verification run.
+        :return: The verification run or None if not found.
+        """
+        row = self.store.verification_runs.get(run_id)
+        return VerificationRun(**row) if row else None
+
+    @staticmethod
+    def _to_model(row: dict) -> AuditEvent:
+        """Builds an AuditEvent from a stored row, copying the changes so callers can't alter the store."""
+        return AuditEvent(**{**row, "changes": copy.deepcopy(row["changes"]) if row["changes"] else {}})
+
+
+class InMemoryUserProfileRepository(UserProfileRepository):
+    def __init__(self, store: InMemoryStore, audit_event_repository: Optional[InMemoryAuditEventRepository] = None):
+        """Initializes the repository with an in-memory store instead of a database connection."""
+        super().__init__(connection=None, audit_event_repository=audit_event_repository)
+        self.store = store
+
+    def _audit_event_repository(self) -> AuditEventRepository:
+        """Returns the audit event repository that shares this repository's storage."""
+        if self.audit_event_repository is None:
+            self.audit_event_repository = InMemoryAuditEventRepository(self.store)
+        return self.audit_event_repository
+
+    def _claim_email(self, user_id: str, email: str):
+        """Enforces the unique email constraint, raising the same error as Postgres on conflict."""
+        owner = self.store.emails.get(email)
+        if owner is not None and owner != user_id:
+            raise asyncpg.UniqueViolationError(
+                'duplicate key value violates unique constraint "user_profiles_email_key"'
+            )
+
+    async def _insert(self, user_id: str, name: str, email: str):
+        """Inserts a new, non-deleted user profile row."""
+        self._claim_email(user_id, email)
+        self.store.profiles[user_id] = {"id": user_id, "name": name, "email": email, "is_deleted": False, "deleted_at": None,
+                                        "change_seq": self.store.next_change_seq(), "updated_at": datetime.now()}
+        self.store.emails[email] = user_id
+
+    async def _update_fields(self, user_profile: UserProfile):
+        """Writes the name and email of the given profile, and records the change."""
+        row = self.store.profiles.get(user_profile.id)
+        if row is None:
+            return  # Same as an UPDATE matching no rows
+        self._claim_email(row["id"], user_profile.email)
+        self.store.emails.pop(row["email"], None)
+        row.update(name=user_profile.name, email=user_profile.email, change_seq=self.store.next_change_seq(),
+                   updated_at=datetime.now())
+        self.store.emails[user_profile.email] = row["id"]
+
+    async def _set_deleted(self, user_id: str, is_deleted: bool):
+        """Sets the soft delete flag of a user profile and when it was deleted, and records the change."""
+        row = self.store.profiles.get(user_id)
+        if row is not None:
+            row["is_deleted"] = is_deleted
+            row["deleted_at"] = datetime.now() if is_deleted else None
+            row["change_seq"], row["updated_at"] = self.store.next_change_seq(), datetime.now()
+
+    async def purge_chunk(self, run: PurgeRun, sweep: bool = False) -> int:
+        """Hard deletes the next chunk of profiles of a purge run and saves the run's progress.
+
+        Args:
+            run (PurgeRun): The purge run; its counters and cursor are advanced.
+            sweep (bool): Start from the oldest profile left, ignoring the cursor (nothing is ever locked here).
+
+        Returns:
+            int: The number of profiles purged.
+        """
+        cursor = (run.cursor_deleted_at, run.cursor_id) if run.cursor_deleted_at and not sweep else None
+        candidates = sorted(
+            (row["deleted_at"], row["id"]) for row in self.store.profiles.values()
+            if row["is_deleted"] and row["deleted_at"] < run.cutoff
+        )
+        chunk = [key for key in candidates if cursor is None or key > cursor][:run.chunk_size]
+        rows = [self.store.profiles.pop(user_id) for _, user_id in chunk]
+        change_seq = self.store.next_change_seq()  # One transaction per chunk
+        for row in rows:
+            self.store.emails.pop(row["email"], None)
+            self.store.tombstones[row["id"]] = {"id": row["id"], "change_seq": change_seq, "updated_at": datetime.now()}
+        advance_purge_run(run, rows)
+        await self.save_purge_run(run)
+        return len(rows)
+
+    async def changes_after(self, after: Tuple[int, str], limit: int) -> List[ProfileChange]:
+        """Retrieves the profiles changed after a (change_seq, id) position, tombstones included.
+
+        Args:
+            after (Tuple[int, str]): (change_seq, id) of the last change the client has.
+            limit (int): Maximum number of changes to return.
+
+        Returns:
+            List[ProfileChange]: The changes, ordered by change_seq and id.
+        """
+        changes = [
+            *(ProfileChange(**row, purged=False) for row in self.store.profiles.values() if (row["change_seq"], row["id"]) > after),
+            *(ProfileChange(**row, is_deleted=True, purged=True) for row in self.store.tombstones.values()
+              if (row["change_seq"], row["id"]) > after),
+        ]
+        changes.sort(key=lambda change: (change.change_seq, change.id))
+        return changes[:limit]
+
+    async def save_purge_run(self, run: PurgeRun):
+        """Creates or updates the progress report of a purge run.
+
+        Args:
+            run (PurgeRun): The purge run.
+        """
+        self.store.purge_runs[run.id] = run.model_dump(exclude={"resumable"})
+
+    async def get_purge_run(self, run_id: str):
+        """Retrieves the progress report of a purge run.
+
+        Args:
+            run_id (str): The ID of the purge run.
+
+        Returns:
+            PurgeRun: The purge run or None if not found.
+        """
+        row = self.store.purge_runs.get(run_id)
+        return PurgeRun(**row) if row else None
+
+    async def import_csv(self, chunks, columns: List[str], report: ProfileImport, on_reject=None, new_id=ids.new_id):
+        """Imports streamed CSV rows as new profiles with their CREATE_PROFILE events, with the same checks
+        (in the same order) as the staging tables of the Postgres backend.
+
+        Args:
+            chunks (AsyncIterator[bytes]): The CSV file, header included, in chunks.
+            columns (List[str]): The columns named by the header, in file order.
+            report (ProfileImport): Progress report, updated as the import goes.
+            on_reject (Callable[[ImportReject], None]): Called with every rejected row, in file order.
+            new_id (Callable[[], str]): Draws the ids of the new profiles.
+        """
+        staged, seen = [], set()
+        records = profile_import.iter_records(chunks)
+        await records.__anext__()  # The header
+        async for record in records:
+            if len(record) != len(columns):
+                raise ValueError(f"Row {report.rows + 1} has {len(record)} columns instead of {len(columns)}")
+            report.rows += 1
+            fields = {column: value.strip(" ") for column, value in zip(columns, record)}
+            name, email = fields["name"], fields["email"]
+            reason = profile_import.check_fields(name, email)
+            if reason is None:
+                reason = profile_import.DUPLICATE_EMAIL if email in seen else None
+                seen.add(email)
+            if reason is None and email in self.store.emails:
+                reason = profile_import.EMAIL_EXISTS
+            if reason is None and not profile_import.is_valid_email(email):
+                reason = profile_import.INVALID_EMAIL
+            staged.append((report.rows, name, email, reason))
+
+        # Nothing is written before the whole file was read, like the single transaction of the Postgres backend
+        report.phase = "merging"
+        for row, name, email, reason in staged:
+            if reason is None:
+                event = profile_import.import_event(new_id(), name, email)
+                await self._insert(event["user_id"], name, email)
+                self.store.events[event["id"]] = event
+                self.store.events_by_user[event["user_id"]].append(event["id"])
+                report.imported += 1
+            else:
+                profile_import.record_reject(report, ImportReject(row=row, name=name or None, email=email or None,
+                                                                  reason=reason), on_reject)
+
+    async def get_by_id(self, user_id: str) -> UserProfile:
+        """Retrieves a user profile by its ID.
+
+        Args:
+            user_id (str): The ID of the user profile.
+
+        Returns:
+            UserProfile: The corresponding user profile or None if not found.
+        """
+        row = self.store.profiles.get(user_id)
+        return UserProfile(**row) if row else None
+
+    async def get_many(self, user_ids: List[str]) -> Dict[str, UserProfile]:
+        """Retrieves several user profiles.
+
+        Args:
+            user_ids (List[str]): The IDs of the user profiles.
+
+        Returns:
+            Dict[str, UserProfile]: The profiles found, indexed by ID (missing IDs are absent).
+        """
+        rows = (self.store.profiles.get(user_id) for user_id in set(user_ids))
+        return {row["id"]: UserProfile(**row) for row in rows if row}
+
+    async def existing_emails(self, emails: List[str]) -> Set[str]:
+        """Returns which of the given emails are already used by a profile.
+
+        Args:
+            emails (List[str]): The emails to look up.
+
+        Returns:
+            Set[str]: The emails found.
+        """
+        return {email for email in emails if email in self.store.emails}
+
+    async def list_profiles(self, active_only: bool = False, include: Tuple[str, ...] = (), after: Optional[str] = None,
+                            limit: Optional[int] = None) -> List[ProfileListItem]:
+        """Retrieves a page of profiles in id order, with their latest audit event and event count if asked for.
+
+        Args:
+            active_only (bool): Whether soft-deleted profiles are left out.
+            include (Tuple[str, ...]): The activity to embed, from PROFILE_LIST_INCLUDES.
+            after (str): ID of the last profile of the previous page; None from the start.
+            limit (int): Maximum number of profiles to return; None for all of them.
+
+        Returns:
+            List[ProfileListItem]: The profiles, ordered by id.
+        """
+        rows = sorted((row for row in self.store.profiles.values()
+                       if (after is None or row["id"] > after) and not (active_only and row["is_deleted"])),
+                      key=lambda row: row["id"])[:limit]
+        items = []
+        for row in rows:
+            fields = {key: row[key] for key in ("id", "name", "email", "is_deleted", "deleted_at")}
+            events = [self.store.events[event_id] for event_id in self.store.events_by_user.get(row["id"], [])]
+            if "last_event" in include:
+                last = max(events, key=lambda event: (event["timestamp"], event["id"]), default=None)
+                fields["last_event"] = InMemoryAuditEventRepository._to_model(last) if last else None
+            if "event_count" in include:
+                checkpoint = self.store.audit_checkpoints.get(row["id"])
+                fields["event_count"] = len(events) + (checkpoint["event_count"] if checkpoint else 0)
+            items.append(ProfileListItem(**fields))
+        return items
+
+    async def get_all(self) -> List[UserProfile]:
+        """Retrieves all user profiles from the store.
+
+        Returns:
+            List[UserProfile]: A list of all user profiles.
+        """
+        return [UserProfile(**row) for row in self.store.profiles.values()]
+
+    async def get_all_active(self) -> List[UserProfile]:
+        """Retrieves all user profiles that are not deleted.
+
+        Returns:
+            List[UserProfile]: A list of active user profiles.
+        """
+        return [UserProfile(**row) for row in self.store.profiles.values() if not row["is_deleted"]]
+
+    async def get_all_inactive(self) -> List[UserProfile]:
+        """Retrieves all user profiles, including deleted ones.
+
+        Returns:
+            List[UserProfile]: A list of all user profiles.
+        """
+        return await self.get_all()
@@ -0,0 +1,717 @@
+import asyncio
+import csv
+import heapq
+import io
+from collections import Counter, defaultdict
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import datetime
+from functools import partial
+from itertools import islice
+from typing import Dict, List, Optional, Set, Tuple
+import asyncpg
+from fastapi import HTTPException
+from app import database, ids, profile_import
+from app.jobs.verify_audit_chain import add_summary, new_summary, worker_pool
+from app.models.audit_event import AuditEvent, AuditEventAction, AuditEventBase, AuditHistory
+from app.models.audit_verification import VerificationRun
+from app.models.profile_import import ImportReject, ProfileImport
+from app.models.purge import PurgeRun, PurgeStatus
+from app.models.user_profile import ProfileChangePage, ProfileListItem, UserProfile, UserProfileCreate
+from app.pagination import NO_ID, encode_change_cursor
+from app.repositories.audit_event_repository import AuditEventRepository
+from app.repositories.user_profile_repository import UserProfileRepository
+from app.sharding import DIRECTORY_SHARD, shard_for
+
+# Repositories over several shards (see app/sharding.py), with the interface of the single-database ones.
+#
+# Every shard is a pair of ordinary repositories (Postgres or in-memory) opened on first use, so a request
+# about one user only holds a connection to that user's shard. Lists, searches and aggregates run on all
+# shards concurrently and are merged in the order the single-database queries return.
+#
+# Emails are unique per database; across shards, writes that set an email first lock it on the directory
+# shard (until its transaction ends) and check that no other shard uses it.
+
+EMAIL_LOCK_CLASS = 72_617_002  # First key of the two-key advisory locks on emails
+# Email locks of several emails in one round trip, taken in a fixed order
+LOCK_EMAILS = "SELECT pg_advisory_xact_lock($1, hashtext(e)) FROM (SELECT e FROM unnest($2::text[]) AS e ORDER BY e) AS emails"
+SHARDED_IMPORT_BATCH_SIZE = 500  # Rows checked across shards and imported at a time (one email lock each)
+DUPLICATE_EMAIL_ERROR = 'duplicate key value violates unique constraint "user_profiles_email_key"'
+
+
+class ShardSet:
+    def __init__(self, count: int, open_shard):
+        """
+        Initializes the shards of a request or a job; each one is opened on first use.
+
+        Args:
+            count (int): The number of shards.
+            open_shard (Callable[[int], Awaitable[Tuple[UserProfileRepository, AuditEventRepository]]]): Opens
+                the repositories of a shard.
+        """
+        self.count = count
+        self._open_shard = open_shard
+        self._shards: Dict[int, Tuple[UserProfileRepository, AuditEventRepository]] = {}
+
+    async def get(self, index: int) -> Tuple[UserProfileRepository, AuditEventRepository]:
+        """Returns the repositories of a shard, opening it if needed."""
+        if index not in self._shards:
+            self._shards[index] = await self._open_shard(index)
+        return self._shards[index]
+
+    async def for_user(self, user_id: str) -> Tuple[UserProfileRepository, AuditEventRepository]:
+        """Returns the repositories of the shard holding a user."""
+        return await self.get(shard_for(user_id, self.count))
+
+    async def all(self) -> List[Tuple[UserProfileRepository, AuditEventRepository]]:
+        """Returns the repositories of every shard, in shard order."""
+        return [await self.get(index) for index in range(self.count)]
+
+    def opened(self) -> List[Tuple[UserProfileRepository, AuditEventRepository]]:
+        """Returns the repositories of the shards opened so far."""
+        return [self._shards[index] for index in sorted(self._shards)]
+
+    @asynccontextmanager
+    async def email_lock(self, emails: List[str]):
+        """
+        Serializes the writes of some emails across shards: the locks are held until the transaction of the
+        directory shard ends (the unit of work's, or one opened for the block).
+
+        Args:
+            emails (List[str]): The emails about to be written.
+        """
+        profiles, _ = await self.get(DIRECTORY_SHARD)
+        connection = profiles.connection
+        if connection is None or not emails:
+            yield  # In-memory shards: nothing runs between the check and the write
+        elif connection.is_in_transaction():
+            await connection.execute(LOCK_EMAILS, EMAIL_LOCK_CLASS, sorted(set(emails)))
+            yield
+        else:
+            async with connection.transaction():
+                await connection.execute(LOCK_EMAILS, EMAIL_LOCK_CLASS, sorted(set(emails)))
+                yield
+
+
+def in_memory_shards(stores) -> ShardSet:
+    """
+    Builds a set of in-memory shards, one per store (tests, local load generation).
+
+    Args:
+        stores (List[InMemoryStore]): The store of each shard.
+
+    Returns:
+        ShardSet: The shards.
+    """
+    from app.repositories.memory import InMemoryAuditEventRepository, InMemoryUserProfileRepository
+
+    async def open_shard(index):
+        events = InMemoryAuditEventRepository(stores[index])
+        return InMemoryUserProfileRepository(stores[index], audit_event_repository=events), events
+    return ShardSet(len(stores), open_shard)
+
+
+@asynccontextmanager
+async def sharded_repositories(connect=database.connect_to_shard):
+    """
+    Provides sharded repositories holding a connection to each shard they touch, given back on exit
+    (requests without a unit of work, jobs).
+
+    Args:
+        connect (Callable[[int], Awaitable[asyncpg.Connection]]): Opens a connection to a shard.
+
+    Yields:
+        Tuple[ShardedUserProfileRepository, ShardedAuditEventRepository]: The repositories.
+    """
+    async with AsyncExitStack() as stack:
+        async def open_shard(index):
+            connection = await connect(index)
+            stack.push_async_callback(database.close_db_connection, connection)
+            events = AuditEventRepository(connection)
+            return UserProfileRepository(connection, audit_event_repository=events), events
+
+        shards = ShardSet(len(database.DATABASE_SHARD_URLS), open_shard)
+        events = ShardedAuditEventRepository(shards)
+        yield ShardedUserProfileRepository(shards, audit_event_repository=events), events
+
+
+def _nulls_last(value):
+    """Sort key ordering None after every other value, like ORDER BY does in Postgres."""
+    return (value is None, value if value is not None else "")
+
+
+class ShardedAuditEventRepository:
+    def __init__(self, shards: ShardSet):
+        """
+        Initializes the repository over a set of shards; events are stored on the shard of their user.
+
+        :param shards: The shards.
+        """
+        self.shards = shards
+        self.connection = None  # Spread over one connection per shard
+
+    async def _shard(self, user_id: str) -> AuditEventRepository:
+        return (await self.shards.for_user(user_id))[1]
+
+    async def _scatter(self, call) -> list:
+        """Runs a call on the audit event repository of every shard concurrently, returning the results in shard order."""
+        return await asyncio.gather(*(call(events) for _, events in await self.shards.all()))
+
+    async def create(self, audit_event: AuditEvent):
+        """
+        Creates an audit event on the shard of its user.
+
+        :param audit_event: The event to be recorded.
+        """
+        await (await self._shard(audit_event.user_id)).create(audit_event)
+
+    async def flush(self):
+        """
+        Writes the events queued in buffered mode on the shards opened so far.
+        """
+        for _, events in self.shards.opened():
+            await events.flush()
+
+    async def create_many(self, audit_events: List[AuditEventBase]):
+        """
+        Creates audit events on the shards of their users, keeping their order per user.
+
+        :param audit_events: The events to be recorded.
+        """
+        by_shard = defaultdict(list)
+        for audit_event in audit_events:
+            by_shard[shard_for(audit_event.user_id, self.shards.count)].append(audit_event)
+        for index, shard_events in by_shard.items():
+            await (await self.shards.get(index))[1].create_many(shard_events)
+
+    async def seal_legacy_events(self, user_id: str):
+        """
+        Seals the legacy events of a user into the hash chain on the user's shard.
+
+        :param user_id: ID of the user.
+        """
+        await (await self._shard(user_id)).seal_legacy_events(user_id)
+
+    async def get_by_user_id(self, user_id: str):
+        """
+        Retrieves all audit events of a user, oldest first, from the user's shard.
+
+        :param user_id: ID of the user.
+        :return: List of audit events related to the user.
+        """
+        return await (await self._shard(user_id)).get_by_user_id(user_id)
+
+    async def get_all(self) -> List[AuditEvent]:
+        """
+        Retrieves all audit events of every shard, ordered by timestamp and id.
+
+        :return: List of all audit events.
+        """
+        events = [event for shard_events in await self._scatter(lambda events: events.get_all()) for event in shard_events]
+        return sorted(events, key=lambda event: (event.timestamp, event.id))
+
+    async def get_by_id(self, event_id: str):
+        """
+        Retrieves a specific audit event by its ID, looking it up on every shard (event ids don't name a shard).
+
+        :param event_id: ID of the audit event to be retrieved.
+        :return: The audit event if found, otherwise None.
+        """
+        if not ids.is_valid(event_id):
+            return None
+        return next((event for event in await self._scatter(lambda events: events.get_by_id(event_id)) if event), None)
+
+    async def get_many(self, event_ids: List[str]) -> Dict[str, AuditEvent]:
+        """
+        Retrieves several audit events, one query per shard.
+
+        :param event_ids: IDs of the audit events to be retrieved.
+        :return: The audit events found, indexed by ID (missing IDs are absent).
+        """
+        found = {}
+        for shard_events in await self._scatter(lambda events: events.get_many(event_ids)):
+            found.update(shard_events)
+        return found
+
+    async def count_by_bucket(self, bucket_size: str, group_by: tuple, start: datetime, end: datetime) -> List[dict]:
+        """
+        Counts the audit events of every shard per time bucket, adding up the counts of the shards.
+
+        :param bucket_size: Unit of the buckets ("hour" or "day").
+        :param group_by: Columns to group by within each bucket, from app.analytics.GROUP_COLUMNS.
+        :param start: Start of the range (inclusive).
+        :param end: End of the range (exclusive).
+        :return: Rows with "bucket", the grouped columns and "count", ordered by bucket.
+        """
+        counts = Counter()
+        for rows in await self._scatter(lambda events: events.count_by_bucket(bucket_size, group_by, start, end)):
+            for row in rows:
+                counts[(row["bucket"], *(row[column] for column in group_by))] += row["count"]
+        return [
+            {"bucket": key[0], **dict(zip(group_by, key[1:])), "count": count}
+            for key, count in sorted(counts.items(), key=lambda item: tuple(_nulls_last(value) for value in item[0]))
+        ]
+
+    async def replayed_until(self) -> Optional[datetime]:
+        """
+        Tells how far the shards are behind their primaries: the furthest behind replica decides.
+
+        :return: The earliest last replayed commit time of the shards, or None if every shard is a primary.
+        """
+        replayed = [timestamp for timestamp in await self._scatter(lambda events: events.replayed_until()) if timestamp]
+        return min(replayed) if replayed else None
+
+    async def find_field_changes(self, field: str, old: Optional[str] = None, new: Optional[str] = None,
+                                 value: Optional[str] = None, start: Optional[datetime] = None,
+                                 end: Optional[datetime] = None, after: Optional[tuple] = None,
+                                 limit: int = 100) -> List[AuditEvent]:
+        """
+        Finds the audit events of every shard that touched a field, newest first. Each shard returns its
+        first `limit` matches after the cursor, and the sorted lists are merged.
+
+        :param field: Name of the field, e.g. "email".
+        :param old: Only events whose old value of the field was this.
+        :param new: Only events whose new value of the field was this.
+        :param value: Only events where the field had this value, before or after the event.
+        :param start: Only events at or after this time.
+        :param end: Only events before this time.
+        :param after: (timestamp, id) of the last event of the previous page.
+        :param limit: Maximum number of events to return.
+        :return: The matching audit events, ordered by timestamp and id, descending.
+        """
+        pages = await self._scatter(lambda events: events.find_field_changes(
+            field, old=old, new=new, value=value, start=start, end=end, after=after, limit=limit
+        ))
+        return list(islice(heapq.merge(*pages, key=lambda event: (event.timestamp, event.id), reverse=True), limit))
+
+    async def verify_chain(self, full: bool = False) -> dict:
+        """
+        Verifies the hash chains on every shard, each against the checkpoints stored on that shard, and adds
+        up the summaries.
+
+        :param full: Whether to ignore the checkpoints and verify every event again.
+        :return: Summary of the verification (see app.jobs.verify_audit_chain).
+        """
+        summary = new_summary()
+        with worker_pool() as pool:  # Shared by the shards, which are verified one after the other
+            for index, (_, events) in enumerate(await self.shards.all()):
+                add_summary(summary, await events.verify_chain(full=full, connect=partial(database.connect_to_shard, index), pool=pool))
+        return summary
+
+    async def save_verification_run(self, run: VerificationRun):
+        """
+        Creates or updates the report of a verification run, kept on the directory shard.
+
+        :param run: The verification run.
+        """
+        await (await self.shards.get(DIRECTORY_SHARD))[1].save_verification_run(run)
+
+    async def get_verification_run(self, run_id: str) -> Optional[VerificationRun]:
+        """
+        Retrieves the report of a verification run from the directory shard.
+
+        :param run_id: The ID of the verification run.
+        :return: The verification run or None if not found.
+        """
+        return await (await self.shards.get(DIRECTORY_SHARD))[1].get_verification_run(run_id)
+
+    async def get_checkpoint(self, user_id: str):
+        """
+        Retrieves the compaction checkpoint of a user's audit history, from the user's shard.
+
+        :param user_id: ID of the user.
+        :return: The checkpoint, or None if the user's history was never compacted.
+        """
+        return await (await self._shard(user_id)).get_checkpoint(user_id)
+
+    async def get_history(self, user_id: str) -> AuditHistory:
+        """
+        Retrieves a user's audit history (checkpoint and live events) from the user's shard.
+
+        :param user_id: ID of the user.
+        :return: The checkpoint (if any) and the remaining events, oldest first.
+        """
+        return await (await self._shard(user_id)).get_history(user_id)
+
+    async def compact(self, user_id: str, up_to_index: int) -> int:
+        """
+        Compacts a user's history on the user's shard.
+
+        :param user_id: ID of the user whose history should be compacted.
+        :param up_to_index: Chain index of the last event to fold.
+        :return: Number of events folded.
+        """
+        return await (await self._shard(user_id)).compact(user_id, up_to_index)
+
+
+class ShardedUserProfileRepository:
+    def __init__(self, shards: ShardSet, audit_event_repository: Optional[ShardedAuditEventRepository] = None):
+        """Initializes the repository over a set of shards; profiles are stored on the shard of their id.
+
+        Args:
+            shards (ShardSet): The shards.
+            audit_event_repository (ShardedAuditEventRepository): Repository recording the audit events; by
+                default one over the same shards.
+        """
+        self.shards = shards
+        self.audit_event_repository = audit_event_repository or ShardedAuditEventRepository(shards)
+        self.connection = None  # Spread over one connection per shard
+
+    async def _shard(self, user_id: str) -> UserProfileRepository:
+        return (await self.shards.for_user(user_id))[0]
+
+    async def _scatter(self, call) -> list:
+        """Runs a call on the profile repository of every shard concurrently, returning the results in shard order."""
+        return await asyncio.gather(*(call(profiles) for profiles, _ in await self.shards.all()))
+
+    async def existing_emails(self, emails: List[str]) -> Set[str]:
+        """Returns which of the given emails are already used by a profile, on any shard.
+
+        Args:
+            emails (List[str]): The emails to look up.
+
+        Returns:
+            Set[str]: The emails found.
+        """
+        return set().union(*await self._scatter(lambda profiles: profiles.existing_emails(emails)))
+
+    async def foreign_emails(self, emails: Dict[str, str]) -> Set[str]:
+        """Returns which emails are already used by a profile of another shard than their user's (the own shard's
+        constraint covers it). Call under the emails' lock.
+
+        Args:
+            emails (Dict[str, str]): Email about to be written, by user id.
+
+        Returns:
+            Set[str]: The emails found on another shard.
+        """
+        found = await self._scatter(lambda profiles: profiles.existing_emails(list(emails.values())))
+        return {email for user_id, email in emails.items()
+                if any(email in found[index] for index in range(self.shards.count) if index != shard_for(user_id, self.shards.count))}
+
+    async def _check_email(self, email: str, user_id: str):
+        """Raises the unique violation of Postgres if another shard has a profile with the email (the own shard's
+        constraint covers it). Called under the email's lock."""
+        own_shard = shard_for(user_id, self.shards.count)
+        for index, (profiles, _) in enumerate(await self.shards.all()):
+            if index != own_shard and await profiles.existing_emails([email]):
+                raise asyncpg.UniqueViolationError(DUPLICATE_EMAIL_ERROR)
+
+    async def create(self, user_profile: UserProfileCreate, user_id: Optional[str] = None) -> UserProfile:
+        """Creates a new user profile and its audit event on the shard of its new id.
+
+        Args:
+            user_profile (UserProfileCreate): Data for the new user profile.
+            user_id (str): ID of the new profile; drawn by default.
+
+        Returns:
+            UserProfile: The created user profile.
+        """
+        user_id = user_id or ids.new_id()
+        async with self.shards.email_lock([user_profile.email]):
+            await self._check_email(user_profile.email, user_id)
+            return await (await self._shard(user_id)).create(user_profile, user_id=user_id)
+
+    async def get_by_id(self, user_id: str) -> UserProfile:
+        """Retrieves a user profile by its ID from its shard.
+
+        Args:
+            user_id (str): The ID of the user profile.
+
+        Returns:
+            UserProfile: The corresponding user profile or None if not found.
+        """
+        if not ids.is_valid(user_id):
+            return None
+        return await (await self._shard(user_id)).get_by_id(user_id)
+
+    async def get_many(self, user_ids: List[str]) -> Dict[str, UserProfile]:
+        """Retrieves several user profiles with one query per shard holding some of them.
+
+        Args:
+            user_ids (List[str]): The IDs of the user profiles.
+
+        Returns:
+            Dict[str, UserProfile]: The profiles found, indexed by ID (missing IDs are absent).
+        """
+        by_shard = defaultdict(list)
+        for user_id in set(user_ids):
+            if ids.is_valid(user_id):
+                by_shard[shard_for(user_id, self.shards.count)].append(user_id)
+        shards = [(await self.shards.get(index))[0] for index in by_shard]
+        found = {}
+        for profiles in await asyncio.gather(*(shard.get_many(by_shard[index]) for shard, index in zip(shards, by_shard))):
+            found.update(profiles)
+        return found
+
+    async def update(self, user_profile: UserProfile) -> UserProfile:
+        """Updates an existing user profile on its shard and logs an audit event.
+
+        Args:
+            user_profile (UserProfile): The user profile with updated data.
+
+        Returns:
+            UserProfile: The updated user profile.
+        """
+        async with self.shards.email_lock([user_profile.email]):
+            await self._check_email(user_profile.email, user_profile.id)
+            return await (await self._shard(user_profile.id)).update(user_profile)
+
+    async def delete(self, user_id: str):
+        """Marks a user profile as deleted (soft delete) on its shard.
+
+        Args:
+            user_id (str): The ID of the user profile to be marked as deleted.
+        """
+        await (await self._shard(user_id)).delete(user_id)
+
+    async def restore(self, user_id: str):
+        """Restores a deleted user profile on its shard.
+
+        Args:
+            user_id (str): The ID of the user profile to be restored.
+        """
+        return await (await self._shard(user_id)).restore(user_id)
+
+    async def _gather_profiles(self, call) -> List[UserProfile]:
+        """Concatenates the profiles returned by every shard, ordered by id (time-ordered)."""
+        profiles = [profile for shard_profiles in await self._scatter(call) for profile in shard_profiles]
+        return sorted(profiles, key=lambda profile: profile.id)
+
+    async def get_all(self) -> List[UserProfile]:
+        """Retrieves all user profiles of every shard.
+
+        Returns:
+            List[UserProfile]: A list of all user profiles, ordered by id.
+        """
+        return await self._gather_profiles(lambda profiles: profiles.get_all())
+
+    async def get_all_active(self) -> List[UserProfile]:
+        """Retrieves the user profiles of every shard that are not deleted.
+
+        Returns:
+            List[UserProfile]: A list of active user profiles, ordered by id.
+        """
+        return await self._gather_profiles(lambda profiles: profiles.get_all_active())
+
+    async def get_all_inactive(self) -> List[UserProfile]:
+        """Retrieves all user profiles of every shard, including deleted ones.
+
+        Returns:
+            List[UserProfile]: A list of all user profiles, ordered by id.
+        """
+        return await self._gather_profiles(lambda profiles: profiles.get_all_inactive())
+
+    async def list_profiles(self, active_only: bool = False, include: Tuple[str, ...] = (), after: Optional[str] = None,
+                            limit: Optional[int] = None) -> List[ProfileListItem]:
+        """Retrieves a page of profiles in id order from every shard, with their activity if asked for (events
+        are on their user's shard). Each shard returns its first `limit` profiles after the cursor.
+
+        Args:
+            active_only (bool): Whether soft-deleted profiles are left out.
+            include (Tuple[str, ...]): The activity to embed, from PROFILE_LIST_INCLUDES.
+            after (str): ID of the last profile of the previous page; None from the start.
+            limit (int): Maximum number of profiles to return; None for all of them.
+
+        Returns:
+            List[ProfileListItem]: The profiles, ordered by id.
+        """
+        pages = await self._scatter(lambda profiles: profiles.list_profiles(active_only, include, after, limit))
+        return list(islice(heapq.merge(*pages, key=lambda profile: profile.id), limit))
+
+    async def get_changes(self, after: Optional[List[Tuple[int, str]]] = None, limit: int = 1000) -> ProfileChangePage:
+        """Retrieves a page of the delta sync feed of every shard.
+
+        Change sequences are transaction ids of each shard's database, so the position has one entry per
+        shard. Each shard returns its next changes in order; the page takes them oldest first (by
+        updated_at), never past a change of the same shard it didn't take.
+
+        Args:
+            after (List[Tuple[int, str]]): The position of the client, one (change_seq, id) per shard;
+                None from the start.
+            limit (int): Maximum number of changes to return.
+
+        Returns:
+            ProfileChangePage: The changes, the cursor of the position reached and whether there are more.
+
+        Raises:
+            ValueError: If the position doesn't have one entry per shard, e.g. it was reached before a resharding.
+        """
+        positions = list(after) if after is not None else [(-1, NO_ID)] * self.shards.count
+        if len(positions) != self.shards.count:
+            raise ValueError("Invalid cursor")
+        pages = await asyncio.gather(*(
+            profiles.changes_after(positions[index], limit + 1) for index, (profiles, _) in enumerate(await self.shards.all())
+        ))
+        merged = heapq.merge(*(
+            [(change.updated_at, index, change.change_seq, change) for change in page] for index, page in enumerate(pages)
+        ), key=lambda entry: entry[:3])  # Keeps the order of each shard, whatever the timestamps
+        changes = []
+        for _, index, change_seq, change in islice(merged, limit):
+            changes.append(change)
+            positions[index] = (change_seq, change.id)
+        return ProfileChangePage(changes=changes, cursor=encode_change_cursor(positions),
+                                 has_more=sum(len(page) for page in pages) > len(changes))
+
+    async def purge_chunk(self, run: PurgeRun, sweep: bool = False) -> int:
+        """Hard deletes the next chunk of profiles of a purge run, shard after shard.
+
+        Each shard keeps its own run report (id "<run id>/<shard>") with its keyset cursor; a chunk that
+        comes short on a shard continues on the next one. A shard is only done once a chunk purges nothing
+        there: a short chunk may have skipped locked rows. The run's counters add up the shard runs.
+
+        Args:
+            run (PurgeRun): The purge run; its counters are advanced.
+            sweep (bool): The final pass: every shard starts from its oldest profile left and waits for locked rows.
+
+        Returns:
+            int: The number of profiles purged.
+        """
+        purged, shard_runs = 0, []
+        for index, (profiles, _) in enumerate(await self.shards.all()):
+            shard_run = await profiles.get_purge_run(f"{run.id}/{index}") or run.model_copy(update={
+                "id": f"{run.id}/{index}", "purged": 0, "chunks": 0, "cursor_deleted_at": None, "cursor_id": None,
+            })
+            if (sweep or shard_run.status != PurgeStatus.COMPLETED) and purged < run.chunk_size:
+                shard_run.chunk_size = run.chunk_size - purged
+                shard_purged = await profiles.purge_chunk(shard_run, sweep)  # Saves the shard run in the same transaction
+                purged += shard_purged
+                if not shard_purged:
+                    shard_run.status = PurgeStatus.COMPLETED
+                    await profiles.save_purge_run(shard_run)
+            shard_runs.append(shard_run)
+        run.purged = sum(shard_run.purged for shard_run in shard_runs)
+        run.chunks += 1 if purged else 0
+        run.updated_at = datetime.now()
+        await self.save_purge_run(run)
+        return purged
+
+    async def save_purge_run(self, run: PurgeRun):
+        """Creates or updates the progress report of a purge run, kept on the directory shard.
+
+        Args:
+            run (PurgeRun): The purge run.
+        """
+        await (await self.shards.get(DIRECTORY_SHARD))[0].save_purge_run(run)
+
+    async def get_purge_run(self, run_id: str) -> Optional[PurgeRun]:
+        """Retrieves the progress report of a purge run from the directory shard.
+
+        Args:
+            run_id (str): The ID of the purge run.
+
+        Returns:
+            PurgeRun: The purge run or None if not found.
+        """
+        return await (await self.shards.get(DIRECTORY_SHARD))[0].get_purge_run(run_id)
+
+    async def import_csv(self, chunks, columns: List[str], report: ProfileImport, on_reject=None, new_id=ids.new_id):
+        """Imports streamed CSV rows as new profiles, spread over the shards.
+
+        Rows are read SHARDED_IMPORT_BATCH_SIZE at a time. Rows with an email used earlier in the file or on
+        any shard are rejected here; the others are dealt out to the shards, whose own import runs the
+        remaining checks and merges them in one transaction per shard and batch. Unlike a single-database
+        import, the batches committed before a failure stay imported.
+
+        Args:
+            chunks (AsyncIterator[bytes]): The CSV file, header included, in chunks.
+            columns (List[str]): The columns named by the header, in file order.
+            report (ProfileImport): Progress report, updated as the import goes.
+            on_reject (Callable[[ImportReject], None]): Called with every rejected row, in file order.
+            new_id (Callable[[], str]): Draws the ids of the new profiles; each shard only keeps its own.
+        """
+        seen, batch = set(), []
+        records = profile_import.iter_records(chunks)
+        await records.__anext__()  # The header
+        report.phase = "merging"
+        async for record in records:
+            if len(record) != len(columns):
+                raise ValueError(f"Row {report.rows + 1} has {len(record)} columns instead of {len(columns)}")
+            report.rows += 1
+            fields = dict(zip(columns, record))
+            batch.append((report.rows, fields["name"], fields["email"]))
+            if len(batch) == SHARDED_IMPORT_BATCH_SIZE:
+                await self._import_batch(batch, report, on_reject, new_id, seen)
+                batch = []
+        if batch:
+            await self._import_batch(batch, report, on_reject, new_id, seen)
+
+    async def _import_batch(self, batch: list, report: ProfileImport, on_reject, new_id, seen: set):
+        """Imports a batch of (row, name, email) rows of the file (see import_csv)."""
+        rejects, by_shard = [], defaultdict(list)
+        candidates = []  # (row, name, email, whether the fields pass their checks)
+        for row, name, email in batch:
+            checked = profile_import.check_fields(name.strip(" "), email.strip(" ")) is None
+            if checked and email.strip(" ") in seen:
+                rejects.append(ImportReject(row=row, name=name.strip(" "), email=email.strip(" "),
+                                            reason=profile_import.DUPLICATE_EMAIL))
+                continue
+            if checked:
+                seen.add(email.strip(" "))
+            candidates.append((row, name, email, checked))
+
+        emails = [email.strip(" ") for _, _, email, checked in candidates if checked]
+        async with self.shards.email_lock(emails):
+            existing = await self.existing_emails(emails)
+            for row, name, email, checked in candidates:
+                if checked and email.strip(" ") in existing:
+                    rejects.append(ImportReject(row=row, name=name.strip(" "), email=email.strip(" "),
+                                                reason=profile_import.EMAIL_EXISTS))
+                else:  # Rows failing their field checks are rejected by the shard's import
+                    by_shard[(row - 1) % self.shards.count].append((row, name, email))  # Dealt out in turn
+
+            for index, rows in by_shard.items():
+                profiles, _ = await self.shards.get(index)
+                shard_report = ProfileImport(id=report.id, status=report.status, started_at=report.started_at)
+                collected = []
+                await profiles.import_csv(_csv_chunks(rows), ["name", "email"], shard_report,
+                                          on_reject=collected.append, new_id=lambda: _shard_id(new_id, index, self.shards.count))
+                report.imported += shard_report.imported
+                rejects += [reject.model_copy(update={"row": rows[reject.row - 1][0]}) for reject in collected]
+
+        for reject in sorted(rejects, key=lambda reject: reject.row):
+            profile_import.record_reject(report, reject, on_reject)
+
+    async def create_audit_event(self, new_audit_event: AuditEvent):
+        """Creates an audit event on the shard of its user.
+
+        Args:
+            new_audit_event (AuditEvent): The audit event to be created.
+        """
+        await self.audit_event_repository.create(new_audit_event)
+
+    async def rollback_changes_by_event_id(self, audit_event_id: str):
+        """
+        Rolls back an audit event by its ID on the shard of its user.
+
+        Args:
+            audit_event_id (str): ID of the audit event to be rolled back.
+        """
+        audit_event = await self.audit_event_repository.get_by_id(audit_event_id)
+        if not audit_event:
+            raise HTTPException(status_code=404, detail="Audit event not found.")
+
+        profiles = await self._shard(audit_event.user_id)
+        email = (audit_event.changes or {}).get("email")
+        if audit_event.action != AuditEventAction.DELETE_PROFILE and isinstance(email, dict) and email.get("old"):
+            async with self.shards.email_lock([email["old"]]):  # The rollback may set the email back
+                await self._check_email(email["old"], audit_event.user_id)
+                await profiles.rollback_changes_by_event_id(audit_event_id)
+        else:
+            await profiles.rollback_changes_by_event_id(audit_event_id)
+
+
+def _shard_id(new_id, index: int, count: int) -> str:
+    """Draws ids until one belongs to the given shard (count draws on average)."""
+    while True:
+        user_id = new_id()
+        if shard_for(user_id, count) == index:
+            return user_id
+
+
+async def _csv_chunks(rows: list):
+    """Writes (row, name, email) rows back as a CSV file with a name,email header, in one chunk."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["name", "email"])
+    writer.writerows((name, email) for _, name, email in rows)
+    yield buffer.getvalue().encode()
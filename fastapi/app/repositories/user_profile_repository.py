@@ -1,31 +1,253 @@
+import asyncio
 import asyncpg
-from app.models.user_profile import UserProfile, UserProfileCreate
-import uuid
-from typing import List
+import json
+from app.models.user_profile import ProfileChange, ProfileChangePage, ProfileListItem, UserProfile, UserProfileCreate
+from typing import Dict, List, Optional, Set, Tuple
 from fastapi import HTTPException
 from datetime import datetime
 from app.models.audit_event import AuditEvent, AuditEventAction, AuditEventBase
-from app.repositories.audit_event_repository import AuditEventRepository
+from app.models.profile_import import ImportReject, ProfileImport
+from app.models.purge import PurgeRun
+from app import ids, profile_import
+from app.audit_chain import GENESIS_HASH
+from app.pagination import NO_ID, encode_change_cursor
+from app.repositories.audit_event_repository import EVENT_COLUMNS, AuditEventRepository
+
+# Single-id lookups run on almost every request; they are prepared on each pooled connection at startup
+SELECT_BY_ID = "SELECT * FROM user_profiles WHERE id = $1"
+HOT_STATEMENTS = (SELECT_BY_ID,)
+
+# One chunk of the purge (see app/jobs/purge_deleted_profiles.py): the next profiles soft deleted before the
+# cutoff in (deleted_at, id) order, starting after the run's keyset cursor. Rows locked by a concurrent
+# restore are skipped rather than waited for, which leaves them behind the cursor: the run ends with a sweep
+# from the start that waits for them instead (purged rows are gone, so it needs no cursor). Purged profiles
+# leave a tombstone for the delta sync feed.
+PURGE_CHUNK = """
+    WITH chunk AS (
+        SELECT id FROM user_profiles
+        WHERE is_deleted AND deleted_at < $1 {after}
+        ORDER BY deleted_at, id
+        LIMIT {limit}
+        {lock}
+    ), purged AS (
+        DELETE FROM user_profiles p USING chunk WHERE p.id = chunk.id
+        RETURNING p.id, p.deleted_at
+    ), tombstones AS (
+        INSERT INTO user_profile_tombstones (id) SELECT id::uuid FROM purged ON CONFLICT (id) DO NOTHING
+    )
+    SELECT id, deleted_at FROM purged
+"""
+PURGE_FIRST_CHUNK = PURGE_CHUNK.format(after="", limit="$2", lock="FOR UPDATE SKIP LOCKED")
+PURGE_NEXT_CHUNK = PURGE_CHUNK.format(after="AND (deleted_at, id) > ($2, $3)", limit="$4", lock="FOR UPDATE SKIP LOCKED")
+PURGE_SWEEP_CHUNK = PURGE_CHUNK.format(after="", limit="$2", lock="FOR UPDATE")
+
+# Delta sync feed: profiles and tombstones changed after a (change_seq, id) position, in that order. The
+# change_seq of a row is the id of the transaction that last wrote it (the column default), so only rows
+# written by transactions older than every transaction still running are returned: none of those can
+# commit later with a lower change_seq, and a client that resumes from the last row never misses one.
+# Each branch is a range scan of its (change_seq, id) index. Ids are compared as text across the branches
+# (the same order as uuids), so the query also runs before the uuid key migration.
+CHANGES_SINCE = """
+    WITH horizon AS (SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS change_seq)
+    (
+        SELECT id::text, change_seq, updated_at, is_deleted, FALSE AS purged, name, email, deleted_at FROM user_profiles
+        WHERE (change_seq, id) > ($1, $2) AND change_seq < (SELECT change_seq FROM horizon)
+        ORDER BY change_seq, user_profiles.id LIMIT $3
+    ) UNION ALL (
+        SELECT id::text, change_seq, updated_at, TRUE, TRUE, NULL, NULL, NULL FROM user_profile_tombstones
+        WHERE (change_seq, id) > ($1, $4::uuid) AND change_seq < (SELECT change_seq FROM horizon)
+        ORDER BY change_seq, user_profile_tombstones.id LIMIT $3
+    )
+    ORDER BY change_seq, id LIMIT $3
+"""
+
+# Profile listings with the activity asked for (include=), in one statement: a LATERAL subquery per profile reads its
+# latest event from the (user_id, timestamp DESC) index, and another counts its live events there (index-only
+# scan); events folded by compaction are counted by the user's checkpoint. The newest events of a user always
+# stay live, so the latest one is never in the archive. Pages follow the ids (time-ordered uuids).
+LAST_EVENT_JOIN = """
+    LEFT JOIN LATERAL (
+        SELECT * FROM audit_events e WHERE e.user_id = p.id ORDER BY e.timestamp DESC, e.id DESC LIMIT 1
+    ) AS last_event ON TRUE
+"""
+EVENT_COUNT_JOIN = """
+    LEFT JOIN LATERAL (SELECT count(*) AS live FROM audit_events e WHERE e.user_id = p.id) AS live_events ON TRUE
+    LEFT JOIN audit_checkpoints c ON c.user_id = p.id
+"""
+
+
+def list_profiles_query(active_only: bool, include: Tuple[str, ...]) -> str:
+    """
+    Builds the statement of a profile listing ($1: id after which the page starts, $2: page size, NULL for all).
+
+    Args:
+        active_only (bool): Whether soft-deleted profiles are left out.
+        include (Tuple[str, ...]): The activity to embed, from PROFILE_LIST_INCLUDES.
+
+    Returns:
+        str: The statement.
+    """
+    columns, joins = ["p.*"], []
+    if "last_event" in include:
+        columns += [f"last_event.{column} AS last_event_{column}" for column in EVENT_COLUMNS]
+        joins.append(LAST_EVENT_JOIN)
+    if "event_count" in include:
+        columns.append("live_events.live + COALESCE(c.event_count, 0) AS event_count")
+        joins.append(EVENT_COUNT_JOIN)
+    return f"""
+        SELECT {", ".join(columns)} FROM user_profiles p {"".join(joins)}
+        WHERE ($1::uuid IS NULL OR p.id > $1::uuid) {"AND p.is_deleted = FALSE" if active_only else ""}
+        ORDER BY p.id LIMIT $2
+    """
+
+
+def list_item(row, include: Tuple[str, ...]) -> ProfileListItem:
+    """Builds a ProfileListItem from a row of a listing; only the included fields are set."""
+    fields = {key: row[key] for key in ("id", "name", "email", "is_deleted", "deleted_at")}
+    if "last_event" in include:
+        event = {column: row[f"last_event_{column}"] for column in EVENT_COLUMNS}
+        fields["last_event"] = AuditEvent(**{**event, "changes": json.loads(event["changes"]) if event["changes"] else {}}) if event["id"] else None
+    if "event_count" in include:
+        fields["event_count"] = row["event_count"]
+    return ProfileListItem(**fields)
+
+
+UPSERT_PURGE_RUN = """
+    INSERT INTO purge_runs (id, cutoff, chunk_size, status, purged, chunks, cursor_deleted_at, cursor_id, error,
+                            started_at, updated_at, finished_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+    ON CONFLICT (id) DO UPDATE SET status = EXCLUDED.status, purged = EXCLUDED.purged, chunks = EXCLUDED.chunks,
+        cursor_deleted_at = EXCLUDED.cursor_deleted_at, cursor_id = EXCLUDED.cursor_id, error = EXCLUDED.error,
+        updated_at = EXCLUDED.updated_at, finished_at = EXCLUDED.finished_at
+"""
+
+
+# Bulk import (see app/jobs/import_profiles.py). The file is copied into a staging table, validated and
+# deduplicated with set-based statements, then merged in a single INSERT ... SELECT. Rows are numbered in
+# file order by the identity column as COPY inserts them. Both staging tables are dropped at commit.
+CREATE_IMPORT_TABLES = """
+    CREATE TEMP TABLE profile_import (
+        line_no BIGINT GENERATED ALWAYS AS IDENTITY, name TEXT, email TEXT, reason TEXT, imported BOOLEAN NOT NULL DEFAULT FALSE
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE profile_import_ready (
+        line_no BIGINT, id TEXT, event_id TEXT, timestamp TIMESTAMP, hash CHAR(64), reason TEXT
+    ) ON COMMIT DROP;
+"""
+IMPORT_CHECK_FIELDS = """
+    UPDATE profile_import SET name = btrim(name), email = btrim(email), reason = CASE
+        WHEN coalesce(btrim(name), '') = '' THEN $1
+        WHEN length(btrim(name)) > $5 THEN $2
+        WHEN coalesce(btrim(email), '') = '' THEN $3
+        WHEN length(btrim(email)) > $5 THEN $4
+    END
+"""
+IMPORT_DUPLICATES = """
+    UPDATE profile_import s SET reason = $1
+    FROM (
+        SELECT line_no, row_number() OVER (PARTITION BY email ORDER BY line_no) AS occurrence
+        FROM profile_import WHERE reason IS NULL
+    ) d
+    WHERE s.line_no = d.line_no AND d.occurrence > 1
+"""
+IMPORT_EXISTING = """
+    UPDATE profile_import s SET reason = $1 FROM user_profiles p WHERE s.reason IS NULL AND p.email = s.email
+"""
+IMPORT_CANDIDATES = "SELECT line_no, name, email FROM profile_import WHERE reason IS NULL ORDER BY line_no"
+IMPORT_INVALID = """
+    UPDATE profile_import s SET reason = r.reason FROM profile_import_ready r WHERE r.line_no = s.line_no AND r.reason IS NOT NULL
+"""
+# Profiles and their CREATE_PROFILE events in one statement. Emails taken by a concurrent write since the
+# existence check are skipped (ON CONFLICT), and so are their events. Staged ids are text; the casts work
+# before and after the uuid key migration (app/jobs/migrate_uuid_keys.py).
+IMPORT_MERGE = """
+    WITH inserted AS (
+        INSERT INTO user_profiles (id, name, email, is_deleted)
+        SELECT r.id::uuid, s.name, s.email, FALSE
+        FROM profile_import_ready r JOIN profile_import s USING (line_no)
+        WHERE r.reason IS NULL
+        ORDER BY r.line_no
+        ON CONFLICT (email) DO NOTHING
+        RETURNING id, name, email
+    ), events AS (
+        INSERT INTO audit_events (id, user_id, action, timestamp, resource, details, changes, chain_index, prev_hash, hash)
+        SELECT r.event_id::uuid, i.id, $1, r.timestamp, $2, $3,
+               jsonb_build_object('name', jsonb_build_object('old', NULL, 'new', i.name),
+                                  'email', jsonb_build_object('old', NULL, 'new', i.email)),
+               1, $4, r.hash
+        FROM inserted i JOIN profile_import_ready r ON r.id = i.id::text
+        RETURNING user_id
+    )
+    UPDATE profile_import s SET imported = TRUE FROM profile_import_ready r, events e
+    WHERE r.line_no = s.line_no AND e.user_id::text = r.id
+"""
+IMPORT_LOST_RACE = "UPDATE profile_import SET reason = $1 WHERE reason IS NULL AND NOT imported"
+IMPORT_REJECTS = """
+    SELECT line_no, NULLIF(name, '') AS name, NULLIF(email, '') AS email, reason
+    FROM profile_import WHERE reason IS NOT NULL ORDER BY line_no
+"""
+IMPORT_BATCH_SIZE = 10_000  # Staged rows checked and hashed in Python at a time
+
+
+def advance_purge_run(run: PurgeRun, rows: list):
+    """Records a purged chunk in the run: counters and the keyset cursor after its last profile."""
+    if rows:
+        run.cursor_deleted_at, run.cursor_id = max((row["deleted_at"], row["id"]) for row in rows)
+        run.purged += len(rows)
+        run.chunks += 1
+    run.updated_at = datetime.now()
 
 class UserProfileRepository:
-    def __init__(self, connection):
-        """Initializes the repository with a database connection."""
+    def __init__(self, connection, audit_event_repository: Optional[AuditEventRepository] = None):
+        """Initializes the repository with a database connection.
+
+        Args:
+            connection (asyncpg.Connection): The database connection.
+            audit_event_repository (AuditEventRepository): Repository recording the audit events; by default
+                one on the same connection is created on first use.
+        """
         self.connection = connection
+        self.audit_event_repository = audit_event_repository
+
+    def _audit_event_repository(self) -> AuditEventRepository:
+        """Returns the audit event repository that shares this repository's storage."""
+        if self.audit_event_repository is None:
+            self.audit_event_repository = AuditEventRepository(self.connection)
+        return self.audit_event_repository
 
-    async def create(self, user_profile: UserProfileCreate) -> UserProfile:
+    async def _insert(self, user_id: str, name: str, email: str):
+        """Inserts a new, non-deleted user profile row."""
+        await self.connection.execute(
+            "INSERT INTO user_profiles (id, name, email, is_deleted) VALUES ($1, $2, $3, $4)",
+            user_id, name, email, False
+        )
+
+    async def _update_fields(self, user_profile: UserProfile):
+        """Writes the name and email of the given profile, and records the change."""
+        await self.connection.execute(
+            "UPDATE user_profiles SET name = $1, email = $2, change_seq = DEFAULT, updated_at = DEFAULT WHERE id = $3",
+            user_profile.name, user_profile.email, user_profile.id
+        )
+
+    async def _set_deleted(self, user_id: str, is_deleted: bool):
+        """Sets the soft delete flag of a user profile and when it was deleted, and records the change."""
+        await self.connection.execute(
+            "UPDATE user_profiles SET is_deleted = $1, deleted_at = CASE WHEN $1 THEN CURRENT_TIMESTAMP END, "
+            "change_seq = DEFAULT, updated_at = DEFAULT WHERE id = $2",
+            is_deleted, user_id
+        )
+
+    async def create(self, user_profile: UserProfileCreate, user_id: Optional[str] = None) -> UserProfile:
         """Creates a new user profile in the database and logs an audit event.
 
         Args:
             user_profile (UserProfileCreate): Data for the new user profile.
+            user_id (str): ID of the new profile, when the caller already drew it (e.g. to pick its shard).
 
         Returns:
             UserProfile: The created user profile.
         """
-        user_id = str(uuid.uuid4())  # Generate a unique user ID
-        await self.connection.execute(
-            "INSERT INTO user_profiles (id, name, email, is_deleted) VALUES ($1, $2, $3, $4)",
-            user_id, user_profile.name, user_profile.email, False  # Insert new user profile into the database
-        )
+        user_id = user_id or ids.new_id()  # Generate a unique, time-ordered user ID
+        await self._insert(user_id, user_profile.name, user_profile.email)  # Insert new user profile into the database
 
         # Create an audit event for the profile creation
         new_event_audit = AuditEventBase(
@@ -51,11 +273,38 @@ class UserProfileRepository:
         Returns:
             UserProfile: The corresponding user profile or None if not found.
         """
-        row = await self.connection.fetchrow("SELECT * FROM user_profiles WHERE id = $1", user_id)
+        if not ids.is_valid(user_id):
+            return None  # Can't be stored in the uuid column, so no profile has it
+        row = await self.connection.fetchrow(SELECT_BY_ID, user_id)
         if row:
             return UserProfile(**row)  # Return the user profile if found
         return None  # Return None if not found
 
+    async def get_many(self, user_ids: List[str]) -> Dict[str, UserProfile]:
+        """Retrieves several user profiles with a single query.
+
+        Args:
+            user_ids (List[str]): The IDs of the user profiles.
+
+        Returns:
+            Dict[str, UserProfile]: The profiles found, indexed by ID (missing IDs are absent).
+        """
+        user_ids = [user_id for user_id in set(user_ids) if ids.is_valid(user_id)]
+        rows = await self.connection.fetch("SELECT * FROM user_profiles WHERE id = ANY($1)", user_ids)
+        return {row["id"]: UserProfile(**row) for row in rows}
+
+    async def existing_emails(self, emails: List[str]) -> Set[str]:
+        """Returns which of the given emails are already used by a profile.
+
+        Args:
+            emails (List[str]): The emails to look up.
+
+        Returns:
+            Set[str]: The emails found.
+        """
+        rows = await self.connection.fetch("SELECT email FROM user_profiles WHERE email = ANY($1::text[])", list(set(emails)))
+        return {row["email"] for row in rows}
+
     async def update(self, user_profile: UserProfile) -> UserProfile:
         """Updates an existing user profile and logs an audit event.
 
@@ -69,10 +318,7 @@ class UserProfileRepository:
         if not old_user_profile:
             raise HTTPException(status_code=404, detail="User profile not found.")  # Raise error if not found
 
-        await self.connection.execute(
-            "UPDATE user_profiles SET name = $1, email = $2 WHERE id = $3",
-            user_profile.name, user_profile.email, user_profile.id  # Update the user profile in the database
-        )
+        await self._update_fields(user_profile)  # Update the user profile in the database
 
         # Create an audit event for the profile update
         new_event_audit = AuditEventBase(
@@ -95,7 +341,7 @@ class UserProfileRepository:
         Args:
             user_id (str): The ID of the user profile to be marked as deleted.
         """
-        await self.connection.execute("UPDATE user_profiles SET is_deleted = TRUE WHERE id = $1", user_id)  # Soft delete the user profile
+        await self._set_deleted(user_id, True)  # Soft delete the user profile
 
         old_user_profile = await self.get_by_id(user_id)  # Fetch the existing user profile
 
@@ -118,7 +364,7 @@ class UserProfileRepository:
         Args:
             user_id (str): The ID of the user profile to be restored.
         """
-        await self.connection.execute("UPDATE user_profiles SET is_deleted = FALSE WHERE id = $1", user_id)  # Restore the user profile
+        await self._set_deleted(user_id, False)  # Restore the user profile
 
         user_profile = await self.get_by_id(user_id)  # Fetch the restored user profile
 
@@ -164,13 +410,181 @@ class UserProfileRepository:
         rows = await self.connection.fetch("SELECT * FROM user_profiles")  # Fetch all user profiles
         return [UserProfile(**row) for row in rows]  # Return a list of all user profiles
 
+    async def list_profiles(self, active_only: bool = False, include: Tuple[str, ...] = (), after: Optional[str] = None,
+                            limit: Optional[int] = None) -> List[ProfileListItem]:
+        """Retrieves a page of profiles in id order, with their latest audit event and event count if asked for,
+        in one statement (see list_profiles_query).
+
+        Args:
+            active_only (bool): Whether soft-deleted profiles are left out.
+            include (Tuple[str, ...]): The activity to embed, from PROFILE_LIST_INCLUDES.
+            after (str): ID of the last profile of the previous page; None from the start.
+            limit (int): Maximum number of profiles to return; None for all of them.
+
+        Returns:
+            List[ProfileListItem]: The profiles, ordered by id.
+        """
+        rows = await self.connection.fetch(list_profiles_query(active_only, include), after, limit)
+        return [list_item(row, include) for row in rows]
+
+    async def get_changes(self, after: Optional[List[Tuple[int, str]]] = None, limit: int = 1000) -> ProfileChangePage:
+        """Retrieves a page of the delta sync feed: the profiles changed after a position, tombstones included.
+
+        Args:
+            after (List[Tuple[int, str]]): The position of the client (see app.pagination.decode_change_cursor);
+                None from the start.
+            limit (int): Maximum number of changes to return.
+
+        Returns:
+            ProfileChangePage: The changes in order, the cursor of the position reached and whether there are more.
+
+        Raises:
+            ValueError: If the position doesn't match the storage, e.g. it was reached before a resharding.
+        """
+        if after is not None and len(after) != 1:
+            raise ValueError("Invalid cursor")  # One position per shard
+        position = after[0] if after else (-1, NO_ID)
+        changes = await self.changes_after(position, limit + 1)  # One extra row tells if there is more
+        page = changes[:limit]
+        if page:
+            position = (page[-1].change_seq, page[-1].id)
+        return ProfileChangePage(changes=page, cursor=encode_change_cursor([position]), has_more=len(changes) > limit)
+
+    async def changes_after(self, after: Tuple[int, str], limit: int) -> List[ProfileChange]:
+        """Retrieves the profiles changed after a (change_seq, id) position, tombstones included.
+
+        Args:
+            after (Tuple[int, str]): (change_seq, id) of the last change the client has.
+            limit (int): Maximum number of changes to return.
+
+        Returns:
+            List[ProfileChange]: The changes, ordered by change_seq and id.
+        """
+        change_seq, user_id = after
+        rows = await self.connection.fetch(CHANGES_SINCE, change_seq, user_id, limit, user_id)
+        return [ProfileChange(**row) for row in rows]
+
+    async def purge_chunk(self, run: PurgeRun, sweep: bool = False) -> int:
+        """Hard deletes the next chunk of profiles of a purge run and saves the run's progress, in one transaction.
+
+        Args:
+            run (PurgeRun): The purge run; its counters and cursor are advanced.
+            sweep (bool): Start from the oldest profile left, ignoring the cursor, and wait for locked rows
+                instead of skipping them (the final pass of a run).
+
+        Returns:
+            int: The number of profiles purged.
+        """
+        async with self.connection.transaction():
+            if sweep:
+                rows = await self.connection.fetch(PURGE_SWEEP_CHUNK, run.cutoff, run.chunk_size)
+            elif run.cursor_deleted_at is None:
+                rows = await self.connection.fetch(PURGE_FIRST_CHUNK, run.cutoff, run.chunk_size)
+            else:
+                rows = await self.connection.fetch(PURGE_NEXT_CHUNK, run.cutoff, run.cursor_deleted_at, run.cursor_id, run.chunk_size)
+            advance_purge_run(run, rows)
+            await self.save_purge_run(run)  # The report never disagrees with what was committed
+        return len(rows)
+
+    async def save_purge_run(self, run: PurgeRun):
+        """Creates or updates the progress report of a purge run.
+
+        Args:
+            run (PurgeRun): The purge run.
+        """
+        await self.connection.execute(
+            UPSERT_PURGE_RUN, run.id, run.cutoff, run.chunk_size, run.status.value, run.purged, run.chunks,
+            run.cursor_deleted_at, run.cursor_id, run.error, run.started_at, run.updated_at, run.finished_at
+        )
+
+    async def get_purge_run(self, run_id: str) -> Optional[PurgeRun]:
+        """Retrieves the progress report of a purge run.
+
+        Args:
+            run_id (str): The ID of the purge run.
+
+        Returns:
+            PurgeRun: The purge run or None if not found.
+        """
+        row = await self.connection.fetchrow("SELECT * FROM purge_runs WHERE id = $1", run_id)
+        return PurgeRun(**row) if row else None
+
+    async def import_csv(self, chunks, columns: List[str], report: ProfileImport, on_reject=None, new_id=ids.new_id):
+        """Imports streamed CSV rows as new profiles with their CREATE_PROFILE events, in one transaction.
+
+        The file is copied chunk by chunk into a staging table, so it is never held in memory; only the
+        rows being hashed (IMPORT_BATCH_SIZE at a time) pass through Python. Events are stamped as they are
+        hashed and only committed at the end, so the transaction is cut off after IMPORT_TIMEOUT_SECONDS:
+        the settle delay of app.analytics relies on it.
+
+        Args:
+            chunks (AsyncIterator[bytes]): The CSV file, header included, in chunks.
+            columns (List[str]): The columns named by the header, in file order.
+            report (ProfileImport): Progress report, updated as the import goes.
+            on_reject (Callable[[ImportReject], None]): Called with every rejected row, in file order.
+            new_id (Callable[[], str]): Draws the ids of the new profiles.
+
+        Raises:
+            TimeoutError: If the import took longer than IMPORT_TIMEOUT_SECONDS (nothing is imported).
+        """
+        try:
+            async with asyncio.timeout(profile_import.IMPORT_TIMEOUT_SECONDS):
+                await self._import_csv(chunks, columns, report, on_reject, new_id)
+        except TimeoutError:
+            raise TimeoutError(f"The import did not finish within {profile_import.IMPORT_TIMEOUT_SECONDS:g} s") from None
+
+    async def _import_csv(self, chunks, columns: List[str], report: ProfileImport, on_reject, new_id):
+        """Runs the transaction of import_csv."""
+        async with self.connection.transaction():
+            await self.connection.execute(CREATE_IMPORT_TABLES)
+            result = await self.connection.copy_to_table(
+                "profile_import", source=chunks, columns=columns, format="csv", header=True
+            )
+            report.rows = int(result.split()[-1])  # "COPY <rows>"
+
+            report.phase = "validating"
+            await self.connection.execute(
+                IMPORT_CHECK_FIELDS, profile_import.MISSING_NAME, profile_import.NAME_TOO_LONG,
+                profile_import.MISSING_EMAIL, profile_import.EMAIL_TOO_LONG, profile_import.MAX_FIELD_LENGTH
+            )
+            await self.connection.execute("ANALYZE profile_import")  # Temp tables have no statistics otherwise
+            await self.connection.execute(IMPORT_DUPLICATES, profile_import.DUPLICATE_EMAIL)
+            await self.connection.execute(IMPORT_EXISTING, profile_import.EMAIL_EXISTS)
+
+            # Emails are checked with the API's validator, and ids and hashed events generated, batch by batch
+            cursor = await self.connection.cursor(IMPORT_CANDIDATES)
+            while rows := await cursor.fetch(IMPORT_BATCH_SIZE):
+                ready = []
+                for line_no, name, email in rows:
+                    if not profile_import.is_valid_email(email):
+                        ready.append((line_no, None, None, None, None, profile_import.INVALID_EMAIL))
+                        continue
+                    event = profile_import.import_event(new_id(), name, email)
+                    ready.append((line_no, event["user_id"], event["id"], event["timestamp"], event["hash"], None))
+                await self.connection.copy_records_to_table("profile_import_ready", records=ready)
+            await self.connection.execute(IMPORT_INVALID)
+
+            report.phase = "merging"
+            await self.connection.execute("ANALYZE profile_import_ready")
+            await self.connection.execute(
+                IMPORT_MERGE, AuditEventAction.CREATE_PROFILE.value, "user_profile", profile_import.IMPORT_DETAILS,
+                GENESIS_HASH
+            )
+            await self.connection.execute(IMPORT_LOST_RACE, profile_import.EMAIL_EXISTS)
+            report.imported = await self.connection.fetchval("SELECT count(*) FROM profile_import WHERE imported")
+
+            async for row in self.connection.cursor(IMPORT_REJECTS, prefetch=IMPORT_BATCH_SIZE):
+                profile_import.record_reject(report, ImportReject(
+                    row=row["line_no"], name=row["name"], email=row["email"], reason=row["reason"]
+                ), on_reject)
+
     async def create_audit_event(self, new_audit_event: AuditEvent):
         """Creates an audit event in the audit event repository.
 
         Args:
             new_audit_event (AuditEvent): The audit event to be created.
         """
-        audit_event_repo = AuditEventRepository(self.connection)  # Initialize the audit event repository
+        audit_event_repo = self._audit_event_repository()  # Initialize the audit event repository
         await audit_event_repo.create(audit_event=new_audit_event)  # Create the audit event
 
     async def rollback_changes_by_event_id(self, audit_event_id: str):
@@ -180,7 +594,7 @@ class UserProfileRepository:
         Args:
             audit_event_id (str): ID of the audit event to be rolled back.
         """
-        audit_event_repo = AuditEventRepository(self.connection)  # Initialize the audit event repository
+        audit_event_repo = self._audit_event_repository()  # Initialize the audit event repository
         audit_event = await audit_event_repo.get_by_id(audit_event_id)  # Fetch the audit event
         
         if not audit_event:
@@ -225,10 +639,7 @@ class UserProfileRepository:
                     }
             
             # Update the user profile in the database
-            await self.connection.execute(
-                "UPDATE user_profiles SET name = $1, email = $2 WHERE id = $3",
-                user_profile.name, user_profile.email, user_profile.id
-            )
+            await self._update_fields(user_profile)
             
             # Create an audit event for the rollback if there are changes
             if rollback_changes:
@@ -0,0 +1,56 @@
+import hashlib
+from app import database
+
+# Hash sharding of profiles and audit events by user id.
+#
+# When DATABASE_SHARD_URLS lists several databases, a profile, its audit events, its chain and compaction
+# checkpoints and its tombstone all live on the shard its user id hashes to, so every operation on one
+# user runs on one database. Operations on one user are routed to their shard; lists, searches and
+# aggregates are sent to every shard and their results merged (app/repositories/sharded.py).
+#
+# Ids are mapped to shards with jump consistent hashing (Lamping and Veach, 2014): going from N to N + 1
+# shards moves only the 1 / (N + 1) of the users that belong on the new shard, and never moves a user
+# between two existing shards. app/jobs/reshard.py moves them.
+
+DIRECTORY_SHARD = 0  # Shard holding the global locks (email uniqueness) and the purge run reports
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Maps a 64-bit key to one of several buckets with jump consistent hashing.
+
+    Args:
+        key (int): The key, e.g. a hash of the id.
+        buckets (int): The number of buckets.
+
+    Returns:
+        int: The bucket, between 0 and buckets - 1.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_for(user_id: str, shard_count: int) -> int:
+    """
+    Returns the shard of a user.
+
+    Args:
+        user_id (str): The id of the user (the id of a profile, or the user_id of an audit event).
+        shard_count (int): The number of shards.
+
+    Returns:
+        int: The index of the shard, in the order of DATABASE_SHARD_URLS.
+    """
+    if shard_count == 1:
+        return 0
+    digest = hashlib.blake2b(str(user_id).lower().encode(), digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, "big"), shard_count)
+
+
+def is_sharded() -> bool:
+    """Returns whether the storage is spread over several databases."""
+    return len(database.DATABASE_SHARD_URLS) > 1
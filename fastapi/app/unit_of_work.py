@@ -0,0 +1,150 @@
+from app import database
+from app.repositories.audit_event_repository import AuditEventRepository
+from app.repositories.memory import InMemoryAuditEventRepository, InMemoryStore, InMemoryUserProfileRepository
+from app.repositories.sharded import ShardedAuditEventRepository, ShardedUserProfileRepository, ShardSet
+from app.repositories.user_profile_repository import UserProfileRepository
+from app.sharding import DIRECTORY_SHARD
+
+# Request-scoped unit of work.
+#
+# A unit of work owns one connection and one transaction for the whole request and exposes both
+# repositories on it, so a profile change and its audit events commit or roll back together.
+# Audit events are buffered while the handler runs and written at commit with one lock round trip
+# and one pipelined executemany (AuditEventRepository.create_many), instead of three statements each.
+# Handlers receive it through Depends(get_unit_of_work) (app/api/dependencies.py).
+#
+# With several shards (app/sharding.py), the unit of work opens one transaction on each shard the request
+# touches. They are committed one after the other, the directory shard (which holds the email locks) last;
+# there is no two-phase commit, so a failure between two commits leaves the earlier shards committed.
+
+
+class UnitOfWork:
+    def __init__(self, connection):
+        """
+        Initializes the unit of work on a database connection.
+
+        Args:
+            connection (asyncpg.Connection): The connection owned by the unit of work for the request.
+        """
+        self.connection = connection
+        self.audit_events = AuditEventRepository(connection, buffered=True)
+        self.user_profiles = UserProfileRepository(connection, audit_event_repository=self.audit_events)
+        self._transaction = None
+
+    async def __aenter__(self):
+        self._transaction = self.connection.transaction()
+        await self._transaction.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            try:
+                await self.commit()
+                return False
+            except BaseException:
+                await self.rollback()
+                raise
+        await self.rollback()
+        return False  # Errors (including HTTPExceptions raised by the handler) still propagate
+
+    async def commit(self):
+        """Writes the buffered audit events and commits the transaction."""
+        await self.audit_events.flush()
+        await self._transaction.commit()
+
+    async def rollback(self):
+        """Discards the buffered audit events and rolls the transaction back."""
+        self.audit_events.pending.clear()
+        await self._transaction.rollback()
+
+
+class InMemoryUnitOfWork(UnitOfWork):
+    def __init__(self, store: InMemoryStore):
+        """
+        Initializes the unit of work on the in-memory store.
+
+        The store has no transactions: profile changes are applied immediately and only the
+        buffered audit events are discarded on rollback.
+
+        Args:
+            store (InMemoryStore): The store holding the profiles and audit events.
+        """
+        self.connection = None
+        self.audit_events = InMemoryAuditEventRepository(store, buffered=True)
+        self.user_profiles = InMemoryUserProfileRepository(store, audit_event_repository=self.audit_events)
+
+    async def __aenter__(self):
+        return self
+
+    async def commit(self):
+        """Writes the buffered audit events."""
+        await self.audit_events.flush()
+
+    async def rollback(self):
+        """Discards the buffered audit events."""
+        self.audit_events.pending.clear()
+
+
+class ShardedUnitOfWork:
+    def __init__(self, count: int, connect=database.connect_to_shard, close=database.close_db_connection):
+        """
+        Initializes the unit of work over several shards; a shard's connection and transaction are opened
+        the first time the request touches it.
+
+        Args:
+            count (int): The number of shards.
+            connect (Callable[[int], Awaitable[asyncpg.Connection]]): Opens a connection to a shard.
+            close (Callable[[asyncpg.Connection], Awaitable[None]]): Gives a connection back.
+        """
+        self._connect, self._close = connect, close
+        self._units, self._committed = {}, set()
+        shards = ShardSet(count, self._open_shard)
+        self.connection = None
+        self.audit_events = ShardedAuditEventRepository(shards)
+        self.user_profiles = ShardedUserProfileRepository(shards, audit_event_repository=self.audit_events)
+
+    async def _open_shard(self, index: int):
+        connection = await self._connect(index)
+        unit_of_work = UnitOfWork(connection)
+        try:
+            await unit_of_work.__aenter__()
+        except BaseException:
+            await self._close(connection)
+            raise
+        self._units[index] = unit_of_work
+        return unit_of_work.user_profiles, unit_of_work.audit_events
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                try:
+                    await self.commit()
+                    return False
+                except BaseException:
+                    await self.rollback()
+                    raise
+            await self.rollback()
+            return False
+        finally:
+            for unit_of_work in self._units.values():
+                await self._close(unit_of_work.connection)
+
+    def _in_commit_order(self):
+        """Returns the shards' units of work, the directory shard last."""
+        return sorted(self._units.items(), key=lambda item: (item[0] == DIRECTORY_SHARD, item[0]))
+
+    async def commit(self):
+        """Writes the buffered audit events and commits the transaction of every shard touched."""
+        for index, unit_of_work in self._in_commit_order():
+            await unit_of_work.commit()
+            self._committed.add(index)  # Not rolled back if a later commit fails
+
+    async def rollback(self):
+        """Discards the buffered audit events and rolls back the transactions still open."""
+        for index, unit_of_work in self._in_commit_order():
+            if index not in self._committed:
+                await unit_of_work.rollback()
+
@@ -2,14 +2,26 @@ import sys
 import os
 from pathlib import Path
 import pytest
+import pytest_asyncio
+
+# Run the API tests against the in-memory backend unless a backend is configured explicitly
+# (the docker-compose API service sets STORAGE_BACKEND=postgres to run them against Postgres).
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+from app import database
 from app.database import connect_to_db, close_db_connection
+from app.repositories.memory import get_memory_store
 import json
 
 root_dir = str(Path(__file__).parent.parent)
 sys.path.append(root_dir)
 
-@pytest.fixture(scope="function")
+@pytest_asyncio.fixture(scope="function")
 async def db_setup():
+    if database.STORAGE_BACKEND == "memory":
+        yield get_memory_store()  # The store lives for the whole session, like the database would
+        return
+
     connection = await connect_to_db()
 
     yield connection 
@@ -0,0 +1,59 @@
+import asyncio
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.middleware.admission import AdmissionControlMiddleware, Budget, Overloaded
+
+@pytest.mark.asyncio
+async def test_budget_queues_and_hands_over_slots():
+    # A released slot should go straight to the oldest waiter
+    budget = Budget("test", max_concurrency=1, max_queue=1, queue_timeout=1.0)
+    await budget.acquire()
+    waiter = asyncio.create_task(budget.acquire())
+    await asyncio.sleep(0)
+    assert len(budget.waiters) == 1  # The second request is queued
+
+    budget.release()
+    await waiter
+    assert budget.active == 1  # The slot was transferred, not freed
+    budget.release()
+    assert budget.active == 0
+
+@pytest.mark.asyncio
+async def test_budget_sheds_when_queue_is_full_or_deadline_passes():
+    # Requests beyond the queue bound fail fast, queued ones fail at their deadline
+    budget = Budget("test", max_concurrency=1, max_queue=1, queue_timeout=0.05)
+    await budget.acquire()
+    queued = asyncio.create_task(budget.acquire())
+    await asyncio.sleep(0)
+
+    with pytest.raises(Overloaded):
+        await budget.acquire()  # Queue is full
+
+    with pytest.raises(Overloaded):
+        await queued  # Deadline passed
+    assert not budget.waiters  # The abandoned waiter was removed
+
+def test_middleware_returns_503_with_retry_after():
+    # A saturated budget should answer with 503 and Retry-After without calling the route
+    app = FastAPI()
+
+    @app.get("/api/v1/items/")
+    async def read_items():
+        return []
+
+    budget = Budget("read", max_concurrency=0, max_queue=0, queue_timeout=0.01, retry_after=7)
+    app.add_middleware(AdmissionControlMiddleware, budgets={"read": budget, "write": budget}, route_budgets=[])
+
+    response = TestClient(app).get("/api/v1/items/")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "7"
+
+def test_middleware_classifies_expensive_routes():
+    # List and rollback routes get their own budget, separate from cheap reads
+    middleware = AdmissionControlMiddleware(app=None)
+    assert middleware.classify("GET", "/api/v1/audit/events/").name == "expensive"
+    assert middleware.classify("POST", "/api/v1/audit/events/rollback/abc").name == "expensive"
+    assert middleware.classify("GET", "/api/v1/users/abc/profile/").name == "read"
+    assert middleware.classify("PUT", "/api/v1/users/abc/profile/").name == "write"
+    assert middleware.classify("GET", "/docs") is None
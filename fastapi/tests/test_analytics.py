@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+import pytest
+from app.analytics import BucketCache, bucketed_counts, truncate
+
+class FakeRepository:
+    # Counts one CREATE_PROFILE event per bucket and records the queried ranges
+    def __init__(self, replayed=None):
+        self.queries = []
+        self.replayed = replayed
+
+    async def replayed_until(self):
+        return self.replayed
+
+    async def count_by_bucket(self, bucket_size, group_by, start, end):
+        self.queries.append((start, end))
+        rows, bucket = [], start
+        while bucket < end:
+            rows.append({"bucket": bucket, "action": "CREATE_PROFILE", "count": 1})
+            bucket += timedelta(hours=1)
+        return rows
+
+def test_truncate():
+    assert truncate(datetime(2024, 5, 6, 13, 45, 12, 7), "hour") == datetime(2024, 5, 6, 13)
+    assert truncate(datetime(2024, 5, 6, 13, 45, 12, 7), "day") == datetime(2024, 5, 6)
+
+@pytest.mark.asyncio
+async def test_closed_buckets_are_cached():
+    repository, cache = FakeRepository(), BucketCache()
+    now = datetime(2024, 5, 6, 12, 30)
+
+    result = await bucketed_counts(repository, "hour", start=datetime(2024, 5, 6, 9, 15), end=now,
+                                   group_by=["action"], cache=cache, now=now)
+    assert (result["start"], result["end"]) == (datetime(2024, 5, 6, 9), datetime(2024, 5, 6, 13))  # Whole buckets
+    assert [row["bucket"].hour for row in result["buckets"]] == [9, 10, 11, 12]
+    assert result["cached_buckets"] == 0
+    assert len(cache) == 3  # The current bucket is not cached
+
+    # A repeat query only recomputes the open bucket
+    result = await bucketed_counts(repository, "hour", start=datetime(2024, 5, 6, 9), end=now,
+                                   group_by=["action"], cache=cache, now=now)
+    assert result["cached_buckets"] == 3
+    assert repository.queries[-1] == (datetime(2024, 5, 6, 12), datetime(2024, 5, 6, 13))
+    assert [row["bucket"].hour for row in result["buckets"]] == [9, 10, 11, 12]
+
+@pytest.mark.asyncio
+async def test_buckets_are_settled_against_the_replica_replay_time():
+    now = datetime(2024, 5, 6, 12, 30)
+    repository, cache = FakeRepository(replayed=datetime(2024, 5, 6, 10, 30).astimezone()), BucketCache()
+
+    await bucketed_counts(repository, "hour", start=datetime(2024, 5, 6, 8), end=now, cache=cache, now=now)
+    assert len(cache) == 2  # 8:00 and 9:00 only: the replica may still miss events of the buckets after
+    result = await bucketed_counts(repository, "hour", start=datetime(2024, 5, 6, 8), end=now, cache=cache, now=now)
+    assert repository.queries[-1] == (datetime(2024, 5, 6, 10), datetime(2024, 5, 6, 13))
+    assert result["cached_buckets"] == 2
+
+def test_bucket_cache_evicts_least_recently_used():
+    cache = BucketCache(max_size=2)
+    cache.put("a", [])
+    cache.put("b", [])
+    cache.get("a")
+    cache.put("c", [])
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ([], None, [])
+
+@pytest.mark.asyncio
+async def test_invalid_requests_are_rejected():
+    repository = FakeRepository()
+    with pytest.raises(ValueError):
+        await bucketed_counts(repository, "hour", group_by=["user_id"])
+    with pytest.raises(ValueError):
+        await bucketed_counts(repository, "hour", start=datetime(2024, 1, 2), end=datetime(2024, 1, 1))
+    with pytest.raises(ValueError):
+        await bucketed_counts(repository, "hour", start=datetime(2000, 1, 1), end=datetime(2024, 1, 1))
+    assert repository.queries == []
@@ -1,8 +1,9 @@
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
 from datetime import datetime
-from app.models.audit_event import AuditEventAction
+from app.models.audit_event import SYSTEM_USER_ID, AuditEventAction
 
 # Initialize the TestClient for the FastAPI application
 client = TestClient(app)
@@ -317,3 +318,222 @@ async def test_audit_event_creation_on_delete(db_setup):
     assert len(events) > 0  # Ensure there are events to return
     assert events[-1]["action"] == AuditEventAction.DELETE_PROFILE.value  # Check the action type
     assert events[-1]["details"] == f"User profile deleted."  # Check the event details
+
+def test_readiness_after_warmup(monkeypatch):
+    # The readiness endpoint should report "starting" until the lifespan warm-up has run
+    assert client.get("/ready").status_code == 503
+
+    async def fake_init_db():
+        pass  # The database warm-up is covered by the integration environment
+
+    async def fake_close_db():
+        pass
+
+    monkeypatch.setattr("app.main.init_db", fake_init_db)
+    monkeypatch.setattr("app.main.close_db", fake_close_db)
+    with TestClient(app) as warm_client:
+        response = warm_client.get("/ready")
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+        assert response.json()["cold_start_seconds"] is not None
+
+@pytest.mark.asyncio
+async def test_verify_audit_chain(db_setup):
+    # Test that the audit trail written so far verifies in the background, and that a second run is incremental
+    with TestClient(app) as admin_client:  # Keeps the event loop running the verification alive between requests
+        admin_client.post("/api/v1/users/profile/", json={"name": "Verified", "email": "verify.me@example.com"}, headers=get_auth_headers())
+        summary = await verify_in_background(admin_client, full=True)
+        assert summary["mismatch_count"] == 0
+        assert summary["events_verified"] > 0
+        assert (await verify_in_background(admin_client))["events_verified"] == 0  # Everything was checkpointed by the previous run
+        assert admin_client.get("/api/v1/audit/verify/does-not-exist", headers=get_auth_headers()).status_code == 404
+
+async def verify_in_background(admin_client, full=False):
+    # Starts a verification run and polls it until it is done, returning its summary
+    response = admin_client.post(f"/api/v1/audit/verify/?full={str(full).lower()}", headers=get_auth_headers())
+    assert response.status_code == 202
+    run_id = response.json()["id"]
+    for _ in range(50):
+        run = admin_client.get(f"/api/v1/audit/verify/{run_id}", headers=get_auth_headers()).json()
+        if run["status"] != "running":
+            break
+        await asyncio.sleep(0.1)
+    assert run["status"] == "completed"
+    return run["summary"]
+
+@pytest.mark.asyncio
+async def test_get_user_profiles_batch(db_setup):
+    # Test looking up found, missing and deleted profiles in one request
+    kept = client.post("/api/v1/users/profile/", json={"name": "Batch Kept", "email": "batch.kept@example.com"}, headers=get_auth_headers()).json()
+    deleted = client.post("/api/v1/users/profile/", json={"name": "Batch Deleted", "email": "batch.deleted@example.com"}, headers=get_auth_headers()).json()
+    client.delete(f"/api/v1/users/{deleted['id']}/profile/", headers=get_auth_headers())
+
+    ids = [deleted["id"], "does-not-exist", kept["id"], kept["id"]]
+    response = client.post("/api/v1/users/profiles/batch/", json={"ids": ids}, headers=get_auth_headers())
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["id"] for result in results] == ids  # Request order, duplicates included
+    assert [result["status"] for result in results] == ["deleted", "missing", "found", "found"]
+    assert results[0]["profile"] is None
+    assert results[2]["profile"]["name"] == "Batch Kept"
+
+    events = client.get(f"/api/v1/audit/events/{kept['id']}", headers=get_auth_headers()).json()
+    response = client.post("/api/v1/audit/events/batch/", json={"ids": ["does-not-exist", events[0]["id"]]}, headers=get_auth_headers())
+    assert [result["status"] for result in response.json()] == ["missing", "found"]
+    assert response.json()[1]["event"]["action"] == "CREATE_PROFILE"
+
+    # Empty and oversized batches are rejected
+    assert client.post("/api/v1/users/profiles/batch/", json={"ids": []}, headers=get_auth_headers()).status_code == 422
+    assert client.post("/api/v1/audit/events/batch/", json={"ids": ["x"] * 501}, headers=get_auth_headers()).status_code == 422
+
+@pytest.mark.asyncio
+async def test_get_audit_analytics(db_setup):
+    # Test that the events written by the previous tests are counted in the current hour
+    client.post("/api/v1/users/profile/", json={"name": "Analytics User", "email": "analytics.user@example.com"}, headers=get_auth_headers())
+    response = client.get("/api/v1/audit/analytics/?bucket_size=hour&group_by=action", headers=get_auth_headers())
+    assert response.status_code == 200
+    analytics = response.json()
+    assert analytics["group_by"] == ["action"]
+    creates = [row for row in analytics["buckets"] if row["action"] == "CREATE_PROFILE"]
+    assert sum(row["count"] for row in creates) >= 1
+    assert all(row["resource"] is None for row in analytics["buckets"])
+
+    response = client.get("/api/v1/audit/analytics/?group_by=user_id", headers=get_auth_headers())
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_purge_deleted_profiles(db_setup):
+    # Test that a purge run hard deletes soft-deleted profiles in the background and reports its progress
+    with TestClient(app) as admin_client:  # Keeps the event loop running the purge alive between requests
+        kept = admin_client.post("/api/v1/users/profile/", json={"name": "Purge Kept", "email": "purge.kept@example.com"}, headers=get_auth_headers()).json()
+        purged = admin_client.post("/api/v1/users/profile/", json={"name": "Purge Me", "email": "purge.me@example.com"}, headers=get_auth_headers()).json()
+        admin_client.delete(f"/api/v1/users/{purged['id']}/profile/", headers=get_auth_headers())
+
+        response = admin_client.post("/api/v1/admin/purge/", json={"older_than_days": 0, "chunk_size": 1}, headers=get_auth_headers())
+        assert response.status_code == 202
+        run_id = response.json()["id"]
+
+        for _ in range(50):
+            run = admin_client.get(f"/api/v1/admin/purge/{run_id}", headers=get_auth_headers()).json()
+            if run["status"] != "running":
+                break
+            await asyncio.sleep(0.1)
+        assert run["status"] == "completed"
+        assert run["resumable"] is False
+        assert run["purged"] >= 1
+
+        assert admin_client.get(f"/api/v1/users/{purged['id']}/profile/", headers=get_auth_headers()).status_code == 404
+        assert admin_client.get(f"/api/v1/users/{kept['id']}/profile/", headers=get_auth_headers()).status_code == 200
+        assert admin_client.post(f"/api/v1/admin/purge/{run_id}/resume", headers=get_auth_headers()).status_code == 409
+
+        # The purge is summarized by a system audit event; the purged profile's own history is kept
+        summary = admin_client.get(f"/api/v1/audit/events/{SYSTEM_USER_ID}", headers=get_auth_headers()).json()[-1]
+        assert summary["action"] == "PURGE_PROFILES"
+        assert summary["changes"]["purge"]["run_id"] == run_id
+        assert len(admin_client.get(f"/api/v1/audit/events/{purged['id']}", headers=get_auth_headers()).json()) == 2
+
+def test_get_slow_queries():
+    # Test that the slow query ring is served (it stays empty with the in-memory backend)
+    response = client.get("/api/v1/admin/slow-queries/?limit=10", headers=get_auth_headers())
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+    assert client.delete("/api/v1/admin/slow-queries/", headers=get_auth_headers()).status_code == 204
+
+@pytest.mark.asyncio
+async def test_get_field_changes(db_setup):
+    # Test paging through the events where an email was a given value
+    created = client.post("/api/v1/users/profile/", json={"name": "Field User", "email": "field.before@example.com"}, headers=get_auth_headers()).json()
+    client.put(f"/api/v1/users/{created['id']}/profile/", json={"name": "Field User", "email": "field.after@example.com"}, headers=get_auth_headers())
+
+    response = client.get("/api/v1/audit/changes/?field=email&value=field.before@example.com&limit=1", headers=get_auth_headers())
+    assert response.status_code == 200
+    page = response.json()
+    assert [event["action"] for event in page["events"]] == ["UPDATE_PROFILE"]
+    assert page["next_cursor"]
+
+    response = client.get(f"/api/v1/audit/changes/?field=email&value=field.before@example.com&limit=1&cursor={page['next_cursor']}", headers=get_auth_headers())
+    page = response.json()
+    assert [event["action"] for event in page["events"]] == ["CREATE_PROFILE"]
+    assert page["next_cursor"] is None
+
+    assert client.get("/api/v1/audit/changes/?field=email&cursor=not-a-cursor", headers=get_auth_headers()).status_code == 400
+
+@pytest.mark.asyncio
+async def test_get_user_profile_changes(db_setup):
+    # Test a full sync followed by incremental ones
+    cursor, has_more = None, True
+    while has_more:
+        page = client.get("/api/v1/users/profiles/changes/", params={"since": cursor, "limit": 2} if cursor else {"limit": 2},
+                          headers=get_auth_headers()).json()
+        assert len(page["changes"]) <= 2
+        cursor, has_more = page["cursor"], page["has_more"]
+
+    created = client.post("/api/v1/users/profile/", json={"name": "Synced User", "email": "synced.user@example.com"}, headers=get_auth_headers()).json()
+    client.delete(f"/api/v1/users/{created['id']}/profile/", headers=get_auth_headers())
+    page = client.get(f"/api/v1/users/profiles/changes/?since={cursor}", headers=get_auth_headers()).json()
+    assert [(change["id"], change["is_deleted"], change["purged"]) for change in page["changes"]] == [(created["id"], True, False)]
+    assert not page["has_more"]
+
+    unchanged = client.get(f"/api/v1/users/profiles/changes/?since={page['cursor']}", headers=get_auth_headers()).json()
+    assert unchanged == {"changes": [], "cursor": page["cursor"], "has_more": False}
+    assert client.get("/api/v1/users/profiles/changes/?since=not-a-cursor", headers=get_auth_headers()).status_code == 400
+
+@pytest.mark.asyncio
+async def test_import_user_profiles(db_setup):
+    # Test importing a CSV upload: valid rows become profiles, the others are reported with a reason
+    client.post("/api/v1/users/profile/", json={"name": "Existing", "email": "import.existing@example.com"}, headers=get_auth_headers())
+    content = (
+        "email,name\n"
+        "import.one@example.com,Import One\n"
+        "import.existing@example.com,Already There\n"
+        "import.one@example.com,Import One Again\n"
+        "not-an-email,Bad Email\n"
+        "import.two@example.com,\n"
+    )
+    response = client.post("/api/v1/admin/import/profiles/", files={"file": ("profiles.csv", content, "text/csv")}, headers=get_auth_headers())
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["status"], report["rows"], report["imported"], report["rejected"]) == ("completed", 5, 1, 4)
+    assert [(reject["row"], reject["reason"]) for reject in report["rejects"]] == [
+        (2, "email already exists"), (3, "duplicate email in file"), (4, "invalid email"), (5, "missing name"),
+    ]
+
+    imported = [profile for profile in client.get("/api/v1/users/profile/", headers=get_auth_headers()).json() if profile["email"] == "import.one@example.com"]
+    assert [profile["name"] for profile in imported] == ["Import One"]
+    events = client.get(f"/api/v1/audit/events/{imported[0]['id']}", headers=get_auth_headers()).json()
+    assert [(event["action"], event["chain_index"]) for event in events] == [("CREATE_PROFILE", 1)]
+    with TestClient(app) as admin_client:
+        assert (await verify_in_background(admin_client))["mismatch_count"] == 0
+
+    assert client.get("/api/v1/admin/import/profiles/", headers=get_auth_headers()).json()[0]["id"] == report["id"]
+    bad_header = client.post("/api/v1/admin/import/profiles/", files={"file": ("bad.csv", "id,email\n1,a@example.com\n", "text/csv")}, headers=get_auth_headers())
+    assert bad_header.status_code == 400
+
+@pytest.mark.asyncio
+async def test_list_profiles_with_last_event(db_setup):
+    # Test embedding each profile's latest audit event and event count, page by page
+    created = client.post("/api/v1/users/profile/", json={"name": "Listed User", "email": "listed.user@example.com"}, headers=get_auth_headers()).json()
+    client.put(f"/api/v1/users/{created['id']}/profile/", json={"name": "Listed Renamed", "email": "listed.user@example.com"}, headers=get_auth_headers())
+
+    plain = client.get("/api/v1/users/profile/", headers=get_auth_headers()).json()
+    assert set(plain[0]) == {"id", "name", "email", "is_deleted", "deleted_at"}  # Nothing embedded unless asked for
+
+    profiles, cursor = [], None
+    while True:
+        params = {"include": "last_event,event_count", "limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/api/v1/users/profile/", params=params, headers=get_auth_headers())
+        assert response.status_code == 200 and len(response.json()) <= 2
+        profiles += response.json()
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert [profile["id"] for profile in profiles] == [profile["id"] for profile in plain]
+    listed = next(profile for profile in profiles if profile["id"] == created["id"])
+    history = client.get(f"/api/v1/audit/events/{created['id']}", headers=get_auth_headers()).json()
+    assert listed["last_event"] == history[-1] and listed["last_event"]["action"] == "UPDATE_PROFILE"
+    assert listed["event_count"] == 2
+
+    active = client.get("/api/v1/users/profiles/active/?include=event_count", headers=get_auth_headers()).json()
+    assert all("event_count" in profile and "last_event" not in profile for profile in active)
+    assert client.get("/api/v1/users/profile/?include=everything", headers=get_auth_headers()).status_code == 400
+    assert client.get("/api/v1/users/profile/?cursor=not-a-cursor", headers=get_auth_headers()).status_code == 400
@@ -0,0 +1,70 @@
+import asyncio
+import time
+from datetime import datetime
+import pytest
+from app.audit_chain import GENESIS_HASH, compute_event_hash, next_link, verify_segments
+from app.jobs.verify_audit_chain import worker_pool
+
+def build_chain(user_id, count):
+    # Builds verification rows for a valid chain of `count` events
+    rows, last = [], None
+    for position in range(count):
+        chain_index, prev_hash = next_link(last)
+        event = {
+            "id": f"event-{position}", "user_id": user_id, "chain_index": chain_index, "action": "UPDATE_PROFILE",
+            "timestamp": datetime(2024, 1, 1, 12, 0, position), "resource": "user_profile", "details": None,
+            "changes": {"name": {"old": str(position), "new": str(position + 1)}},
+        }
+        event_hash = compute_event_hash(prev_hash, event)
+        rows.append((event["id"], chain_index, event["action"], event["timestamp"], event["resource"],
+                     event["details"], '{"name": {"old": "%d", "new": "%d"}}' % (position, position + 1), prev_hash, event_hash))
+        last = (chain_index, event_hash)
+    return rows
+
+def test_valid_chain_verifies_from_genesis_and_from_checkpoint():
+    rows = build_chain("user-1", 4)
+    [(user_id, verified, last_index, last_hash, errors)] = verify_segments([("user-1", 0, GENESIS_HASH, rows)])
+    assert (user_id, verified, last_index, last_hash, errors) == ("user-1", 4, 4, rows[-1][8], [])
+
+    # Incremental verification starts from the checkpoint of event 2
+    [(_, verified, last_index, _, errors)] = verify_segments([("user-1", 2, rows[1][8], rows[2:])])
+    assert (verified, last_index, errors) == (2, 4, [])
+
+def test_tampering_is_detected():
+    rows = build_chain("user-1", 4)
+    tampered = list(rows[2])
+    tampered[6] = '{"name": {"old": "2", "new": "forged"}}'  # Edited changes
+    rows[2] = tuple(tampered)
+    [(_, verified, last_index, _, errors)] = verify_segments([("user-1", 0, GENESIS_HASH, rows)])
+    assert (verified, last_index) == (2, 2)  # The prefix before the edit still verifies
+    assert errors == [("event-2", "event content does not match its hash")]
+
+def test_removed_event_is_detected():
+    rows = build_chain("user-1", 4)
+    del rows[1]
+    [(_, _, _, _, errors)] = verify_segments([("user-1", 0, GENESIS_HASH, rows)])
+    assert errors == [("event-2", "expected chain index 2, found 3")]
+
+def test_compaction_boundary():
+    from app.jobs.compact_audit_history import compaction_boundary
+    # Too many events: fold all but the newest ones
+    assert compaction_boundary(live_events=1500, last_index=1600, last_old_index=None, max_events=1000, keep_events=100) == 1500
+    # Old events: fold them, but never into the kept tail
+    assert compaction_boundary(live_events=50, last_index=50, last_old_index=40, max_events=1000, keep_events=20) == 30
+    assert compaction_boundary(live_events=50, last_index=50, last_old_index=10, max_events=1000, keep_events=20) == 10
+    assert compaction_boundary(live_events=10, last_index=10, last_old_index=5, max_events=1000, keep_events=20) is None
+
+@pytest.mark.asyncio
+async def test_compaction_keeps_at_least_one_live_event():
+    from app.jobs.compact_audit_history import compact_audit_history
+    with pytest.raises(ValueError):
+        await compact_audit_history(connection=None, keep_events=0)  # Rejected before touching the database
+
+def test_cancelled_verification_does_not_wait_for_queued_batches():
+    started = time.perf_counter()
+    with pytest.raises(asyncio.CancelledError):
+        with worker_pool(1) as pool:
+            for _ in range(4):
+                pool.submit(time.sleep, 2)
+            raise asyncio.CancelledError  # E.g. the request's deadline passed
+    assert time.perf_counter() - started < 2  # Neither the queued batches nor the running one are waited for
@@ -0,0 +1,92 @@
+import asyncio
+import asyncpg
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app import database, deadlines, metrics
+from app.middleware.deadline import DeadlineMiddleware
+
+def slow_app(cancelled):
+    app = FastAPI()
+
+    @app.get("/api/slow")
+    async def slow(seconds: float = 1.0):
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return {"remaining": deadlines.remaining()}
+
+    @app.get("/api/canceled")
+    async def canceled():
+        raise asyncpg.QueryCanceledError("canceling statement due to statement timeout")
+
+    return app
+
+def client(app):
+    app.add_middleware(DeadlineMiddleware, default_timeout=0.05, route_timeouts=[("GET", r"^/api/slow$", 0.1)], max_timeout=2)
+    return TestClient(app)
+
+def test_request_past_its_deadline_is_cancelled_with_504():
+    metrics.reset()
+    cancelled = []
+    response = client(slow_app(cancelled)).get("/api/slow")
+    assert response.status_code == 504
+    assert response.json() == {"detail": "Request deadline exceeded."}
+    assert cancelled == [True]  # The handler stopped instead of running to completion
+    assert metrics.snapshot()["counters"]["deadline.exceeded.request"] == 1
+
+def test_deadline_can_be_overridden_per_request():
+    test_client = client(slow_app([]))
+    response = test_client.get("/api/slow?seconds=0.2", headers={"X-Request-Timeout": "1"})
+    assert response.status_code == 200
+    assert 0 < response.json()["remaining"] < 1
+    assert test_client.get("/api/slow?seconds=0", headers={"X-Request-Timeout": "60"}).json()["remaining"] <= 2  # Capped
+    assert test_client.get("/api/slow", headers={"X-Request-Timeout": "soon"}).status_code == 400
+    assert test_client.get("/api/slow", headers={"X-Request-Timeout": "0"}).status_code == 400
+
+def test_statement_timeout_is_answered_with_504():
+    metrics.reset()
+    response = client(slow_app([])).get("/api/canceled")
+    assert response.status_code == 504
+    assert metrics.snapshot()["counters"]["deadline.exceeded.statement"] == 1
+
+@pytest.mark.asyncio
+async def test_client_disconnect_cancels_the_handler():
+    metrics.reset()
+    cancelled, sent = [], []
+    middleware = DeadlineMiddleware(slow_app(cancelled), default_timeout=5, route_timeouts=[])
+    messages = iter([{"type": "http.request", "body": b"", "more_body": False}, {"type": "http.disconnect"}])
+
+    async def receive():
+        message = next(messages)
+        if message["type"] == "http.disconnect":
+            await asyncio.sleep(0.05)  # The client gives up while the handler is running
+        return message
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/api/slow", "raw_path": b"/api/slow", "root_path": "",
+             "query_string": b"seconds=5", "headers": [], "scheme": "http", "server": ("test", 80), "client": ("test", 1)}
+    await asyncio.wait_for(middleware(scope, receive, send), timeout=1)
+    assert cancelled == [True]
+    assert sent[0]["status"] == 499
+    assert metrics.snapshot()["counters"]["deadline.client_closed"] == 1
+
+@pytest.mark.asyncio
+async def test_connections_get_the_deadline_as_statement_timeout():
+    try:
+        connection = await asyncpg.connect(database.DATABASE_URL, timeout=2)
+    except (OSError, asyncpg.PostgresError, TimeoutError) as e:
+        pytest.skip(f"Postgres not reachable: {e}")
+
+    token = deadlines.current_deadline.set(asyncio.get_running_loop().time() + 0.2)
+    try:
+        await deadlines.apply_statement_timeout(connection)
+        with pytest.raises(asyncpg.QueryCanceledError):
+            await connection.execute("SELECT pg_sleep(2)")
+    finally:
+        deadlines.current_deadline.reset(token)
+        await connection.close()
@@ -0,0 +1,84 @@
+import uuid
+from datetime import datetime
+import asyncpg
+import pytest
+from app import database, ids, pagination
+from app.jobs.migrate_uuid_keys import migrate_uuid_keys, shadow_index_definition
+
+def test_uuid7_layout():
+    value = ids.uuid7()
+    assert value.version == 7
+    assert value.variant == uuid.RFC_4122
+    assert abs((value.int >> 80) - datetime.now().timestamp() * 1000) < 5000  # Millisecond timestamp in the top 48 bits
+
+def test_ids_are_ordered():
+    generated = [ids.uuid7() for _ in range(10000)]
+    assert generated == sorted(generated)
+    assert len(set(generated)) == len(generated)
+
+def test_is_valid():
+    assert ids.is_valid(ids.new_id())
+    assert ids.is_valid(uuid.uuid4())
+    assert not ids.is_valid("not-a-uuid")
+    assert not ids.is_valid("")
+
+def test_codec_round_trip():
+    value = ids.new_id()
+    assert ids.decode(ids.encode(value)) == value
+    assert ids.encode(uuid.UUID(value)) == ids.encode(value)
+    with pytest.raises(ValueError):
+        ids.encode("not-a-uuid")
+
+def test_cursor_with_a_malformed_id_is_rejected():
+    timestamp, row_id = datetime(2024, 1, 1), ids.new_id()
+    assert pagination.decode_cursor(pagination.encode_cursor(timestamp, row_id)) == (timestamp, row_id)
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(pagination.encode_cursor(timestamp, "not-a-uuid"))
+
+def test_shadow_index_definition():
+    definition = "CREATE UNIQUE INDEX idx_audit_events_user_chain ON public.audit_events USING btree (user_id, chain_index)"
+    assert shadow_index_definition("idx_audit_events_user_chain", definition, ["id", "user_id"]) == (
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_audit_events_user_chain_uuid "
+        "ON public.audit_events USING btree (user_id_uuid, chain_index)"
+    )
+    definition = "CREATE INDEX idx_user_profiles_active ON public.user_profiles USING btree (created_at, id) WHERE (NOT is_deleted)"
+    assert shadow_index_definition("idx_user_profiles_active", definition, ["id"]) == (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_profiles_active_uuid "
+        "ON public.user_profiles USING btree (created_at, id_uuid) WHERE (NOT is_deleted)"
+    )
+
+def legacy_schema() -> str:
+    # postgres/init.sql as it was when ids were VARCHAR columns (tombstones came later, with uuid ids)
+    return "\n".join(
+        line if "purged profile" in line else line.replace(" UUID PRIMARY KEY", " VARCHAR(255) PRIMARY KEY").replace(" UUID,", " VARCHAR(255),")
+        for line in database.SCHEMA_PATH.read_text().splitlines()
+    )
+
+@pytest.mark.asyncio
+async def test_schema_applies_again_after_uuid_migration():
+    try:
+        connection = await asyncpg.connect(database.DATABASE_URL, timeout=2)
+    except (OSError, asyncpg.PostgresError, TimeoutError) as e:
+        pytest.skip(f"Postgres not reachable: {e}")
+    schema = f"migrate_{uuid.uuid4().hex}"  # A scratch copy of the tables, away from the shared ones
+    try:
+        await connection.execute(f"CREATE SCHEMA {schema}; SET search_path TO {schema}")
+        await connection.execute(legacy_schema())
+        user_id, event_id = ids.new_id(), ids.new_id()
+        await connection.execute("INSERT INTO user_profiles (id, name, email) VALUES ($1, 'Legacy', 'legacy@example.com')", user_id)
+        await connection.execute("INSERT INTO audit_events (id, user_id, action) VALUES ($1, $2, 'CREATE_PROFILE')", event_id, user_id)
+
+        await migrate_uuid_keys(connection, pause=0, max_lag=0, cut_over=False)
+        await database.apply_schema(connection)  # Restarted between the backfill and the cutover
+        await migrate_uuid_keys(connection, pause=0, max_lag=0)
+        await database.apply_schema(connection)  # Next start on the migrated database
+
+        types = await connection.fetch(
+            "SELECT table_name, data_type FROM information_schema.columns WHERE table_schema = $1 AND column_name IN ('id', 'user_id')", schema
+        )
+        assert {row["table_name"] for row in types if row["data_type"] != "uuid"} == set()
+        row = await connection.fetchrow("SELECT id::text, user_id::text FROM audit_events_all")
+        assert (row["id"], row["user_id"]) == (event_id, user_id)
+    finally:
+        await connection.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await connection.close()
@@ -0,0 +1,120 @@
+import json
+import uuid
+from datetime import datetime, timedelta
+import asyncpg
+import pytest
+from app import database, ids
+from app.audit_replay import HISTORY_MISSING, PROFILE_DIFFERS, PROFILE_MISSING, replay_segments
+from app.jobs import replay_profiles
+from app.jobs.replay_profiles import merge_users, rebuild_profiles
+from app.models.user_profile import UserProfile, UserProfileCreate
+from app.repositories.user_profile_repository import UserProfileRepository
+
+CREATED = datetime(2024, 1, 1)
+
+def stored(name="Ana", email="ana@example.com", is_deleted=False, has_profile=True, purged=False, state=None, up_to=None):
+    return {"has_profile": has_profile, "name": name, "email": email, "is_deleted": is_deleted,
+            "change_seq": 7 if has_profile else None, "purged": purged, "state": json.dumps(state) if state else None, "up_to": up_to}
+
+def event(action, minutes=0, **changes):
+    return (action, CREATED + timedelta(minutes=minutes), json.dumps({field: {"old": old, "new": new} for field, (old, new) in changes.items()}))
+
+HISTORY = [
+    event("CREATE_PROFILE", name=(None, "Ana"), email=(None, "ana@example.com")),
+    event("UPDATE_PROFILE", 1, name=("Ana", "Bia")),
+    event("ROLLBACK_EVENT", 2, name=("Bia", "Ana")),
+]
+
+def test_consistent_profiles_are_not_reported():
+    deleted = HISTORY + [event("DELETE_PROFILE", 3, name=("Ana", None), email=("ana@example.com", None))]
+    assert replay_segments([
+        ("u1", stored(), HISTORY),
+        ("u2", stored(is_deleted=True), deleted),
+        ("u3", stored(has_profile=False, name=None, email=None, is_deleted=None, purged=True), deleted),
+        ("u4", stored(state={"name": "Ana", "email": "ana@example.com", "is_deleted": False}, up_to=CREATED), []),
+    ]) == []
+
+def test_drift_is_reported_with_the_replayed_state():
+    deleted = HISTORY + [event("DELETE_PROFILE", 3, name=("Ana", None), email=("ana@example.com", None))]
+    mismatches = replay_segments([
+        ("u1", stored(name="Bia"), HISTORY),
+        ("u2", None, deleted),
+        ("u3", stored(), []),
+    ])
+    expected = {"name": "Ana", "email": "ana@example.com", "is_deleted": False}
+    assert mismatches == [
+        ("u1", PROFILE_DIFFERS, expected, None, 7),
+        ("u2", PROFILE_MISSING, {**expected, "is_deleted": True}, CREATED + timedelta(minutes=3), None),
+        ("u3", HISTORY_MISSING, None, None, None),
+    ]
+
+@pytest.mark.asyncio
+async def test_merge_users_pairs_both_sides_in_id_order():
+    async def iterate(items):
+        for item in items:
+            yield item
+
+    merged = [user async for user in merge_users(
+        iterate([("a", "stored a"), ("c", "stored c")]),
+        iterate([("b", ["event b"]), ("c", ["event c"]), ("d", ["event d"])]),
+    )]
+    assert merged == [("a", "stored a", []), ("b", None, ["event b"]), ("c", "stored c", ["event c"]), ("d", None, ["event d"])]
+
+@pytest.mark.asyncio
+async def test_postgres_drift_is_found_and_rebuilt(monkeypatch):
+    try:
+        connection = await asyncpg.connect(database.DATABASE_URL, timeout=2)
+    except (OSError, asyncpg.PostgresError, TimeoutError) as e:
+        pytest.skip(f"Postgres not reachable: {e}")
+    monkeypatch.setattr(replay_profiles, "MAX_REPORTED_MISMATCHES", 10_000)  # The database is shared with other tests
+
+    orphan = ids.new_id()
+    try:
+        await database.register_codecs(connection)
+        profiles = UserProfileRepository(connection)
+        drifted, missing = [
+            await profiles.create(UserProfileCreate(name="Replayed", email=f"replay.{uuid.uuid4().hex}@example.com"))
+            for _ in range(2)
+        ]
+        await profiles.update(UserProfile(**{**drifted.model_dump(), "name": "Replayed Again"}))
+        await connection.execute("UPDATE user_profiles SET name = 'Drifted' WHERE id = $1", drifted.id)
+        await connection.execute("DELETE FROM user_profiles WHERE id = $1", missing.id)
+        await connection.execute("INSERT INTO user_profiles (id, name, email) VALUES ($1, 'Orphan', $2)",
+                                 orphan, f"replay.{uuid.uuid4().hex}@example.com")
+
+        summary = await replay_profiles.replay_profiles(rebuild=True, workers=1, batch_size=50)
+        reasons = {mismatch["user_id"]: mismatch["reason"] for mismatch in summary["mismatches"]}
+        assert (reasons[drifted.id], reasons[missing.id], reasons[orphan]) == (PROFILE_DIFFERS, PROFILE_MISSING, HISTORY_MISSING)
+        assert (await profiles.get_by_id(drifted.id)).name == "Replayed Again"
+        assert (await profiles.get_by_id(missing.id)).email == missing.email
+
+        reasons = {mismatch["user_id"]: mismatch["reason"] for mismatch in (await replay_profiles.replay_profiles(workers=1))["mismatches"]}
+        assert drifted.id not in reasons and missing.id not in reasons
+        assert reasons[orphan] == HISTORY_MISSING  # Nothing to rebuild it from
+    finally:
+        await connection.execute("DELETE FROM user_profiles WHERE id = $1", orphan)
+        await connection.close()
+
+@pytest.mark.asyncio
+async def test_rebuild_leaves_profiles_written_since_the_snapshot():
+    try:
+        connection = await asyncpg.connect(database.DATABASE_URL, timeout=2)
+    except (OSError, asyncpg.PostgresError, TimeoutError) as e:
+        pytest.skip(f"Postgres not reachable: {e}")
+    try:
+        await database.register_codecs(connection)
+        profiles = UserProfileRepository(connection)
+        profile = await profiles.create(UserProfileCreate(name="Snapshot", email=f"replay.{uuid.uuid4().hex}@example.com"))
+        change_seq = await connection.fetchval("SELECT change_seq FROM user_profiles WHERE id = $1", profile.id)
+        await profiles.update(UserProfile(**{**profile.model_dump(), "name": "Written Since"}))
+
+        fix = (profile.id, "Replayed", profile.email, False, None)
+        assert await rebuild_profiles(connection, [fix + (change_seq,)]) == (0, 0)
+        assert await rebuild_profiles(connection, [fix + (None,)]) == (0, 0)  # Missing in the snapshot, created since
+        assert (await profiles.get_by_id(profile.id)).name == "Written Since"
+
+        change_seq = await connection.fetchval("SELECT change_seq FROM user_profiles WHERE id = $1", profile.id)
+        assert await rebuild_profiles(connection, [fix + (change_seq,)]) == (1, 0)
+        assert (await profiles.get_by_id(profile.id)).name == "Replayed"
+    finally:
+        await connection.close()
@@ -0,0 +1,71 @@
+import asyncio
+import time
+import pytest
+from fastapi.testclient import TestClient
+from app import profiling
+from app.main import app
+
+client = TestClient(app)
+
+@pytest.fixture(autouse=True)
+def empty_store(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_TOKEN", "profile-token")
+    profiling.clear()
+    yield
+    profiling.clear()
+
+def busy(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+async def handler():
+    busy(0.05)  # On the loop thread
+    await asyncio.sleep(0.05)  # Suspended
+
+@pytest.mark.asyncio
+async def test_profiler_samples_running_and_waiting_stacks():
+    coroutine = handler()
+    profiler = profiling.Profiler(coroutine, interval=0.001)
+    profiler.start()
+    try:
+        await coroutine
+    finally:
+        profiler.stop()
+
+    running = {stack: count for stack, count in profiler.stacks.items() if stack.split(";")[-1].startswith("busy ")}
+    waiting = {stack: count for stack, count in profiler.stacks.items() if stack.endswith(profiling.WAITING_FRAME)}
+    assert running and waiting
+    assert all(stack.startswith("handler (") for stack in profiler.stacks)  # Rooted at the profiled coroutine
+    assert profiler.samples == sum(profiler.stacks.values())
+    assert profiler.folded().splitlines()[0].rsplit(" ", 1)[1].isdigit()
+
+def test_route_rates():
+    rates = profiling.parse_route_rates("GET ^/api/v1/users/profile/$=0.5; post ^/api/v1/audit/verify/$=1")
+    assert [(method, pattern.pattern, rate) for method, pattern, rate in rates] == [
+        ("GET", "^/api/v1/users/profile/$", 0.5), ("POST", "^/api/v1/audit/verify/$", 1.0),
+    ]
+    with pytest.raises(ValueError):
+        profiling.parse_route_rates("GET=0.5")
+
+def test_requested_profiles_are_stored_and_served():
+    headers = {"Authorization": "Bearer test"}
+    response = client.get("/api/v1/users/profile/", headers={**headers, "X-Profile": "profile-token"})
+    assert response.status_code == 200
+    profile_id = response.headers["x-profile-id"]
+
+    by_query = client.get("/api/v1/users/profile/?profile=profile-token", headers=headers).headers["x-profile-id"]
+    assert "x-profile-id" not in client.get("/api/v1/users/profile/", headers={**headers, "X-Profile": "wrong"}).headers
+
+    profiles = client.get("/api/v1/admin/profiling/", headers=headers).json()
+    assert [profile["id"] for profile in profiles] == [by_query, profile_id]
+    assert profiles[1]["route"] == "/api/v1/users/profile/"
+    assert (profiles[1]["trigger"], profiles[1]["status_code"]) == ("requested", 200)
+
+    stacks = client.get(f"/api/v1/admin/profiling/{profile_id}", headers=headers)
+    assert stacks.status_code == 200
+    assert stacks.headers["content-type"].startswith("text/plain")
+    assert client.get("/api/v1/admin/profiling/unknown", headers=headers).status_code == 404
+
+    assert client.delete("/api/v1/admin/profiling/", headers=headers).status_code == 204
+    assert client.get("/api/v1/admin/profiling/", headers=headers).json() == []
@@ -0,0 +1,123 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from asyncpg.connection import LoggedQuery
+from app import query_log
+from app.middleware.query_route import QueryRouteMiddleware
+
+class FakeConnection:
+    # Records the EXPLAIN statements and transactions run to capture a plan
+    def __init__(self):
+        self.statements, self.transactions, self.closed = [], [], False
+
+    def transaction(self, readonly=False):
+        connection = self
+
+        class Transaction:
+            async def start(self):
+                connection.transactions.append(("start", readonly))
+
+            async def rollback(self):
+                connection.transactions.append(("rollback", readonly))
+        return Transaction()
+
+    async def fetch(self, statement, *args, timeout=None):
+        self.statements.append((statement, args))
+        return [("Index Scan using user_profiles_pkey on user_profiles",), ("Buffers: shared hit=3",)]
+
+    async def close(self):
+        self.closed = True
+
+def logged(query, args=(), elapsed=0.5, exception=None):
+    return LoggedQuery(query=query, args=args, timeout=None, elapsed=elapsed, exception=exception, conn_addr=None, conn_params=None)
+
+@pytest.fixture(autouse=True)
+def empty_ring():
+    query_log.clear()
+    yield
+    query_log.clear()
+
+def test_slow_statements_are_recorded_with_redacted_params():
+    assert query_log.log_query(logged("SELECT 1", elapsed=0.001), sample_rate=0) is None  # Under the threshold
+
+    scope = {"method": "GET", "path": "/api/v1/users/42/profile/", "route": SimpleNamespace(path="/api/v1/users/{user_id}/profile/")}
+    token = query_log.current_request.set(scope)
+    try:
+        entry = query_log.log_query(logged("SELECT *\n  FROM user_profiles WHERE id = $1 AND email = $2", ("42", "secret@example.com")), sample_rate=0)
+    finally:
+        query_log.current_request.reset(token)
+
+    assert entry["route"] == "GET /api/v1/users/{user_id}/profile/"
+    assert entry["statement"] == "SELECT * FROM user_profiles WHERE id = $1 AND email = $2"
+    assert entry["params"] == ["<str>", "<str>"]  # Values never reach the log
+    assert entry["elapsed_ms"] == 500.0
+    assert query_log.recent() == [entry]
+
+@pytest.mark.asyncio
+async def test_reads_are_explained_with_analyze_in_a_rolled_back_read_only_transaction():
+    connection = FakeConnection()
+
+    async def connect():
+        return connection
+
+    entry = query_log.log_query(logged("SELECT * FROM user_profiles WHERE id = $1", ("42",)), sample_rate=1, connect=connect)
+    for _ in range(10):
+        await asyncio.sleep(0)  # Let the capture task run
+    assert connection.statements == [("EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM user_profiles WHERE id = $1", ("42",))]
+    assert connection.transactions == [("start", True), ("rollback", True)]
+    assert entry["plan"].startswith("Index Scan")
+    assert connection.closed
+
+@pytest.mark.asyncio
+async def test_writes_are_only_explained():
+    connection = FakeConnection()
+
+    async def connect():
+        return connection
+
+    entry = query_log.log_query(logged("UPDATE user_profiles SET name = $1 WHERE id = $2", ("New", "42")), sample_rate=0)
+    await query_log.capture_plan(entry, "UPDATE user_profiles SET name = $1 WHERE id = $2", ("New", "42"), connect)
+    assert connection.statements[0][0] == "EXPLAIN UPDATE user_profiles SET name = $1 WHERE id = $2"
+    assert connection.transactions == [("start", False), ("rollback", False)]
+
+@pytest.mark.asyncio
+async def test_selects_with_side_effects_are_only_explained():
+    connection = FakeConnection()
+
+    async def connect():
+        return connection
+
+    statement = "SELECT pg_advisory_xact_lock(hashtext(u)) FROM (SELECT u FROM unnest($1::text[]) AS u ORDER BY u) AS users"
+    entry = query_log.log_query(logged(statement, (["42"],)), sample_rate=0)
+    await query_log.capture_plan(entry, statement, (["42"],), connect)
+    assert connection.statements[0][0] == f"EXPLAIN {statement}"  # Not run again: it would wait for the lock
+    assert not query_log.is_plain_read("SELECT nextval('audit_events_seq')")
+    assert query_log.is_plain_read("SELECT * FROM user_profiles WHERE id = $1")
+
+@pytest.mark.asyncio
+async def test_a_burst_of_slow_statements_starts_at_most_the_allowed_captures(monkeypatch):
+    monkeypatch.setattr(query_log, "SLOW_QUERY_MAX_CAPTURES", 2)
+    connects = []
+
+    async def connect():
+        connects.append(None)
+        return FakeConnection()
+
+    for _ in range(5):  # Logged back to back, before any capture task gets to run
+        query_log.log_query(logged("SELECT * FROM user_profiles"), sample_rate=1, connect=connect)
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert len(connects) == 2
+    assert not query_log._captures  # Released once done
+
+@pytest.mark.asyncio
+async def test_middleware_exposes_the_request_route():
+    routes = []
+
+    async def app(scope, receive, send):
+        scope["route"] = SimpleNamespace(path="/api/v1/audit/events/{user_id}")  # What FastAPI's router does
+        routes.append(query_log.current_route())
+
+    await QueryRouteMiddleware(app)({"type": "http", "method": "GET", "path": "/api/v1/audit/events/42"}, None, None)
+    assert routes == ["GET /api/v1/audit/events/{user_id}"]
+    assert query_log.current_route() is None  # Reset after the request
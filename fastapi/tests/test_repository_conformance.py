@@ -0,0 +1,440 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+import asyncpg
+import pytest
+import pytest_asyncio
+from app import database
+from app.jobs.backfill_columns import backfill_columns
+from app.jobs.import_profiles import import_profiles
+from app.jobs.purge_deleted_profiles import new_purge_run, purge_deleted_profiles
+from app.models.audit_event import SYSTEM_USER_ID, AuditEventAction, AuditEventBase
+from app.models.purge import PurgeStatus
+from app.models.user_profile import UserProfile, UserProfileCreate
+from app.pagination import decode_change_cursor
+from app.repositories.audit_event_repository import AuditEventRepository
+from app.repositories.memory import InMemoryAuditEventRepository, InMemoryStore, InMemoryUserProfileRepository
+from app.repositories.sharded import ShardedAuditEventRepository, ShardedUserProfileRepository, in_memory_shards
+from app.repositories.user_profile_repository import UserProfileRepository
+
+# Shared conformance suite: every storage backend must behave the same way through the repository interface.
+# The Postgres backend is skipped when no database is reachable at DATABASE_URL; the sharded backend
+# spreads the data over three in-memory shards.
+
+pytestmark = pytest.mark.asyncio
+
+@pytest_asyncio.fixture(params=["memory", "sharded", "postgres"])
+async def repositories(request):
+    if request.param == "memory":
+        store = InMemoryStore()
+        yield InMemoryUserProfileRepository(store), InMemoryAuditEventRepository(store)
+        return
+    if request.param == "sharded":
+        shards = in_memory_shards([InMemoryStore() for _ in range(3)])
+        events = ShardedAuditEventRepository(shards)
+        yield ShardedUserProfileRepository(shards, audit_event_repository=events), events
+        return
+
+    try:
+        connection = await asyncpg.connect(database.DATABASE_URL, timeout=2)
+    except (OSError, asyncpg.PostgresError, TimeoutError) as e:
+        pytest.skip(f"Postgres not reachable: {e}")
+    await database.register_codecs(connection)
+    yield UserProfileRepository(connection), AuditEventRepository(connection)
+    await connection.close()
+
+def new_profile(name="Conformance User"):
+    # Emails are unique per test run, since the Postgres database outlives the test session
+    return UserProfileCreate(name=name, email=f"conformance.{uuid.uuid4().hex}@example.com")
+
+async def test_create_and_get_by_id(repositories):
+    profiles, events = repositories
+    created = await profiles.create(new_profile())
+
+    fetched = await profiles.get_by_id(created.id)
+    assert fetched == created
+    assert fetched.is_deleted is False
+
+    history = await events.get_by_user_id(created.id)
+    assert [event.action for event in history] == [AuditEventAction.CREATE_PROFILE]
+    assert history[0].changes["email"] == {"old": None, "new": created.email}
+
+async def test_missing_ids_return_none(repositories):
+    profiles, events = repositories
+    assert await profiles.get_by_id(str(uuid.uuid4())) is None
+    assert await events.get_by_id(str(uuid.uuid4())) is None
+    assert await events.get_by_user_id(str(uuid.uuid4())) == []
+
+async def test_malformed_ids_are_not_found(repositories):
+    profiles, events = repositories
+    created = await profiles.create(new_profile())
+    assert await profiles.get_by_id("not-a-uuid") is None
+    assert await profiles.get_many([created.id, "not-a-uuid"]) == {created.id: created}
+    assert await events.get_by_id("not-a-uuid") is None
+    assert await events.get_by_user_id("not-a-uuid") == []
+
+async def test_get_many(repositories):
+    profiles, events = repositories
+    first = await profiles.create(new_profile())
+    second = await profiles.create(new_profile())
+    missing = str(uuid.uuid4())
+
+    found = await profiles.get_many([second.id, missing, first.id, first.id])
+    assert found == {first.id: first, second.id: second}
+
+    event = (await events.get_by_user_id(first.id))[0]
+    assert await events.get_many([event.id, missing]) == {event.id: event}
+
+async def test_email_uniqueness(repositories):
+    profiles, _ = repositories
+    first = await profiles.create(new_profile())
+    with pytest.raises(asyncpg.UniqueViolationError):
+        await profiles.create(UserProfileCreate(name="Duplicate", email=first.email))
+
+    second = await profiles.create(new_profile())
+    with pytest.raises(asyncpg.UniqueViolationError):
+        await profiles.update(UserProfile(id=second.id, name="Duplicate", email=first.email, is_deleted=False))
+
+async def test_update_records_ordered_history(repositories):
+    profiles, events = repositories
+    created = await profiles.create(new_profile("Before"))
+    changed = new_profile("After")
+    await profiles.update(UserProfile(id=created.id, name=changed.name, email=changed.email, is_deleted=False))
+
+    assert (await profiles.get_by_id(created.id)).name == "After"
+    history = await events.get_by_user_id(created.id)
+    assert [event.action for event in history] == [AuditEventAction.CREATE_PROFILE, AuditEventAction.UPDATE_PROFILE]
+    assert history[-1].changes["name"] == {"old": "Before", "new": "After"}
+    assert await events.get_by_id(history[-1].id) == history[-1]
+
+async def test_delete_restore_and_active_listing(repositories):
+    profiles, events = repositories
+    created = await profiles.create(new_profile())
+    await profiles.delete(created.id)
+
+    assert (await profiles.get_by_id(created.id)).is_deleted is True
+    assert created.id not in {profile.id for profile in await profiles.get_all_active()}
+    assert created.id in {profile.id for profile in await profiles.get_all()}
+
+    restored = await profiles.restore(created.id)
+    assert restored.is_deleted is False
+    assert created.id in {profile.id for profile in await profiles.get_all_active()}
+    history = await events.get_by_user_id(created.id)
+    assert [event.action for event in history][-2:] == [AuditEventAction.DELETE_PROFILE, AuditEventAction.RESTORE_PROFILE]
+
+async def test_rollback_update_and_delete(repositories):
+    profiles, events = repositories
+    original = new_profile("Original")
+    created = await profiles.create(original)
+    changed = new_profile("Changed")
+    await profiles.update(UserProfile(id=created.id, name=changed.name, email=changed.email, is_deleted=False))
+    update_event = (await events.get_by_user_id(created.id))[-1]
+
+    await profiles.rollback_changes_by_event_id(update_event.id)
+    rolled_back = await profiles.get_by_id(created.id)
+    assert (rolled_back.name, rolled_back.email) == (original.name, original.email)
+    assert (await events.get_by_user_id(created.id))[-1].action == AuditEventAction.ROLLBACK_EVENT
+
+    await profiles.delete(created.id)
+    delete_event = (await events.get_by_user_id(created.id))[-1]
+    await profiles.rollback_changes_by_event_id(delete_event.id)
+    assert (await profiles.get_by_id(created.id)).is_deleted is False
+    assert (await events.get_by_user_id(created.id))[-1].action == AuditEventAction.ROLLBACK_DELETE
+
+async def test_events_are_hash_chained(repositories):
+    profiles, events = repositories
+    created = await profiles.create(new_profile())
+    await profiles.delete(created.id)
+
+    history = await events.get_by_user_id(created.id)
+    assert [event.chain_index for event in history] == [1, 2]
+    assert history[1].prev_hash == history[0].hash
+
+    summary = await events.verify_chain()
+    assert summary["mismatch_count"] == 0
+    assert summary["events_verified"] >= 2
+
+async def test_compaction_keeps_history_and_rollback(repositories):
+    profiles, events = repositories
+    original = new_profile("Version 0")
+    created = await profiles.create(original)
+    for version in range(1, 5):
+        await profiles.update(UserProfile(id=created.id, name=f"Version {version}", email=original.email, is_deleted=False))
+    first_update = (await events.get_by_user_id(created.id))[1]
+
+    assert await events.compact(created.id, up_to_index=3) == 3
+    history = await events.get_history(created.id)
+    assert history.checkpoint.chain_index == 3
+    assert history.checkpoint.event_count == 3
+    assert history.checkpoint.state == {"name": "Version 2", "email": original.email, "is_deleted": False}
+    assert [event.chain_index for event in history.events] == [4, 5]
+
+    # Archived events are still found by id and can be rolled back
+    assert await events.get_by_id(first_update.id) == first_update
+    await profiles.rollback_changes_by_event_id(first_update.id)
+    assert (await profiles.get_by_id(created.id)).name == "Version 0"
+
+    # Compacting again folds into the same checkpoint, and the chain still verifies across the archive
+    assert await events.compact(created.id, up_to_index=5) == 2
+    assert (await events.get_checkpoint(created.id)).event_count == 5
+    assert (await events.verify_chain(full=True))["mismatch_count"] == 0
+
+async def test_list_profiles_with_activity(repositories):
+    profiles, events = repositories
+    original = new_profile("Listed 0")
+    created = await profiles.create(original)
+    for version in range(1, 4):
+        await profiles.update(UserProfile(id=created.id, name=f"Listed {version}", email=original.email, is_deleted=False))
+    await events.compact(created.id, up_to_index=2)
+    latest = (await events.get_by_user_id(created.id))[-1]
+
+    listed = [item for item in await profiles.list_profiles(include=("last_event", "event_count")) if item.id == created.id]
+    assert listed[0].last_event == latest
+    assert listed[0].event_count == 4  # Compacted events still count
+    plain = await profiles.list_profiles()
+    assert [item.id for item in plain] == sorted(item.id for item in plain)
+    assert "last_event" not in plain[0].model_fields_set
+
+    # Keyset pages: ordered by id, resuming after the last id of the previous page
+    first_page = await profiles.list_profiles(limit=1)
+    second_page = await profiles.list_profiles(after=first_page[-1].id, limit=1)
+    assert [item.id for item in first_page + second_page] == [item.id for item in plain[:2]]
+
+    await profiles.delete(created.id)
+    assert created.id not in [item.id for item in await profiles.list_profiles(active_only=True)]
+
+async def test_count_by_bucket(repositories):
+    profiles, events = repositories
+    created = await profiles.create(new_profile())
+    await profiles.delete(created.id)
+    event = (await events.get_by_user_id(created.id))[0]
+    start = event.timestamp.replace(minute=0, second=0, microsecond=0)
+    end = datetime.now() + timedelta(hours=1)
+
+    rows = await events.count_by_bucket("hour", ("action",), start, end)
+    counts = {(row["bucket"], row["action"]): row["count"] for row in rows}
+    assert counts[(start, "CREATE_PROFILE")] >= 1
+    assert all(set(row) == {"bucket", "action", "count"} for row in rows)
+    assert rows == sorted(rows, key=lambda row: (row["bucket"], row["action"]))
+    assert await events.replayed_until() is None  # Not a replica
+
+async def test_purge_in_chunks(repositories):
+    profiles, events = repositories
+    deleted = [await profiles.create(new_profile()) for _ in range(3)]
+    for profile in deleted:
+        await profiles.delete(profile.id)
+    kept = await profiles.create(new_profile())
+    assert (await profiles.get_by_id(deleted[0].id)).deleted_at is not None
+
+    run = new_purge_run(older_than_days=0, chunk_size=2, now=datetime.now() + timedelta(seconds=1))
+    await profiles.save_purge_run(run)
+    assert await profiles.purge_chunk(run) == 2  # One chunk; the cursor is saved with it
+    saved = await profiles.get_purge_run(run.id)
+    assert (saved.purged, saved.chunks, saved.cursor_id) == (2, 1, run.cursor_id)
+    assert saved.resumable
+
+    # Resuming continues after the cursor until nothing is left
+    run = await purge_deleted_profiles(profiles, saved, pause=0, max_lag=0)
+    assert run.status == PurgeStatus.COMPLETED and not run.resumable
+    assert run.purged >= 3
+    assert await profiles.get_many([profile.id for profile in deleted]) == {}
+    assert await profiles.get_by_id(kept.id) == kept
+    assert (await events.get_by_user_id(SYSTEM_USER_ID))[-1].changes["purge"]["run_id"] == run.id
+
+    # The email of a purged profile can be used again
+    await profiles.create(UserProfileCreate(name="Reused", email=deleted[0].email))
+
+async def test_purge_waits_for_rows_locked_during_the_run(repositories):
+    profiles, _ = repositories
+    if getattr(profiles, "connection", None) is None:
+        pytest.skip("only Postgres has row locks")
+    deleted = [await profiles.create(new_profile()) for _ in range(3)]
+    for profile in deleted:
+        await profiles.delete(profile.id)
+
+    # A concurrent transaction (e.g. a restore) holds the first profile: the keyset pass skips it
+    locker = await asyncpg.connect(database.DATABASE_URL)
+    transaction = locker.transaction()
+    await transaction.start()
+    await locker.execute("SELECT 1 FROM user_profiles WHERE id = $1::uuid FOR UPDATE", deleted[0].id)
+    run = new_purge_run(older_than_days=0, chunk_size=1, now=datetime.now() + timedelta(seconds=1))
+    purge = asyncio.create_task(purge_deleted_profiles(profiles, run, pause=0, max_lag=0))
+    await asyncio.sleep(0.5)
+    assert not purge.done()  # The final sweep waits for the lock instead of completing without the row
+    await transaction.rollback()
+    await locker.close()
+
+    run = await purge
+    assert run.status == PurgeStatus.COMPLETED
+    assert await profiles.get_many([profile.id for profile in deleted]) == {}
+
+async def test_backfill_deleted_at(repositories):
+    profiles, events = repositories
+    if getattr(profiles, "connection", None) is None:
+        pytest.skip("backfills only run against Postgres")
+    created = await profiles.create(new_profile())
+    await profiles.delete(created.id)
+    await profiles.connection.execute("UPDATE user_profiles SET deleted_at = NULL WHERE id = $1", created.id)  # As before deleted_at existed
+
+    summary = await backfill_columns(profiles.connection, batch_size=2, pause=0)
+    assert summary["rows_updated"]["user_profiles.deleted_at"] >= 1
+    deletion = (await events.get_by_user_id(created.id))[-1]
+    assert (await profiles.get_by_id(created.id)).deleted_at == deletion.timestamp
+
+async def test_change_seq_is_added_in_place_and_backfilled():
+    try:
+        connection = await asyncpg.connect(database.DATABASE_URL, timeout=2)
+    except (OSError, asyncpg.PostgresError, TimeoutError) as e:
+        pytest.skip(f"Postgres not reachable: {e}")
+    schema = f"backfill_{uuid.uuid4().hex}"  # A scratch copy of the tables, away from the shared ones
+    try:
+        await database.register_codecs(connection)
+        await connection.execute(f"CREATE SCHEMA {schema}; SET search_path TO {schema}")
+        # user_profiles as it was before the delta sync feed
+        await connection.execute("CREATE TABLE user_profiles (id UUID PRIMARY KEY, name VARCHAR(255) NOT NULL, "
+                                 "email VARCHAR(255) NOT NULL UNIQUE, is_deleted BOOLEAN DEFAULT FALSE)")
+        await connection.executemany("INSERT INTO user_profiles (id, name, email) VALUES ($1, 'Legacy', $2)",
+                                     [(str(uuid.uuid4()), f"legacy{i}@example.com") for i in range(5)])
+        storage = "SELECT relfilenode FROM pg_class WHERE oid = 'user_profiles'::regclass"
+        before = await connection.fetchval(storage)
+
+        await database.apply_schema(connection)
+        assert await connection.fetchval(storage) == before  # Not rewritten
+        assert await connection.fetchval("SELECT count(*) FROM user_profiles WHERE change_seq IS NULL") == 5
+
+        summary = await backfill_columns(connection, batch_size=2, pause=0)
+        assert summary["rows_updated"]["user_profiles.change_seq"] == 5
+        assert summary["checks_validated"] == ["user_profiles_change_seq_not_null"]
+        assert await connection.fetchval("SELECT count(DISTINCT change_seq) FROM user_profiles") == 3  # One per batch
+        with pytest.raises(asyncpg.CheckViolationError):
+            await connection.execute("UPDATE user_profiles SET change_seq = NULL")
+
+        await database.apply_schema(connection)  # Next start
+        assert (await backfill_columns(connection, pause=0))["checks_validated"] == []
+    finally:
+        await connection.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await connection.close()
+
+async def sync_changes(profiles, after=None):
+    # Pages through the delta sync feed from a position to its end, like a client would
+    changes, has_more = [], True
+    while has_more:
+        page = await profiles.get_changes(after=after, limit=500)
+        changes += page.changes
+        after, has_more = decode_change_cursor(page.cursor), page.has_more
+    return changes, after
+
+async def test_changes_since(repositories):
+    profiles, events = repositories
+    _, position = await sync_changes(profiles)
+    first, second = await profiles.create(new_profile("First")), await profiles.create(new_profile("Second"))
+    changes, position = await sync_changes(profiles, position)
+    assert [(change.id, change.name, change.is_deleted) for change in changes] == [(first.id, "First", False), (second.id, "Second", False)]
+    assert changes[0].updated_at <= changes[1].updated_at  # change_seq only orders the changes of one database
+
+    # Every write moves the profile to the end of the feed, with its current state
+    await profiles.update(UserProfile(**{**first.model_dump(), "name": "Renamed"}))
+    await profiles.delete(second.id)
+    changes, position = await sync_changes(profiles, position)
+    assert [(change.id, change.name, change.is_deleted) for change in changes] == [(first.id, "Renamed", False), (second.id, "Second", True)]
+    update = (await events.get_by_user_id(first.id))[-1]
+    await profiles.rollback_changes_by_event_id(update.id)
+    changes, position = await sync_changes(profiles, position)
+    assert [(change.id, change.name) for change in changes] == [(first.id, "First")]
+
+    # Purged profiles leave a tombstone
+    run = new_purge_run(older_than_days=0, chunk_size=100, now=datetime.now() + timedelta(seconds=1))
+    await purge_deleted_profiles(profiles, run, pause=0, max_lag=0)
+    changes, position = await sync_changes(profiles, position)
+    tombstone = next(change for change in changes if change.id == second.id)
+    assert (tombstone.purged, tombstone.is_deleted, tombstone.name, tombstone.email) == (True, True, None, None)
+    assert first.id not in {change.id for change in changes}
+    assert (await profiles.get_changes(after=position)).changes == []
+
+async def test_create_many_chains_events_in_order(repositories):
+    profiles, events = repositories
+    first = await profiles.create(new_profile())
+    second = await profiles.create(new_profile())
+
+    await events.create_many([
+        AuditEventBase(user_id=first.id, action=AuditEventAction.UPDATE_PROFILE, resource="user_profile", changes={}),
+        AuditEventBase(user_id=second.id, action=AuditEventAction.UPDATE_PROFILE, resource="user_profile", changes={}),
+        AuditEventBase(user_id=first.id, action=AuditEventAction.DELETE_PROFILE, resource="user_profile", changes={}),
+    ])
+    history = await events.get_by_user_id(first.id)
+    assert [(event.chain_index, event.action) for event in history] == [
+        (1, AuditEventAction.CREATE_PROFILE), (2, AuditEventAction.UPDATE_PROFILE), (3, AuditEventAction.DELETE_PROFILE),
+    ]
+    assert history[2].prev_hash == history[1].hash
+    assert [event.chain_index for event in await events.get_by_user_id(second.id)] == [1, 2]
+
+async def test_find_field_changes(repositories):
+    profiles, events = repositories
+    original = new_profile("Field Query")
+    created = await profiles.create(original)
+    changed = new_profile("Field Query")
+    await profiles.update(UserProfile(id=created.id, name=changed.name, email=changed.email, is_deleted=False))
+    await profiles.update(UserProfile(id=created.id, name="Renamed", email=changed.email, is_deleted=False))
+    create_event, email_change, rename = await events.get_by_user_id(created.id)
+
+    # Every event where the email was the original one, before or after the event
+    found = await events.find_field_changes("email", value=original.email)
+    assert [event.id for event in found] == [email_change.id, create_event.id]  # Newest first
+    assert [event.id for event in await events.find_field_changes("email", old=original.email)] == [email_change.id]
+    assert [event.id for event in await events.find_field_changes("email", new=changed.email)] == [rename.id, email_change.id]
+
+    # Without a value, only events that actually changed the field (the rename kept the email)
+    changed_email = [event.id for event in await events.find_field_changes("email", limit=1000)]
+    assert email_change.id in changed_email and rename.id not in changed_email
+
+    # Keyset pagination: the second page continues after the first
+    first_page = await events.find_field_changes("email", value=changed.email, limit=1)
+    second_page = await events.find_field_changes("email", value=changed.email, limit=1,
+                                                  after=(first_page[0].timestamp, first_page[0].id))
+    assert [first_page[0].id, second_page[0].id] == [rename.id, email_change.id]
+
+async def test_import_profiles(repositories):
+    profiles, events = repositories
+    existing = await profiles.create(new_profile())
+    emails = [new_profile().email for _ in range(3)]
+    content = (
+        f'name,email\n"Imported, First",{emails[0]}\n'
+        f'Imported Second, {emails[1]} \n'
+        f'Duplicate,{emails[0]}\n'
+        f'Existing,{existing.email}\n'
+        f',{emails[2]}\n'
+        f'Bad Email,not-an-email\n'
+    ).encode()
+
+    async def chunks(size=7):  # Small chunks, so quoted fields and rows span them
+        for start in range(0, len(content), size):
+            yield content[start:start + size]
+
+    rejected = []
+    report = await import_profiles(profiles, chunks(), on_reject=rejected.append)
+    assert (report.rows, report.imported, report.rejected) == (6, 2, 4)
+    assert [(reject.row, reject.reason) for reject in rejected] == [
+        (3, "duplicate email in file"), (4, "email already exists"), (5, "missing name"), (6, "invalid email"),
+    ]
+    assert report.rejected_by_reason["missing name"] == 1
+
+    # Imported profiles (trimmed) with their first chained event, indistinguishable from created ones
+    imported = {profile.email: profile for profile in await profiles.get_all() if profile.email in emails}
+    assert {email: profile.name for email, profile in imported.items()} == {emails[0]: "Imported, First", emails[1]: "Imported Second"}
+    history = await events.get_by_user_id(imported[emails[1]].id)
+    assert [(event.action, event.chain_index) for event in history] == [(AuditEventAction.CREATE_PROFILE, 1)]
+    assert history[0].changes["email"] == {"old": None, "new": emails[1]}
+    assert (await events.verify_chain())["mismatch_count"] == 0
+
+async def test_import_profiles_rejects_malformed_files(repositories):
+    profiles, _ = repositories
+    email = new_profile().email
+
+    async def chunks(content):
+        yield content
+
+    with pytest.raises(ValueError):
+        await import_profiles(profiles, chunks(b"id,email\n"))
+    with pytest.raises((ValueError, asyncpg.DataError)):
+        await import_profiles(profiles, chunks(f"name,email\nValid,{email}\nToo,many,columns\n".encode()))
+    assert email not in {profile.email for profile in await profiles.get_all()}  # Nothing imported
@@ -0,0 +1,232 @@
+import os
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+import asyncpg
+import pytest
+from app import database, ids
+from app.jobs.import_profiles import import_profiles
+from app.jobs.purge_deleted_profiles import new_purge_run, purge_deleted_profiles
+from app.jobs.reshard import plan_moves, reshard
+from app.jobs.verify_audit_chain import new_summary
+from app.models.purge import PurgeStatus
+from app.models.user_profile import UserProfile, UserProfileCreate
+from app.pagination import decode_change_cursor, encode_change_cursor
+from app.profile_import import DUPLICATE_EMAIL, EMAIL_EXISTS, MISSING_NAME
+from app.repositories.memory import InMemoryStore, InMemoryUserProfileRepository
+from app.repositories.sharded import ShardedAuditEventRepository, ShardedUserProfileRepository, ShardSet, in_memory_shards, sharded_repositories
+from app.sharding import jump_hash, shard_for
+
+SHARDS = 3
+
+def sharded(stores):
+    shards = in_memory_shards(stores)
+    events = ShardedAuditEventRepository(shards)
+    return ShardedUserProfileRepository(shards, audit_event_repository=events), events
+
+def new_profile(name="Sharded User"):
+    return UserProfileCreate(name=name, email=f"sharded.{uuid.uuid4().hex}@example.com")
+
+def test_jump_hash_is_balanced_and_stable():
+    keys = [uuid.uuid4().int >> 64 for _ in range(20000)]
+    counts = Counter(jump_hash(key, 4) for key in keys)
+    assert set(counts) == {0, 1, 2, 3}
+    assert all(abs(count - 5000) < 500 for count in counts.values())
+    assert [jump_hash(key, 4) for key in keys[:100]] == [jump_hash(key, 4) for key in keys[:100]]
+
+def test_adding_a_shard_only_moves_users_to_it():
+    user_ids = [ids.new_id() for _ in range(5000)]
+    moved = [user_id for user_id in user_ids if shard_for(user_id, 4) != shard_for(user_id, 5)]
+    assert {shard_for(user_id, 5) for user_id in moved} == {4}
+    assert 0.15 < len(moved) / len(user_ids) < 0.25  # About 1/5
+    assert shard_for(user_ids[0], 3) == shard_for(user_ids[0].upper(), 3)
+
+def test_plan_moves_skips_users_already_in_place():
+    targets = ["postgresql://a", "postgresql://b", "postgresql://c"]
+    user_ids = [ids.new_id() for _ in range(300)]
+    moves = plan_moves(user_ids, "postgresql://a", targets)
+    assert 0 not in moves
+    assert sorted(user_id for keys in moves.values() for user_id in keys) == sorted(
+        user_id for user_id in user_ids if shard_for(user_id, 3) != 0
+    )
+
+@pytest.mark.asyncio
+async def test_users_are_colocated_with_their_events():
+    stores = [InMemoryStore() for _ in range(SHARDS)]
+    profiles, events = sharded(stores)
+    created = [await profiles.create(new_profile()) for _ in range(30)]
+    await profiles.delete(created[0].id)
+
+    for profile in created:
+        store = stores[shard_for(profile.id, SHARDS)]
+        assert profile.id in store.profiles
+        assert len(store.events_by_user[profile.id]) == (2 if profile is created[0] else 1)
+    assert sum(len(store.profiles) for store in stores) == 30
+    assert all(store.profiles for store in stores)
+    assert [profile.id for profile in await profiles.get_all()] == sorted(profile.id for profile in created)
+
+@pytest.mark.asyncio
+async def test_emails_are_unique_across_shards():
+    profiles, _ = sharded([InMemoryStore() for _ in range(SHARDS)])
+    first = await profiles.create(new_profile())
+    other_shard = next(user_id for user_id in iter(ids.new_id, None)
+                       if shard_for(user_id, SHARDS) != shard_for(first.id, SHARDS))
+    with pytest.raises(asyncpg.UniqueViolationError):
+        await profiles.create(UserProfileCreate(name="Duplicate", email=first.email), user_id=other_shard)
+    second = await profiles.create(new_profile(), user_id=other_shard)
+    with pytest.raises(asyncpg.UniqueViolationError):
+        await profiles.update(UserProfile(id=second.id, name="Duplicate", email=first.email, is_deleted=False))
+
+@pytest.mark.asyncio
+async def test_foreign_emails_ignore_the_users_own_shard():
+    profiles, _ = sharded([InMemoryStore() for _ in range(SHARDS)])
+    first = await profiles.create(new_profile())
+    same_shard = next(user_id for user_id in iter(ids.new_id, None) if shard_for(user_id, SHARDS) == shard_for(first.id, SHARDS))
+    other_shard = next(user_id for user_id in iter(ids.new_id, None) if shard_for(user_id, SHARDS) != shard_for(first.id, SHARDS))
+    assert await profiles.foreign_emails({same_shard: first.email, other_shard: "free@example.com"}) == set()
+    assert await profiles.foreign_emails({other_shard: first.email}) == {first.email}
+
+@pytest.mark.asyncio
+async def test_chains_are_verified_against_each_shards_own_checkpoints():
+    calls = []
+
+    class ShardEvents:
+        def __init__(self, index):
+            self.index = index
+
+        async def verify_chain(self, full=False, connect=None, pool=None):
+            calls.append((self.index, connect, pool))
+            return new_summary()
+
+    async def open_shard(index):
+        return None, ShardEvents(index)
+
+    await ShardedAuditEventRepository(ShardSet(SHARDS, open_shard)).verify_chain()
+    assert [(index, connect.func, connect.args) for index, connect, _ in calls] == [
+        (index, database.connect_to_shard, (index,)) for index in range(SHARDS)
+    ]
+    assert len({id(pool) for _, _, pool in calls}) == 1  # One pool of workers for every shard
+
+@pytest.mark.asyncio
+async def test_changes_cursor_has_one_position_per_shard():
+    profiles, _ = sharded([InMemoryStore() for _ in range(SHARDS)])
+    created = [await profiles.create(new_profile()) for _ in range(10)]
+
+    page = await profiles.get_changes(limit=4)
+    assert page.has_more and len(decode_change_cursor(page.cursor)) == SHARDS
+    rest = await profiles.get_changes(after=decode_change_cursor(page.cursor), limit=100)
+    assert [change.id for change in page.changes + rest.changes] == [profile.id for profile in created]
+    assert not rest.has_more
+
+    with pytest.raises(ValueError):
+        await profiles.get_changes(after=decode_change_cursor(encode_change_cursor([(0, ids.new_id())])))
+
+@pytest.mark.asyncio
+async def test_purge_fills_chunks_across_shards():
+    stores = [InMemoryStore() for _ in range(SHARDS)]
+    profiles, _ = sharded(stores)
+    for _ in range(12):
+        await profiles.delete((await profiles.create(new_profile())).id)
+
+    run = new_purge_run(older_than_days=0, chunk_size=5, now=datetime.now() + timedelta(seconds=1))
+    await purge_deleted_profiles(profiles, run, pause=0, max_lag=0)
+    assert (run.status, run.purged, run.chunks) == (PurgeStatus.COMPLETED, 12, 3)
+    assert not any(store.profiles for store in stores)
+    assert (await profiles.get_purge_run(run.id)).purged == 12
+
+@pytest.mark.asyncio
+async def test_purge_keeps_a_shard_open_after_a_short_chunk(monkeypatch):
+    stores = [InMemoryStore() for _ in range(SHARDS)]
+    profiles, _ = sharded(stores)
+    while len(stores[0].profiles) < 3:
+        await profiles.delete((await profiles.create(new_profile())).id)
+    locked = min(stores[0].profiles.values(), key=lambda row: (row["deleted_at"], row["id"]))["id"]
+
+    original = InMemoryUserProfileRepository.purge_chunk
+    async def purge_chunk(self, run, sweep=False):
+        # Like FOR UPDATE SKIP LOCKED: a row locked by another transaction is left out of the chunk
+        row = self.store.profiles.pop(locked) if self.store is stores[0] and not sweep else None
+        try:
+            return await original(self, run, sweep)
+        finally:
+            if row:
+                self.store.profiles[locked] = row
+    monkeypatch.setattr(InMemoryUserProfileRepository, "purge_chunk", purge_chunk)
+
+    run = new_purge_run(older_than_days=0, chunk_size=100, now=datetime.now() + timedelta(seconds=1))
+    await profiles.purge_chunk(run)
+    shard_run = await (await profiles.shards.get(0))[0].get_purge_run(f"{run.id}/0")
+    assert shard_run.status == PurgeStatus.RUNNING  # Short, but not empty: there may be locked rows left
+
+    await purge_deleted_profiles(profiles, run, pause=0, max_lag=0)
+    assert run.status == PurgeStatus.COMPLETED
+    assert not any(store.profiles for store in stores)
+
+@pytest.mark.asyncio
+async def test_import_spreads_rows_and_reports_them_in_file_order():
+    stores = [InMemoryStore() for _ in range(SHARDS)]
+    profiles, events = sharded(stores)
+    existing = await profiles.create(new_profile())
+    rows = [f"User {row},user{row}.{uuid.uuid4().hex}@example.com" for row in range(1, 10)]
+    rows[3] = f"Taken,{existing.email}"
+    rows[5] = "," + rows[5].split(",")[1]
+    rows[7] = "Again," + rows[0].split(",")[1]
+
+    async def chunks():
+        yield ("name,email\n" + "\n".join(rows) + "\n").encode()
+
+    rejects = []
+    report = await import_profiles(profiles, chunks(), on_reject=rejects.append)
+    assert (report.rows, report.imported, report.rejected) == (9, 6, 3)
+    assert [(reject.row, reject.reason) for reject in rejects] == [(4, EMAIL_EXISTS), (6, MISSING_NAME), (8, DUPLICATE_EMAIL)]
+
+    imported = [profile for profile in await profiles.get_all() if profile.id != existing.id]
+    assert len(imported) == 6
+    for profile in imported:
+        assert profile.id in stores[shard_for(profile.id, SHARDS)].profiles
+        assert len(await events.get_by_user_id(profile.id)) == 1
+
+@pytest.mark.asyncio
+async def test_scatter_queries_merge_shards():
+    profiles, events = sharded([InMemoryStore() for _ in range(SHARDS)])
+    created = [await profiles.create(new_profile()) for _ in range(9)]
+    for profile in created:
+        await profiles.update(UserProfile(**{**profile.model_dump(), "email": f"moved.{uuid.uuid4().hex}@example.com"}))
+
+    found = await events.find_field_changes("email", limit=1000)
+    assert [(event.timestamp, event.id) for event in found] == sorted(((event.timestamp, event.id) for event in found), reverse=True)
+    first_page = await events.find_field_changes("email", limit=4)
+    second_page = await events.find_field_changes("email", limit=4, after=(first_page[-1].timestamp, first_page[-1].id))
+    assert [event.id for event in first_page + second_page] == [event.id for event in found[:8]]
+
+    summary = await events.verify_chain()
+    assert (summary["mismatch_count"], summary["users_verified"]) == (0, 9)
+    assert len(await events.get_all()) == 18
+    assert await events.get_by_id(found[0].id) == found[0]
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(len(os.getenv("TEST_SHARD_URLS", "").split(",")) < 3,
+                    reason="needs three local Postgres databases (TEST_SHARD_URLS, comma separated)")
+async def test_reshard_moves_users_to_the_new_shard(monkeypatch):
+    # Integration test: users written on two shards are found on three after resharding
+    urls = [url.strip() for url in os.environ["TEST_SHARD_URLS"].split(",")][:3]
+    for url in urls:
+        connection = await asyncpg.connect(url)
+        await database.apply_schema(connection)
+        await connection.close()
+
+    monkeypatch.setattr(database, "DATABASE_SHARD_URLS", urls[:2])
+    async with sharded_repositories() as (profiles, _):
+        created = [await profiles.create(new_profile()) for _ in range(30)]
+        await profiles.delete(created[0].id)
+
+    summary = await reshard(urls[:2], urls)
+    assert summary["users_moved"]["user_profiles"] >= sum(shard_for(profile.id, 3) == 2 for profile in created)
+    assert set(summary["moves"]) <= {"0->2", "1->2"}
+
+    monkeypatch.setattr(database, "DATABASE_SHARD_URLS", urls)
+    async with sharded_repositories() as (profiles, events):
+        for profile in created:
+            assert (await profiles.get_by_id(profile.id)).email == profile.email
+            assert len(await events.get_by_user_id(profile.id)) == (2 if profile is created[0] else 1)
+    assert (await reshard(urls, urls))["users_moved"] == {}  # Nothing left to move
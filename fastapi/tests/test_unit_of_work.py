@@ -0,0 +1,80 @@
+import uuid
+import asyncpg
+import pytest
+from app import database
+from app.models.user_profile import UserProfileCreate
+from app.repositories.memory import InMemoryStore
+from app.unit_of_work import InMemoryUnitOfWork, ShardedUnitOfWork, UnitOfWork
+
+pytestmark = pytest.mark.asyncio
+
+def new_profile():
+    return UserProfileCreate(name="Unit Of Work", email=f"uow.{uuid.uuid4().hex}@example.com")
+
+async def test_audit_events_are_written_at_commit():
+    store = InMemoryStore()
+    async with InMemoryUnitOfWork(store) as unit_of_work:
+        created = await unit_of_work.user_profiles.create(new_profile())
+        await unit_of_work.user_profiles.delete(created.id)
+        assert len(unit_of_work.audit_events.pending) == 2
+        assert store.events == {}  # Buffered until commit
+
+    history = [store.events[event_id] for event_id in store.events_by_user[created.id]]
+    assert [(row["chain_index"], row["action"]) for row in history] == [(1, "CREATE_PROFILE"), (2, "DELETE_PROFILE")]
+
+async def test_audit_events_are_discarded_on_error():
+    store = InMemoryStore()
+    with pytest.raises(RuntimeError):
+        async with InMemoryUnitOfWork(store) as unit_of_work:
+            await unit_of_work.user_profiles.create(new_profile())
+            raise RuntimeError("handler failed")
+    assert store.events == {}
+
+async def test_postgres_rolls_back_profile_and_events_together():
+    try:
+        connection = await asyncpg.connect(database.DATABASE_URL, timeout=2)
+    except (OSError, asyncpg.PostgresError, TimeoutError) as e:
+        pytest.skip(f"Postgres not reachable: {e}")
+
+    try:
+        with pytest.raises(RuntimeError):
+            async with UnitOfWork(connection) as unit_of_work:
+                created = await unit_of_work.user_profiles.create(new_profile())
+                raise RuntimeError("handler failed")
+        assert await connection.fetchval("SELECT count(*) FROM user_profiles WHERE id = $1", created.id) == 0
+
+        async with UnitOfWork(connection) as unit_of_work:
+            created = await unit_of_work.user_profiles.create(new_profile())
+        assert await connection.fetchval("SELECT count(*) FROM audit_events WHERE user_id = $1", created.id) == 1
+    finally:
+        await connection.close()
+
+async def test_sharded_unit_of_work_commits_every_shard_touched():
+    try:
+        await (await asyncpg.connect(database.DATABASE_URL, timeout=2)).close()
+    except (OSError, asyncpg.PostgresError, TimeoutError) as e:
+        pytest.skip(f"Postgres not reachable: {e}")
+
+    async def connect(index):  # Two shards on the same database
+        connection = await asyncpg.connect(database.DATABASE_URL)
+        await database.register_codecs(connection)
+        return connection
+
+    async def close(connection):
+        await connection.close()
+
+    with pytest.raises(RuntimeError):
+        async with ShardedUnitOfWork(2, connect=connect, close=close) as unit_of_work:
+            discarded = [await unit_of_work.user_profiles.create(new_profile()) for _ in range(8)]
+            raise RuntimeError("handler failed")
+    async with ShardedUnitOfWork(2, connect=connect, close=close) as unit_of_work:
+        kept = [await unit_of_work.user_profiles.create(new_profile()) for _ in range(8)]
+
+    connection = await connect(0)
+    try:
+        assert await connection.fetchval("SELECT count(*) FROM user_profiles WHERE id = ANY($1::uuid[])",
+                                         [profile.id for profile in discarded]) == 0
+        assert await connection.fetchval("SELECT count(*) FROM audit_events WHERE user_id = ANY($1::uuid[])",
+                                         [profile.id for profile in kept]) == 8
+    finally:
+        await connection.close()
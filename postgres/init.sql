@@ -3,23 +3,154 @@
 -- Creation of the user_profiles table
 -- This table stores user profile information, including a unique identifier,
 -- name, email, and a flag indicating if the profile is deleted.
+-- Databases created when ids were VARCHAR columns are converted online by app/jobs/migrate_uuid_keys.py.
 CREATE TABLE IF NOT EXISTS user_profiles (
-    id VARCHAR(255) PRIMARY KEY,          -- Unique identifier for the user profile
+    id UUID PRIMARY KEY,                  -- Unique, time-ordered identifier for the user profile (UUID v7)
     name VARCHAR(255) NOT NULL,           -- Name of the user, cannot be null
     email VARCHAR(255) NOT NULL UNIQUE,   -- User's email, must be unique and cannot be null
-    is_deleted BOOLEAN DEFAULT FALSE       -- Soft delete flag, defaults to false
+    is_deleted BOOLEAN DEFAULT FALSE,      -- Soft delete flag, defaults to false
+    deleted_at TIMESTAMP,                  -- When the profile was soft deleted (NULL while active)
+    change_seq BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint, -- Transaction that last wrote the row
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP -- When the row was last written
 );
 
+-- Soft delete timestamp for databases created before the purge job existed
+-- (existing rows are filled in once by "python -m app.jobs.backfill_columns")
+ALTER TABLE user_profiles ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+-- Keyset order of the purge job; only soft-deleted profiles are indexed
+CREATE INDEX IF NOT EXISTS idx_user_profiles_purge ON user_profiles (deleted_at, id) WHERE is_deleted;
+
+-- Change tracking for the delta sync feed (GET /api/v1/users/profiles/changes/), for databases created before
+-- it existed. change_seq is the id of the transaction that last wrote the row; writes set both columns back
+-- to their defaults. A volatile default would rewrite the table under an exclusive lock (and give every
+-- existing row the same value), so change_seq is added without one: only new rows get it, the existing rows
+-- are filled in by "python -m app.jobs.backfill_columns", which then validates the NOT NULL check added here
+-- without scanning the table. Until then they are missing from the feed. updated_at's default is evaluated
+-- once for the existing rows, which is a catalog change only.
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'user_profiles' AND column_name = 'change_seq'
+    ) THEN
+        ALTER TABLE user_profiles ADD COLUMN change_seq BIGINT;
+        ALTER TABLE user_profiles ALTER COLUMN change_seq SET DEFAULT pg_current_xact_id()::text::bigint;
+        ALTER TABLE user_profiles ADD CONSTRAINT user_profiles_change_seq_not_null CHECK (change_seq IS NOT NULL) NOT VALID;
+    END IF;
+END $$;
+ALTER TABLE user_profiles ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+CREATE INDEX IF NOT EXISTS idx_user_profiles_changes ON user_profiles (change_seq, id);
+
+-- Creation of the user_profile_tombstones table
+-- Profiles hard deleted by the purge job, so that delta sync clients remove them too.
+CREATE TABLE IF NOT EXISTS user_profile_tombstones (
+    id UUID PRIMARY KEY,                   -- ID of the purged profile
+    change_seq BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint, -- Transaction that purged it
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP -- When it was purged
+);
+CREATE INDEX IF NOT EXISTS idx_user_profile_tombstones_changes ON user_profile_tombstones (change_seq, id);
+
 -- Creation of the audit_events table
 -- This table records audit events related to user actions, including the event's
 -- unique identifier, associated user ID, action performed, timestamp, resource,
 -- details about the event, and any changes made.
 CREATE TABLE IF NOT EXISTS audit_events (
-    id VARCHAR(255) PRIMARY KEY,           -- Unique identifier for the audit event
-    user_id VARCHAR(255),                  -- ID of the user associated with the event
+    id UUID PRIMARY KEY,                   -- Unique, time-ordered identifier for the audit event (UUID v7)
+    user_id UUID,                          -- ID of the user associated with the event
     action VARCHAR(255),                   -- Action performed that triggered the audit event
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- Timestamp of when the event occurred
     resource VARCHAR(255),                  -- Resource that the action was performed on
     details TEXT,                          -- Optional details about the event
-    changes JSONB                          -- JSONB field to record changes made during the event
-);
\ No newline at end of file
+    changes JSONB,                         -- JSONB field to record changes made during the event
+    chain_index INTEGER,                   -- Position of the event in the user's hash chain (1 = first event)
+    prev_hash CHAR(64),                    -- Hash of the previous event of the same user
+    hash CHAR(64)                          -- SHA-256 over prev_hash and the event content
+);
+
+-- Hash chain columns for databases created before the chain existed.
+-- Events written before that stay unsealed (NULL chain_index) until their user's next event, or until
+-- "python -m app.jobs.verify_audit_chain --seal-legacy" runs.
+ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS chain_index INTEGER;
+ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS prev_hash CHAR(64);
+ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS hash CHAR(64);
+
+-- One position per user in the chain; also serves per-user history reads and the ordered verification stream
+CREATE UNIQUE INDEX IF NOT EXISTS idx_audit_events_user_chain ON audit_events (user_id, chain_index);
+
+-- Keeps counting and finding unsealed events cheap
+CREATE INDEX IF NOT EXISTS idx_audit_events_unsealed ON audit_events (user_id) WHERE chain_index IS NULL;
+
+-- Creation of the audit_chain_checkpoints table
+-- Last verified event of every user's hash chain, so verification can resume incrementally.
+CREATE TABLE IF NOT EXISTS audit_chain_checkpoints (
+    user_id UUID PRIMARY KEY,              -- ID of the user whose chain was verified
+    chain_index INTEGER NOT NULL,          -- Index of the last verified event
+    hash CHAR(64) NOT NULL,                -- Hash of the last verified event
+    verified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP -- When the chain was last verified
+);
+
+-- Creation of the audit_events_archive table
+-- Events folded into a compaction checkpoint are moved here, out of the hot audit_events table.
+-- Same columns and indexes as audit_events.
+CREATE TABLE IF NOT EXISTS audit_events_archive (LIKE audit_events INCLUDING ALL);
+
+-- Range scans of the time-bucketed analytics (the archive was created before this index, so it gets its own)
+CREATE INDEX IF NOT EXISTS idx_audit_events_timestamp ON audit_events (timestamp);
+CREATE INDEX IF NOT EXISTS idx_audit_events_archive_timestamp ON audit_events_archive (timestamp);
+
+-- Latest events of a user first: profile listings with include=last_event / event_count
+CREATE INDEX IF NOT EXISTS idx_audit_events_user_timestamp ON audit_events (user_id, timestamp DESC, id DESC);
+
+-- Field-level queries: JSONB containment on changes, e.g. changes @> '{"email": {"old": "..."}}'
+CREATE INDEX IF NOT EXISTS idx_audit_events_changes ON audit_events USING GIN (changes jsonb_path_ops);
+CREATE INDEX IF NOT EXISTS idx_audit_events_archive_changes ON audit_events_archive USING GIN (changes jsonb_path_ops);
+
+-- Every audit event, archived or not (verification, rollbacks of old events, full listings).
+-- Columns are named: the two tables may not store them in the same order (see app/jobs/migrate_uuid_keys.py).
+-- Dropped and created again rather than replaced, so an earlier definition with other columns can't get in the way.
+DROP VIEW IF EXISTS audit_events_all;
+CREATE VIEW audit_events_all AS
+    SELECT id, user_id, action, timestamp, resource, details, changes, chain_index, prev_hash, hash FROM audit_events_archive
+    UNION ALL
+    SELECT id, user_id, action, timestamp, resource, details, changes, chain_index, prev_hash, hash FROM audit_events;
+
+-- Creation of the audit_verification_runs table
+-- Report of every verification of the hash chains started through the API (POST /api/v1/audit/verify/).
+CREATE TABLE IF NOT EXISTS audit_verification_runs (
+    id VARCHAR(255) PRIMARY KEY,           -- Unique identifier for the verification run
+    full_check BOOLEAN NOT NULL,           -- Whether the checkpoints were ignored
+    status VARCHAR(32) NOT NULL,           -- running, completed or failed
+    summary JSONB,                         -- Events and users verified and mismatches found
+    error TEXT,                            -- Why the run failed
+    started_at TIMESTAMP NOT NULL,         -- When the run was started
+    finished_at TIMESTAMP                  -- When the run completed or failed
+);
+
+-- Creation of the audit_checkpoints table
+-- Profile state after the events that compaction moved to the archive, one row per user.
+CREATE TABLE IF NOT EXISTS audit_checkpoints (
+    user_id UUID PRIMARY KEY,              -- ID of the user whose history was compacted
+    chain_index INTEGER NOT NULL,          -- Chain index of the last folded event
+    event_count INTEGER NOT NULL,          -- Number of events folded so far
+    up_to TIMESTAMP NOT NULL,              -- Timestamp of the last folded event
+    state JSONB NOT NULL,                  -- Profile state after the last folded event
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP -- When the checkpoint was last updated
+);
+
+-- Creation of the purge_runs table
+-- Progress report of every purge of soft-deleted profiles; the cursor lets failed or interrupted runs resume.
+CREATE TABLE IF NOT EXISTS purge_runs (
+    id VARCHAR(255) PRIMARY KEY,           -- Unique identifier for the purge run
+    cutoff TIMESTAMP NOT NULL,             -- Profiles soft deleted before this time are purged
+    chunk_size INTEGER NOT NULL,           -- Profiles hard deleted per transaction
+    status VARCHAR(32) NOT NULL,           -- running, completed or failed
+    purged INTEGER NOT NULL DEFAULT 0,     -- Profiles hard deleted so far
+    chunks INTEGER NOT NULL DEFAULT 0,     -- Chunks committed so far
+    cursor_deleted_at TIMESTAMP,           -- Keyset cursor: deleted_at of the last purged profile
+    cursor_id UUID,                        -- Keyset cursor: id of the last purged profile
+    error TEXT,                            -- Why the run failed
+    started_at TIMESTAMP NOT NULL,         -- When the run was started
+    updated_at TIMESTAMP NOT NULL,         -- When the last chunk was committed
+    finished_at TIMESTAMP                  -- When the run completed
+);